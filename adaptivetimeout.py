@@ -0,0 +1,74 @@
+from collections import deque
+from threading import Lock
+
+# The most recent window latencies for each key
+class LatencyTracker():
+    def __init__(self, window):
+        self._window = window
+        self._lock = Lock()
+        self._samples = {}
+
+    def add(self, key, secs):
+        with self._lock:
+            if key not in self._samples:
+                self._samples[key] = deque(maxlen=self._window)
+            self._samples[key].append(secs)
+
+    # The q quantile of key's latencies, or None if there are fewer than
+    # min_samples of them
+    def quantile(self, key, q, min_samples):
+        with self._lock:
+            if key not in self._samples: return None
+            samples = sorted(self._samples[key])
+        if len(samples) < min_samples: return None
+        return samples[min(len(samples)-1, int(q * len(samples)))]
+
+# Circuit build and SOCKS connect timeouts based on how long builds and
+# connects through the same relays, or failing that through our tor instance
+# at all, have taken recently: a high quantile plus a margin, kept between
+# args.timeout_min and the fixed timeout we used to always use.
+#
+# Every circuit's latency counts for every relay in it other than W and Z.
+# A circuit is as slow as its slowest relay, so a path's timeout is the
+# largest of its relays' timeouts. A timeout counts as a latency of the
+# timeout itself so a slow but working relay gets more time on its next try.
+class AdaptiveTimeouts():
+    INSTANCE_KEY = '*'
+
+    def __init__(self, args, logger):
+        self._args = args
+        self._log = logger
+        self._fixed = set([args.w_relay, args.z_relay])
+        self._build = LatencyTracker(args.timeout_window)
+        self._connect = LatencyTracker(args.timeout_window)
+
+    def build_timeout(self, path):
+        return self._timeout(self._build, path, self._args.circ_build_timeout)
+
+    def connect_timeout(self, path):
+        return self._timeout(self._connect, path, self._args.socks_timeout)
+
+    def record_build(self, path, secs):
+        self._record(self._build, path, secs)
+
+    def record_connect(self, path, secs):
+        self._record(self._connect, path, secs)
+
+    def _record(self, tracker, path, secs):
+        tracker.add(AdaptiveTimeouts.INSTANCE_KEY, secs)
+        for fp in path:
+            if fp not in self._fixed: tracker.add(fp, secs)
+
+    def _timeout(self, tracker, path, cap):
+        args = self._args
+        q, min_samples = args.timeout_quantile, args.timeout_min_samples
+        latencies = [ tracker.quantile(fp, q, min_samples) \
+                for fp in path if fp not in self._fixed ]
+        latencies = [ l for l in latencies if l != None ]
+        if len(latencies) <= 0:
+            latency = tracker.quantile(AdaptiveTimeouts.INSTANCE_KEY, q,
+                    min_samples)
+            if latency == None: return cap
+            latencies = [ latency ]
+        timeout = max(latencies) + args.timeout_margin
+        return min(cap, max(args.timeout_min, timeout))
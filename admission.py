@@ -0,0 +1,185 @@
+import fcntl
+import json
+import os
+import random
+import time
+
+# Every circuit from every client thread in every ting process on this host
+# goes through the same W relay, so a burst of circuit builds and ting
+# streams from all of them at once loads W enough to inflate the RTTs we
+# measure through it and to make builds fail. This limits how many circuit
+# builds and how many ting streams are in flight at once across the whole
+# host, and how fast new circuit builds may start.
+#
+# Everything is shared through files in args.admission_dir:
+#
+#   build-N.lock, stream-N.lock
+#       One file per slot. Holding an flock on one is holding the slot. The
+#       kernel drops it if the process holding it dies, so a crashed ting
+#       process never leaks a slot.
+#   state.json (guarded by an flock on state.lock)
+#       The current circuit build concurrency limit, a token bucket limiting
+#       the rate at which builds start, and what the limit is based on.
+#
+# The build limit is adjusted like a TCP congestion window: it grows by about
+# one for every limit builds that go fine and is multiplied by
+# args.admission_decrease when W looks overloaded, at most once per typical
+# build time. W looks overloaded when a build takes more than
+# args.admission_latency_factor times as long as the fastest builds have
+# lately, or when a build fails while more than args.admission_failure_rate
+# of recent builds have failed. A single failure usually means a relay in the
+# circuit is down and says nothing about W. Builds that tor refused to even
+# start count for nothing.
+#
+# The number of ting streams is a fixed args.admission_streams. They put a
+# steady load on W for as long as they sample, so whether they're hurting is
+# better seen in the build latencies than in anything about the streams.
+class AdmissionControl():
+    # How much each build moves the averages of the failure rate and of the
+    # fastest build time
+    FAILURE_WEIGHT = 0.05
+    LATENCY_WEIGHT = 0.01
+    # How often to look for a free slot when there isn't one, and how often to
+    # reread the limit while doing so
+    POLL_INTERVAL = 0.05
+    REFRESH_INTERVAL = 1.0
+
+    def __init__(self, args, logger):
+        self._args = args
+        self._log = logger
+        self._dname = os.path.abspath(args.admission_dir)
+        os.makedirs(self._dname, exist_ok=True)
+        self._limit = args.admission_start
+        self._refreshed_at = 0
+
+    def _default_state(self, now):
+        return { 'limit': self._args.admission_start,
+                'tokens': self._args.admission_burst, 'refilled_at': now,
+                'base_latency': None, 'failure_rate': 0.0,
+                'decreased_at': 0 }
+
+    # Call func with the shared state while holding the lock on it, write the
+    # state back, and return whatever func did
+    def _with_state(self, func):
+        fname = os.path.join(self._dname, 'state.json')
+        now = time.time()
+        with open(os.path.join(self._dname, 'state.lock'), 'at') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self._default_state(now)
+            if os.path.isfile(fname):
+                with open(fname, 'rt') as f:
+                    try: state.update(json.load(f))
+                    except ValueError: pass
+            ret = func(state, now)
+            tmp_fname = fname + '.tmp'
+            with open(tmp_fname, 'wt') as f: json.dump(state, f)
+            os.replace(tmp_fname, fname)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        self._limit = state['limit']
+        self._refreshed_at = now
+        return ret
+
+    # A slot is (its number, its open lock file)
+    def _try_slot(self, kind, limit):
+        slots = list(range(max(1, int(limit))))
+        random.shuffle(slots)
+        for i in slots:
+            f = open(os.path.join(self._dname,
+                '{}-{}.lock'.format(kind, i)), 'at')
+            try: fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError: f.close()
+            else: return i, f
+        return None
+
+    def _wait_for_slot(self, kind, get_limit):
+        while True:
+            slot = self._try_slot(kind, get_limit())
+            if slot: return slot
+            time.sleep(AdmissionControl.POLL_INTERVAL * (0.5 + random.random()))
+
+    def _release_slot(self, slot):
+        _, f = slot
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+    def _build_limit(self):
+        if self._refreshed_at + AdmissionControl.REFRESH_INTERVAL < \
+                time.time():
+            self._with_state(lambda state, now: None)
+        return self._limit
+
+    # Take a token if there is one. Returns how long to wait for one if not.
+    def _take_token(self, state, now):
+        args = self._args
+        state['tokens'] = min(args.admission_burst, state['tokens'] + \
+                (now - state['refilled_at']) * args.admission_rate)
+        state['refilled_at'] = now
+        if state['tokens'] >= 1:
+            state['tokens'] -= 1
+            return 0
+        return (1 - state['tokens']) / args.admission_rate
+
+    # Wait until we may start building a circuit and return what to give to
+    # release_build() once it's built or has failed. The slot we got may be
+    # past a limit that was lowered while we waited for a token, in which
+    # case we let it go and wait for another.
+    def acquire_build(self):
+        while True:
+            slot = self._wait_for_slot('build', self._build_limit)
+            while True:
+                wait = self._with_state(self._take_token)
+                if wait <= 0: break
+                time.sleep(wait)
+            if slot[0] < max(1, int(self._limit)): return slot
+            self._release_slot(slot)
+
+    # secs is how long the build took and succeeded whether it worked. Leave
+    # them out if the build says nothing about how loaded W is.
+    def release_build(self, slot, secs=None, succeeded=None):
+        try:
+            if secs != None:
+                self._with_state(lambda state, now: self._adjust(state, now,
+                    secs, succeeded))
+        finally:
+            self._release_slot(slot)
+
+    def _adjust(self, state, now, secs, succeeded):
+        args = self._args
+        a = AdmissionControl.FAILURE_WEIGHT
+        state['failure_rate'] = (1 - a) * state['failure_rate'] + \
+                a * (0 if succeeded else 1)
+        base = state['base_latency']
+        if succeeded:
+            # Drift up slowly so that a few lucky builds don't set the bar
+            # forever
+            if base == None or secs < base: base = secs
+            else: base += (secs - base) * AdmissionControl.LATENCY_WEIGHT
+            state['base_latency'] = base
+        if base == None: return
+        if succeeded: overloaded = secs > base * args.admission_latency_factor
+        else: overloaded = state['failure_rate'] > args.admission_failure_rate
+        limit = state['limit']
+        if not overloaded:
+            state['limit'] = min(args.admission_max, limit + 1.0 / limit)
+        elif state['decreased_at'] + base * args.admission_latency_factor \
+                < now:
+            state['limit'] = max(args.admission_min,
+                    limit * args.admission_decrease)
+            state['decreased_at'] = now
+            if int(state['limit']) < int(limit):
+                self._log.info('Lowering the host-wide circuit build limit '
+                    'to',int(state['limit']),'after a',round(secs, 2),
+                    'sec build that', 'worked' if succeeded else 'failed')
+
+    # Wait until we may open a ting stream and return what to give to
+    # release_stream() once it's closed
+    def acquire_stream(self):
+        return self._wait_for_slot('stream',
+                lambda: self._args.admission_streams)
+
+    def release_stream(self, slot):
+        self._release_slot(slot)
+
+    # The current circuit build limit, for stats
+    def build_limit(self):
+        return self._limit
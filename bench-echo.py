@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# Find out how many ting streams at once echo.py can take before its own
+# queueing shows up in the RTTs we measure through it.
+#
+# For each of the given --workers counts, echo.py is started on localhost with
+# that many --concurrent-connections and hammered with --connections client
+# connections at once speaking the same protocol as TingClient: a b'!' that
+# is echoed back, --samples times per connection, then a b'X'. Each client
+# process drives its share of the connections from one select() loop.
+#
+# For each run we print:
+#   - how long connecting took until the first echo came back, which is
+#     mostly waiting for a worker to accept() the connection
+#   - how much longer than on an idle server each echo took, which is what
+#     echo.py adds to every RTT ting measures
+#   - echoes per second, and how many connections failed or didn't finish
+#
+# Connections past the number of workers wait in the listen queue
+# (--pending-connections) until a worker is free, and past that the kernel
+# drops their SYNs and the client tries again a second or more later, so a
+# server with too few workers or too short a queue shows up as a long tail of
+# connect times.
+import heapq
+import multiprocessing
+import os
+import resource
+import selectors
+import signal
+import socket
+import subprocess
+import sys
+import time
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+
+def fail_hard(*msg):
+    if msg: print(*msg, file=sys.stderr)
+    exit(1)
+
+def quantile(l, q):
+    if len(l) <= 0: return float('nan')
+    return l[min(len(l)-1, int(q * len(l)))]
+
+# Drive num_conns connections to host:port at once. Returns the connect to
+# first echo time of every connection, the time of every other echo, and how
+# many connections failed.
+def run_clients(host, port, num_conns, samples, interval, timeout):
+    sel = selectors.DefaultSelector()
+    connect_times, echo_times = [], []
+    failures = 0
+    # conn -> [ started_at, sent_at, echoes so far ]
+    conns = {}
+    # (when, conn) of connections waiting out interval before their next ting
+    timers = []
+    def send_ting(s, now):
+        try: s.send(b'!')
+        except OSError: return False
+        conns[s][1] = now
+        sel.register(s, selectors.EVENT_READ)
+        return True
+    def finish(s, ok):
+        try:
+            if ok: s.send(b'X')
+        except OSError: ok = False
+        s.close()
+        del conns[s]
+        return 0 if ok else 1
+    deadline = time.time() + timeout
+    for _ in range(num_conns):
+        s = socket.socket()
+        s.setblocking(False)
+        s.connect_ex( (host, port) )
+        conns[s] = [ time.time(), None, 0 ]
+        sel.register(s, selectors.EVENT_WRITE)
+    while len(conns) > 0 and time.time() < deadline:
+        wait = 1
+        if len(timers) > 0: wait = max(0, min(wait, timers[0][0] - time.time()))
+        for key, mask in sel.select(wait):
+            s = key.fileobj
+            now = time.time()
+            sel.unregister(s)
+            if mask & selectors.EVENT_WRITE:
+                # Connected, or failed to
+                if s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0 or \
+                        not send_ting(s, now):
+                    failures += finish(s, False)
+                continue
+            try: data = s.recv(1)
+            except OSError: data = b''
+            if data != b'!':
+                failures += finish(s, False)
+                continue
+            started_at, sent_at, num = conns[s]
+            if num == 0: connect_times.append(now - started_at)
+            else: echo_times.append(now - sent_at)
+            conns[s][2] = num + 1
+            if num + 1 > samples: failures += finish(s, True)
+            elif interval > 0:
+                heapq.heappush(timers, (now + interval, id(s), s))
+            elif not send_ting(s, now): failures += finish(s, False)
+        now = time.time()
+        while len(timers) > 0 and timers[0][0] <= now:
+            _, _, s = heapq.heappop(timers)
+            if not send_ting(s, now): failures += finish(s, False)
+    # Whatever is left didn't finish in time
+    failures += len(conns)
+    for s in list(conns.keys()): s.close()
+    return connect_times, echo_times, failures
+
+def start_echo(args, workers, port):
+    proc = subprocess.Popen([ sys.executable, args.echo_script,
+            '--listen-ip', '127.0.0.1', '--listen-port', str(port),
+            '--concurrent-connections', str(workers),
+            '--pending-connections', str(args.pending_connections) ],
+            stdout=subprocess.DEVNULL, start_new_session=True)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try: socket.create_connection( ('127.0.0.1', port) ).close()
+        except ConnectionRefusedError: time.sleep(0.1)
+        else: return proc
+    stop_echo(proc)
+    fail_hard('echo.py never started listening on port', port)
+
+# echo.py's workers are forked children in its process group
+def stop_echo(proc):
+    try: os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError: pass
+    proc.wait()
+
+def run(args, workers, port):
+    proc = start_echo(args, workers, port)
+    try:
+        # What an echo takes when nothing else is going on
+        _, idle, _ = run_clients('127.0.0.1', port, 1, args.samples * 5, 0,
+                args.timeout)
+        idle = quantile(sorted(idle), 0.5)
+        per_proc = [ args.connections // args.client_procs ] * \
+                args.client_procs
+        per_proc[0] += args.connections - sum(per_proc)
+        start = time.time()
+        with multiprocessing.Pool(args.client_procs) as pool:
+            outs = pool.starmap(run_clients, [ ('127.0.0.1', port, n,
+                args.samples, args.interval, args.timeout) \
+                for n in per_proc ])
+        duration = time.time() - start
+    finally:
+        stop_echo(proc)
+    connect_times = sorted([ t for out in outs for t in out[0] ])
+    echo_times = sorted([ t - idle for out in outs for t in out[1] ])
+    failures = sum([ out[2] for out in outs ])
+    qs = [ 0.5, 0.9, 0.99, 1.0 ]
+    print('{:>7} {:>9.0f} {} {} {:>6}'.format(workers,
+        len(echo_times) / duration,
+        ' '.join([ '{:>8.4f}'.format(quantile(connect_times, q)) \
+                for q in qs ]),
+        ' '.join([ '{:>8.5f}'.format(quantile(echo_times, q)) \
+                for q in qs ]),
+        failures))
+    sys.stdout.flush()
+
+def main(args):
+    # Every connection is a file descriptor on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    want = 2 * args.connections + 100
+    if soft < want and (hard == resource.RLIM_INFINITY or hard >= want):
+        resource.setrlimit(resource.RLIMIT_NOFILE, (want, hard))
+    elif soft < want:
+        fail_hard('Need',want,'open files but may only have',hard)
+    print('# {} connections at once, {} tings each {} secs apart, echo.py '
+            'listen queue {}'.format(args.connections, args.samples,
+            args.interval, args.pending_connections))
+    print('# {:>5} {:>9} {} {} {:>6}'.format('workers', 'echoes/s',
+        ' '.join([ '{:>8}'.format('conn_' + q) \
+                for q in ['p50', 'p90', 'p99', 'max'] ]),
+        ' '.join([ '{:>8}'.format('echo_' + q) \
+                for q in ['p50', 'p90', 'p99', 'max'] ]),
+        'failed'))
+    for i, workers in enumerate(args.workers):
+        run(args, workers, args.port + i)
+
+if __name__=='__main__':
+    parser = ArgumentParser(
+            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--workers', metavar='NUM', type=int, nargs='+',
+            help='echo.py --concurrent-connections values to try',
+            default=[50, 100, 200, 500])
+    parser.add_argument('--pending-connections', metavar='NUM', type=int,
+            help='echo.py --pending-connections to use', default=30)
+    parser.add_argument('--connections', metavar='NUM', type=int,
+            help='Number of client connections to have open at once',
+            default=1000)
+    parser.add_argument('--samples', metavar='NUM', type=int,
+            help='Number of tings to send over each connection', default=20)
+    parser.add_argument('--interval', metavar='SECS', type=float,
+            help='How long to wait between tings on a connection. Through '
+            'tor, each ting waits for the one before it to make it all the '
+            'way around the circuit', default=0.25)
+    parser.add_argument('--client-procs', metavar='NUM', type=int,
+            help='Number of processes to split the client connections '
+            'between', default=4)
+    parser.add_argument('--timeout', metavar='SECS', type=float,
+            help='Give up on connections that haven\'t finished after this '
+            'long', default=120)
+    parser.add_argument('--port', metavar='PORT', type=int,
+            help='Port for echo.py to listen on for the first run. Each run '
+            'after uses the next one', default=16700)
+    parser.add_argument('--echo-script', metavar='FNAME', type=str,
+            help='echo.py to benchmark',
+            default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            'echo.py'))
+    args = parser.parse_args()
+    if args.connections < args.client_procs:
+        fail_hard('Need at least as many --connections as --client-procs')
+    exit(main(args))
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# Compare the memory use and multithreaded lookup speed of the old
+# dict-of-dicts leg cache behind a single lock with RttCache.
+#
+# Entries are made up the way ting2.py makes them: 3 hop paths W-X-Z and 4
+# hop paths W-X-Y-Z between --relays random relays. The old cache is built
+# the way json.load() would build it from a cache file, so no strings are
+# shared between entries.
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from threading import Lock, Thread
+from rttcache import RttCache
+import gc
+import json
+import os
+import random
+import time
+import tracemalloc
+
+def random_fp():
+    return '{:040X}'.format(random.getrandbits(160))
+
+def make_paths(args):
+    w, z = random_fp(), random_fp()
+    relays = [ random_fp() for _ in range(args.relays) ]
+    paths = [ [w, x, z] for x in relays ]
+    while len(paths) < args.entries:
+        x, y = random.sample(relays, 2)
+        paths.append([w, x, y, z])
+    return paths[:args.entries]
+
+# A copy of every string, like json.load() would give us
+def copy_fp(fp):
+    return ''.join(list(fp))
+
+def build_dict_cache(paths, now):
+    cache = {}
+    for path in paths:
+        path = [ copy_fp(fp) for fp in path ]
+        cache['-'.join(path)] = { 'rtt': random.random(), 'path': path,
+                'time': now }
+    return cache
+
+def build_rtt_cache(paths, now, num_stripes):
+    cache = RttCache(num_stripes)
+    for path in paths:
+        cache.merge([ copy_fp(fp) for fp in path ], random.random(), now)
+    return cache
+
+def measure_memory(build, *args):
+    gc.collect()
+    tracemalloc.start()
+    cache = build(*args)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cache, size
+
+# Each thread does args.ops lookups, a tenth of which are followed by an
+# insert, like a TingClient that finds most of its legs in the cache. If
+# do_write is given, another thread keeps writing the cache out like ting2.py
+# does every --write-cache-every results. Returns the ops per second and the
+# longest any one op took.
+def run_threads(args, paths, do_get, do_put, do_write=None):
+    longest = [ 0 ] * args.threads
+    def enter(i):
+        rng = random.Random(i)
+        for _ in range(args.ops):
+            path = paths[rng.randrange(len(paths))]
+            start = time.time()
+            do_get(path)
+            if rng.random() < 0.1: do_put(path, rng.random())
+            longest[i] = max(longest[i], time.time() - start)
+    threads = [ Thread(target=enter, args=(i,)) for i in range(args.threads) ]
+    start = time.time()
+    for thr in threads: thr.start()
+    if do_write:
+        while any([ thr.is_alive() for thr in threads ]): do_write()
+    for thr in threads: thr.join()
+    return args.ops * args.threads / (time.time() - start), max(longest)
+
+def dict_cache_ops(cache, life):
+    lock = Lock()
+    def do_get(path):
+        key = '-'.join(path)
+        with lock:
+            if key not in cache: return None
+            if cache[key]['time'] + life < time.time(): return None
+            return cache[key]['rtt']
+    def do_put(path, rtt):
+        key = '-'.join(path)
+        with lock:
+            if key not in cache or cache[key]['rtt'] > rtt:
+                cache[key] = { 'rtt': rtt, 'path': path, 'time': time.time() }
+    def do_write():
+        with lock, open(os.devnull, 'wt') as f: json.dump(cache, f)
+    return do_get, do_put, do_write
+
+def rtt_cache_ops(cache, life):
+    do_get = lambda path: cache.get(path, life)
+    do_put = lambda path, rtt: cache.put(path, rtt, life)
+    # What dump() does, minus renaming a tmp file over the one we write to
+    def do_write():
+        with open(os.devnull, 'wt') as f: json.dump(cache.to_dict(), f)
+    return do_get, do_put, do_write
+
+def main(args):
+    random.seed(args.seed)
+    paths = make_paths(args)
+    now = time.time()
+    life = 60*60*24
+    print('Benchmarking with {} entries, {} relays, {} threads doing {} '
+            'ops each'.format(len(paths), args.relays, args.threads,
+            args.ops))
+    dict_cache, dict_size = measure_memory(build_dict_cache, paths, now)
+    rtt_cache, rtt_size = measure_memory(build_rtt_cache, paths, now,
+            args.stripes)
+    print('Memory:  dict {:.1f} MiB ({:.0f} B/entry), RttCache {:.1f} MiB '
+            '({:.0f} B/entry)'.format(dict_size/2**20, dict_size/len(paths),
+            rtt_size/2**20, rtt_size/len(paths)))
+    dict_ops = dict_cache_ops(dict_cache, life)
+    rtt_ops = rtt_cache_ops(rtt_cache, life)
+    for name, with_writes in [ ('Lookups', False),
+            ('Lookups while writing the cache', True) ]:
+        dict_rate, dict_longest = run_threads(args, paths, *dict_ops[0:2],
+                do_write=dict_ops[2] if with_writes else None)
+        rtt_rate, rtt_longest = run_threads(args, paths, *rtt_ops[0:2],
+                do_write=rtt_ops[2] if with_writes else None)
+        print('{}: dict {:.0f} ops/sec (longest {:.3f}s), RttCache {:.0f} '
+                'ops/sec (longest {:.3f}s) with {} stripes'.format(name,
+                dict_rate, dict_longest, rtt_rate, rtt_longest,
+                args.stripes))
+
+if __name__=='__main__':
+    parser = ArgumentParser(
+            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--entries', metavar='NUM', type=int,
+            help='Number of cache entries', default=500000)
+    parser.add_argument('--relays', metavar='NUM', type=int,
+            help='Number of relays the entries are between', default=7000)
+    parser.add_argument('--threads', metavar='NUM', type=int,
+            help='Number of threads using the cache at once', default=16)
+    parser.add_argument('--ops', metavar='NUM', type=int,
+            help='Number of lookups each thread does', default=50000)
+    parser.add_argument('--stripes', metavar='NUM', type=int,
+            help='Number of stripes to give the RttCache', default=16)
+    parser.add_argument('--seed', metavar='NUM', type=int,
+            help='Seed for the random number generator', default=1)
+    args = parser.parse_args()
+    exit(main(args))
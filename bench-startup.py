@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# Measure what ting2.py does before it can measure its first pair, the old
+# way and the current way.
+#
+# Made up cache, results, and relaylist files of the given sizes are used to
+# time loading the cache and pruning the relay list of pairs with recent
+# results. The old way did one after the other and kept every result in
+# memory. Now the cache loads in the background while the relay list is
+# pruned.
+#
+# If --ctrl-port is given, connecting one controller per thread to that tor
+# is also timed, one at a time like ting2.py used to and all at once like it
+# does now.
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from threading import Thread
+from resultindex import ResultIndex
+from rttcache import RttCache
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+def random_fp():
+    return '{:040X}'.format(random.getrandbits(160))
+
+def make_files(args, dname):
+    w, z = random_fp(), random_fp()
+    relays = [ random_fp() for _ in range(args.relays) ]
+    now = time.time()
+    cache = {}
+    for x in relays:
+        path = [w, x, z]
+        cache['-'.join(path)] = { 'rtt': random.random(), 'path': path,
+                'time': now }
+    while len(cache) < args.cache_entries:
+        path = [w] + random.sample(relays, 2) + [z]
+        cache['-'.join(path)] = { 'rtt': random.random(), 'path': path,
+                'time': now }
+    cache_fname = os.path.join(dname, 'cache.json')
+    with open(cache_fname, 'wt') as f: json.dump(cache, f)
+    results_fname = os.path.join(dname, 'results.json')
+    with open(results_fname, 'wt') as f:
+        for _ in range(args.results):
+            x, y = random.sample(relays, 2)
+            res = { 'time': now - random.random() * 60*60*24*200,
+                'rtt': random.random(),
+                'x': { 'fp': x, 'ip': '0.0.0.0', 'nick': 'x' },
+                'y': { 'fp': y, 'ip': '0.0.0.0', 'nick': 'y' } }
+            f.write('{}\n'.format(json.dumps(res)))
+    pairs = set()
+    while len(pairs) < args.pairs:
+        pairs.add(tuple(sorted(random.sample(relays, 2))))
+    return cache_fname, results_fname, pairs
+
+# What RelayList._prune_existing_results used to do
+def old_prune(pairs, results_fname, life):
+    now = time.time()
+    results = []
+    for line in open(results_fname, 'rt'): results.append(json.loads(line))
+    for res in results:
+        xy = ( res['x']['fp'], res['y']['fp'] )
+        if xy[0] > xy[1]: xy = xy[1], xy[0]
+        if res['time'] + life < now: continue
+        if xy in pairs: pairs.remove(xy)
+
+def new_prune(pairs, results_fname, life):
+    now = time.time()
+    result_index = ResultIndex(include_failures=True).load(results_fname)
+    for xy in [ xy for xy in pairs \
+            if result_index.is_fresh(xy[0], xy[1], life, now) ]:
+        pairs.remove(xy)
+
+def time_files(args):
+    dname = tempfile.mkdtemp()
+    try:
+        cache_fname, results_fname, pairs = make_files(args, dname)
+        life = 60*60*24*100
+        times = {}
+        start = time.time()
+        json.load(open(cache_fname, 'rt'))
+        times['old_cache'] = time.time() - start
+        start = time.time()
+        old_prune(set(pairs), results_fname, life)
+        times['old_prune'] = time.time() - start
+        start = time.time()
+        RttCache().load(cache_fname)
+        times['new_cache'] = time.time() - start
+        start = time.time()
+        new_prune(set(pairs), results_fname, life)
+        times['new_prune'] = time.time() - start
+        start = time.time()
+        rtt_cache = RttCache().load_in_background(cache_fname)
+        new_prune(set(pairs), results_fname, life)
+        times['new_pruned_at'] = time.time() - start
+        rtt_cache.get(['0'*40]*3, life)
+        times['new_total'] = time.time() - start
+    finally:
+        shutil.rmtree(dname)
+    print('Loading the cache: old {old_cache:.2f}s, new {new_cache:.2f}s\n'
+            'Pruning the relay list: old {old_prune:.2f}s, new '
+            '{new_prune:.2f}s\n'
+            'Both: old {old:.2f}s one after the other, new {new_total:.2f}s '
+            'with the cache loading in the background ({new_pruned_at:.2f}s '
+            'until the relay list was ready)'.format(
+            old=times['old_cache'] + times['old_prune'], **times))
+
+# stem is only needed for this part
+def connect(port):
+    from stem.control import Controller
+    cont = Controller.from_port(port=port)
+    cont.authenticate()
+    cont.set_conf('__DisablePredictedCircuits', '1')
+    cont.set_conf('__LeaveStreamsUnattached', '1')
+    return cont
+
+def time_controllers(args):
+    start = time.time()
+    conts = [ connect(args.ctrl_port) for _ in range(args.threads) ]
+    old = time.time() - start
+    for cont in conts: cont.close()
+    conts = []
+    def enter(): conts.append(connect(args.ctrl_port))
+    threads = [ Thread(target=enter) for _ in range(args.threads) ]
+    start = time.time()
+    for thr in threads: thr.start()
+    for thr in threads: thr.join()
+    new = time.time() - start
+    for cont in conts: cont.close()
+    print('{} controllers: one at a time {:.2f}s, all at once {:.2f}s'.format(
+        args.threads, old, new))
+
+def main(args):
+    random.seed(args.seed)
+    print('Benchmarking with {} cache entries, {} results, and {} '
+            'pairs'.format(args.cache_entries, args.results, args.pairs))
+    time_files(args)
+    if args.ctrl_port: time_controllers(args)
+
+if __name__=='__main__':
+    parser = ArgumentParser(
+            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--cache-entries', metavar='NUM', type=int,
+            help='Number of entries in the cache file', default=200000)
+    parser.add_argument('--results', metavar='NUM', type=int,
+            help='Number of results in the results file', default=500000)
+    parser.add_argument('--pairs', metavar='NUM', type=int,
+            help='Number of pairs in the relay list', default=10000)
+    parser.add_argument('--relays', metavar='NUM', type=int,
+            help='Number of relays the pairs are between', default=7000)
+    parser.add_argument('--ctrl-port', metavar='PORT', type=int,
+            help='Also time connecting to the tor with this control port')
+    parser.add_argument('--threads', metavar='NUM', type=int,
+            help='Number of controllers to connect', default=16)
+    parser.add_argument('--seed', metavar='NUM', type=int,
+            help='Seed for the random number generator', default=1)
+    args = parser.parse_args()
+    exit(main(args))
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# Check the coordinator and its workers end to end on localhost, without tor.
+#
+# A coordinator is started on 127.0.0.1 with --pairs made up relay pairs and
+# --workers CoordinatorClients connect to it over TCP, each in its own thread
+# with its own RttCache, "measuring" every pair they're leased by making up
+# an RTT for it and for the 3 hop legs of both its relays. Before they start,
+# one more worker leases some pairs and then goes silent without
+# disconnecting, so that its lease has to expire and be given to someone
+# else.
+#
+# Once every pair is done we check that:
+#   - no pair was leased out again unless the lease it was in expired or was
+#     given back, and that the silent worker's lease was
+#   - every pair has exactly one result, in the results file too
+#   - the coordinator's cache has every leg any worker measured, each with
+#     the lowest RTT measured for it, and every worker heard about legs
+#     measured by the others
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, Namespace
+from threading import Lock, Thread
+from compression import open_file
+from coordinator import (Coordinator, CoordinatorClient, CoordinatorServer,
+        recv_msg, send_msg)
+from pastlylogger import PastlyLogger
+from resultindex import ResultIndex
+from rttcache import RttCache, cache_lifetimes
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+log = PastlyLogger(warn='/dev/stderr')
+W_RELAY, Z_RELAY = 'W' * 40, 'Z' * 40
+
+def fail_hard(*msg):
+    if msg: print(*msg, file=sys.stderr)
+    exit(1)
+
+def random_fp():
+    return '{:040X}'.format(random.getrandbits(160))
+
+# Remembers every lease it hands out and every pair it takes back from one
+class RecordingCoordinator(Coordinator):
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        # (lease id, worker, pairs)
+        self.leased = []
+        # pair -> how many times it was taken back from a lease
+        self.requeued = {}
+        self.requeued_leases = set()
+
+    def lease(self, worker, num):
+        lease = super().lease(worker, num)
+        if lease:
+            with self._lock: self.leased.append( (lease[0], worker, lease[1]) )
+        return lease
+
+    # Called with the lock held
+    def _requeue(self, lease_id):
+        self.requeued_leases.add(lease_id)
+        for pair in self._leases[lease_id]['pairs']:
+            self.requeued[pair] = self.requeued.get(pair, 0) + 1
+        super()._requeue(lease_id)
+
+# Every leg each worker measured and the RTTs it measured for it
+measured_legs = {}
+measured_legs_lock = Lock()
+
+def run_worker(args, worker_args, name, caches):
+    rtt_cache = RttCache(4, cache_lifetimes(worker_args))
+    caches[name] = rtt_cache
+    client = CoordinatorClient(worker_args, log, rtt_cache)
+    try:
+        for fp1, fp2 in client.pairs():
+            time.sleep(random.random() * args.measure_time)
+            for fp in (fp1, fp2):
+                path = [W_RELAY, fp, Z_RELAY]
+                rtt = random.random()
+                rtt_cache.put(path, rtt, worker_args.cache_3hop_life)
+                with measured_legs_lock:
+                    measured_legs.setdefault('-'.join(path), []).append(rtt)
+            client.add_result({ 'time': time.time(), 'rtt': random.random(),
+                'x': { 'fp': fp1 }, 'y': { 'fp': fp2 } })
+    finally:
+        client.stop()
+
+# Lease some pairs and then say nothing until well past the lease time
+def run_silent_worker(args, port):
+    with socket.create_connection( ('127.0.0.1', port) ) as s:
+        f = s.makefile('rwb')
+        send_msg(f, { 'type': 'lease', 'max': args.lease_pairs })
+        reply = recv_msg(f)
+        if reply['type'] != 'lease':
+            fail_hard('The silent worker got no lease:', reply)
+        time.sleep(args.lease_time * 3)
+    return reply['lease']
+
+def check(cond, *msg):
+    if cond: print('ok  ', *msg)
+    else:
+        print('FAIL', *msg)
+        check.failed = True
+check.failed = False
+
+def main(args):
+    tmpdir = tempfile.mkdtemp(prefix='check-coordinator-')
+    try: run(args, tmpdir)
+    finally: shutil.rmtree(tmpdir)
+    if check.failed: fail_hard('Some checks failed')
+
+def run(args, tmpdir):
+    coord_args = Namespace(lease_time=args.lease_time, worker_wait=0.2,
+            write_results_every=10, write_cache_interval=1,
+            out_result_file=os.path.join(tmpdir, 'results.json'),
+            out_cache_file=os.path.join(tmpdir, 'cache.json'),
+            cache_3hop_life=60*60, cache_4hop_life=60*60)
+    pairs = set()
+    while len(pairs) < args.pairs:
+        fp1, fp2 = sorted([random_fp(), random_fp()])
+        pairs.add( (fp1, fp2) )
+    coord = RecordingCoordinator(coord_args, log, sorted(pairs),
+            ResultIndex())
+    server = CoordinatorServer(coord, ('127.0.0.1', 0))
+    port = server.server_address[1]
+    Thread(target=server.serve_forever, name='server', daemon=True).start()
+    silent = {}
+    silent_thread = Thread(target=lambda: silent.update(
+        lease=run_silent_worker(args, port)), name='silent-worker')
+    silent_thread.start()
+    while len(coord.leased) <= 0: time.sleep(0.01)
+    worker_args = Namespace(coordinator='127.0.0.1:{}'.format(port),
+            lease_pairs=args.lease_pairs, coordinator_retry=10,
+            cache_3hop_life=60*60, cache_4hop_life=60*60)
+    caches = {}
+    workers = [ Thread(target=run_worker, args=(args, worker_args,
+        'worker-{}'.format(i), caches), name='worker-{}'.format(i)) \
+        for i in range(args.workers) ]
+    start = time.time()
+    for thr in workers: thr.start()
+    for thr in workers: thr.join()
+    silent_thread.join()
+    server.shutdown()
+    server.server_close()
+    coord.write_results()
+    coord.write_cache()
+    print('Swept',len(pairs),'pairs with',args.workers,'workers in',
+            round(time.time() - start, 2),'secs')
+
+    check(coord.done.is_set(), 'the coordinator says every pair is done')
+    times_leased = {}
+    for _, _, leased in coord.leased:
+        for pair in leased: times_leased[pair] = times_leased.get(pair, 0) + 1
+    check(set(times_leased) == pairs, 'every pair was leased out')
+    check(all([ n == 1 + coord.requeued.get(pair, 0) \
+            for pair, n in times_leased.items() ]),
+            'pairs were only leased out again after their lease ran out')
+    check(silent.get('lease') in coord.requeued_leases,
+            'the silent worker\'s lease expired and was given to others')
+
+    check(coord.num_results == len(pairs) and coord.num_duplicates == 0,
+            'every pair has exactly one result')
+    result_pairs = []
+    with open_file(coord_args.out_result_file, 'rt') as f:
+        for line in f:
+            res = json.loads(line)
+            result_pairs.append(tuple(sorted(
+                [res['x']['fp'], res['y']['fp']])))
+    check(sorted(result_pairs) == sorted(pairs),
+            'the results file has every pair once')
+
+    with open_file(coord_args.out_cache_file, 'rt') as f: cache = json.load(f)
+    check(set(cache) == set(measured_legs),
+            'the cache file has every leg that was measured')
+    check(all([ cache[k]['rtt'] == min(rtts) \
+            for k, rtts in measured_legs.items() if k in cache ]),
+            'every leg in the cache file has its lowest RTT')
+    check(all([ len(c) > args.lease_pairs * 2 for c in caches.values() ]),
+            'every worker heard about legs the others measured')
+
+if __name__=='__main__':
+    parser = ArgumentParser(
+            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--workers', metavar='NUM', type=int,
+            help='Number of workers besides the silent one', default=3)
+    parser.add_argument('--pairs', metavar='NUM', type=int,
+            help='Number of relay pairs to sweep', default=300)
+    parser.add_argument('--lease-pairs', metavar='NUM', type=int,
+            help='How many pairs workers ask for at once', default=5)
+    parser.add_argument('--lease-time', metavar='SECS', type=float,
+            help='How long leases last', default=2)
+    parser.add_argument('--measure-time', metavar='SECS', type=float,
+            help='The longest a worker takes to "measure" a pair',
+            default=0.02)
+    args = parser.parse_args()
+    if args.workers < 2: fail_hard('Need at least 2 --workers')
+    exit(main(args))
@@ -0,0 +1,115 @@
+from threading import BoundedSemaphore, Event, Lock, Thread
+from queue import Empty, Queue
+import time
+
+# Builds circuits for pairs that are about to be given to a worker so that,
+# when a worker finishes sampling its current pair, the circuits for its next
+# pair are already built instead of it waiting up to CircuitBuildTimeout for
+# each one.
+#
+# At most args.prefetch_circs circuits are being built or are built and
+# waiting to be used at any one time. A built circuit that no one has taken
+# after args.prefetch_max_age seconds is closed.
+class CircuitPrefetcher():
+    def __init__(self, args, logger, client):
+        self._args = args
+        self._log = logger
+        # Only used for its controller connection and its cache. It never
+        # measures anything itself.
+        self._client = client
+        self._max_age = args.prefetch_max_age
+        self._wanted = Queue()
+        self._budget = BoundedSemaphore(args.prefetch_circs)
+        self._lock = Lock()
+        # path tuple -> list of (circ_id, built_at)
+        self._ready = {}
+        self._building = set()
+        # How many pairs we've been told about and how many of them have been
+        # given to a worker. There's no point building circuits for a pair a
+        # worker already has.
+        self._num_wanted = 0
+        self._num_dispatched = 0
+        self._is_shutting_down = Event()
+        self._threads = [ Thread(target=self._enter,
+            name='prefetch-{}'.format(i)) \
+            for i in range(args.prefetch_circs) ]
+        for thr in self._threads: thr.start()
+
+    def want_pair(self, fp1, fp2):
+        w, z = self._args.w_relay, self._args.z_relay
+        for path in ([w,fp1,fp2,z], [w,fp1,z], [w,fp2,z]):
+            self._wanted.put( (self._num_wanted, path) )
+        self._num_wanted += 1
+
+    def pair_dispatched(self):
+        self._num_dispatched += 1
+
+    # Returns the ID of a built circuit for path or None if there isn't one
+    def take(self, path):
+        self._close_stale()
+        key = tuple(path)
+        with self._lock:
+            if key not in self._ready: return None
+            circ_id, _ = self._ready[key].pop(0)
+            if len(self._ready[key]) <= 0: del self._ready[key]
+        self._budget.release()
+        circ = self._client._cont.get_circuit(circ_id, default=None)
+        if not circ or circ.status != 'BUILT':
+            self._log.info('Prefetched circ {} is no longer usable'.format(
+                circ_id))
+            if circ: self._client._close_circ(circ_id)
+            return None
+        self._log.debug('Using prefetched circ {}'.format(circ_id))
+        return circ_id
+
+    def stop(self):
+        self._is_shutting_down.set()
+        for thr in self._threads: thr.join()
+        with self._lock:
+            ready = [ c for circs in self._ready.values() for c, _ in circs ]
+            self._ready = {}
+        for circ_id in ready: self._client._close_circ(circ_id)
+
+    def _close_stale(self):
+        now = time.time()
+        stale = []
+        with self._lock:
+            for key in list(self._ready.keys()):
+                circs = self._ready[key]
+                stale.extend([ c for c, t in circs if t + self._max_age < now ])
+                circs = [ (c, t) for c, t in circs if t + self._max_age >= now ]
+                if len(circs) > 0: self._ready[key] = circs
+                else: del self._ready[key]
+        for circ_id in stale:
+            self._log.info('Closing stale prefetched circ {}'.format(circ_id))
+            self._client._close_circ(circ_id)
+            self._budget.release()
+
+    def _should_build(self, path):
+        key = tuple(path)
+        if self._client._get_cached_rtt(path) != None: return False
+        with self._lock:
+            if key in self._ready or key in self._building: return False
+            self._building.add(key)
+        return True
+
+    def _enter(self):
+        while not self._is_shutting_down.is_set():
+            self._close_stale()
+            if not self._budget.acquire(timeout=1): continue
+            try: pair_num, path = self._wanted.get(timeout=1)
+            except Empty:
+                self._budget.release()
+                continue
+            if pair_num < self._num_dispatched or \
+                    not self._should_build(path):
+                self._budget.release()
+                continue
+            circ_id = self._client._build_circ(path)
+            with self._lock:
+                self._building.discard(tuple(path))
+                if circ_id != None:
+                    key = tuple(path)
+                    if key not in self._ready: self._ready[key] = []
+                    self._ready[key].append( (circ_id, time.time()) )
+            if circ_id == None: self._budget.release()
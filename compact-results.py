@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# Compact a results file that has been appended to run after run, keeping
+# only the results per relay pair that are worth keeping.
+#
+# The results are split into shard files by a hash of their pair in one pass,
+# so every result for a pair ends up in the same shard, and the shards are
+# compacted in parallel. Of each pair's successful results, the --history
+# latest or lowest (--keep) are kept. Failed results are only kept for pairs
+# that have never been measured successfully, and then only the latest, so
+# ting2.py still knows it tried them. Statistics about every pair's results
+# can also be written to --stats-file, one JSON object per line.
+#
+# The compacted results replace --out-file (by default the results file
+# itself) all at once, so readers see either the old or the new file. Don't
+# run this while something is still adding to the results file. If the file
+# changes while we work, we give up without replacing it.
+import json
+import math
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from compression import open_file, tmp_name
+from resultindex import ResultIndex
+
+def fail_hard(*msg):
+    if msg: print(*msg, file=sys.stderr)
+    exit(1)
+
+def notice(*msg):
+    print(*msg, file=sys.stderr)
+
+# (time, rtt, fp1, fp2) of a results file line with fp1 < fp2, or None if it
+# isn't a result
+def parse_line(line):
+    if len(line) <= 0 or line[0] == '#': return None
+    match = ResultIndex.RESULT_RE.match(line)
+    if match:
+        at, rtt, fp1, fp2 = match.groups()
+        at, rtt = float(at), None if rtt == 'null' else float(rtt)
+    else:
+        res = json.loads(line)
+        at, rtt, fp1, fp2 = res['time'], res['rtt'], res['x']['fp'], \
+                res['y']['fp']
+    if fp1 > fp2: fp1, fp2 = fp2, fp1
+    return at, rtt, fp1, fp2
+
+def shard_of(fp1, fp2, num_shards):
+    return zlib.crc32((fp1 + fp2).encode('utf-8')) % num_shards
+
+def split_into_shards(args, shard_fnames):
+    shards = [ open(fname, 'wt') for fname in shard_fnames ]
+    num_lines = 0
+    try:
+        for line in open_file(args.result_file, 'rt'):
+            line = line.strip()
+            parsed = parse_line(line)
+            if parsed == None: continue
+            _, _, fp1, fp2 = parsed
+            shards[shard_of(fp1, fp2, len(shards))].write(line + '\n')
+            num_lines += 1
+    finally:
+        for f in shards: f.close()
+    return num_lines
+
+def pair_stats(fp1, fp2, results):
+    rtts = sorted([ rtt for _, rtt, _ in results if rtt != None ])
+    stats = { 'x': fp1, 'y': fp2, 'results': len(results),
+            'failures': len(results) - len(rtts),
+            'first': min([ at for at, _, _ in results ]),
+            'last': max([ at for at, _, _ in results ]) }
+    if len(rtts) > 0:
+        mean = sum(rtts) / len(rtts)
+        stats.update({ 'min': rtts[0], 'max': rtts[-1], 'mean': mean,
+            'median': rtts[len(rtts)//2],
+            'stdev': math.sqrt(sum([ (rtt - mean)**2 for rtt in rtts ]) / \
+                    len(rtts)) })
+    return stats
+
+# The results of one pair to keep, in the order they were measured
+def keep_results(args, results):
+    succeeded = [ r for r in results if r[1] != None ]
+    if len(succeeded) <= 0: return [ max(results, key=lambda r: r[0]) ]
+    if args.keep == 'best': succeeded.sort(key=lambda r: (r[1], -r[0]))
+    else: succeeded.sort(key=lambda r: r[0], reverse=True)
+    return sorted(succeeded[0:args.history], key=lambda r: r[0])
+
+# Compact one shard file in place, writing the stats of its pairs next to it
+# if asked to. Returns how many pairs and results it ended up with.
+def compact_shard(args, fname):
+    pairs = {}
+    for line in open(fname, 'rt'):
+        line = line.strip()
+        at, rtt, fp1, fp2 = parse_line(line)
+        key = (fp1, fp2)
+        if key not in pairs: pairs[key] = []
+        pairs[key].append( (at, rtt, line) )
+    num_kept = 0
+    with open(fname + '.out', 'wt') as out_file:
+        for results in pairs.values():
+            for _, _, line in keep_results(args, results):
+                out_file.write(line + '\n')
+                num_kept += 1
+    if args.stats_file:
+        with open(fname + '.stats', 'wt') as stats_file:
+            for (fp1, fp2), results in pairs.items():
+                stats_file.write('{}\n'.format(json.dumps(
+                    pair_stats(fp1, fp2, results))))
+    os.remove(fname)
+    return len(pairs), num_kept
+
+# Concatenate the given files into fname, replacing it all at once
+def write_atomically(fname, part_fnames):
+    tmp_fname = tmp_name(fname)
+    with open_file(tmp_fname, 'wt') as out_file:
+        for part_fname in part_fnames:
+            with open(part_fname, 'rt') as f: shutil.copyfileobj(f, out_file)
+    os.replace(tmp_fname, fname)
+
+def file_version(fname):
+    st = os.stat(fname)
+    return st.st_size, st.st_mtime
+
+def main(args):
+    start = time.time()
+    version = file_version(args.result_file)
+    tmpdir = tempfile.mkdtemp(dir=args.tmpdir, prefix='compact-results-')
+    try:
+        shard_fnames = [ os.path.join(tmpdir, 'shard-{:04d}'.format(i)) \
+                for i in range(args.shards) ]
+        num_in = split_into_shards(args, shard_fnames)
+        notice('Split',num_in,'results into',args.shards,'shards in',
+                round(time.time() - start, 2),'secs')
+        with multiprocessing.Pool(args.procs) as pool:
+            counts = pool.starmap(compact_shard,
+                    [ (args, fname) for fname in shard_fnames ])
+        num_pairs = sum([ c[0] for c in counts ])
+        num_kept = sum([ c[1] for c in counts ])
+        if file_version(args.result_file) != version:
+            fail_hard(args.result_file,'changed while we were compacting it. '
+                    'Leaving it alone')
+        write_atomically(args.out_file,
+                [ fname + '.out' for fname in shard_fnames ])
+        if args.stats_file:
+            write_atomically(args.stats_file,
+                    [ fname + '.stats' for fname in shard_fnames ])
+    finally:
+        shutil.rmtree(tmpdir)
+    notice('Kept',num_kept,'of',num_in,'results for',num_pairs,'pairs in',
+            args.out_file,'after',round(time.time() - start, 2),'secs')
+
+if __name__=='__main__':
+    parser = ArgumentParser(
+            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--result-file', metavar='FNAME', type=str,
+            help='Results file to compact. It may be compressed if its name '
+            'ends with .xz, .gz, or .zst', default='data/results.json')
+    parser.add_argument('--out-file', metavar='FNAME', type=str,
+            help='Where to write the compacted results. Not given means '
+            'replacing --result-file')
+    parser.add_argument('--keep', choices=['latest', 'best'],
+            default='latest', help='Keep the most recent or the lowest RTT '
+            'successful results of each pair')
+    parser.add_argument('--history', metavar='NUM', type=int,
+            help='How many successful results to keep per pair', default=1)
+    parser.add_argument('--stats-file', metavar='FNAME', type=str,
+            help='Also write the number of results, failures, and RTT min, '
+            'median, mean, max, and standard deviation of every pair to '
+            'this file')
+    parser.add_argument('--shards', metavar='NUM', type=int,
+            help='Number of shards to split the results into. Each shard\'s '
+            'pairs are held in memory while it is compacted', default=64)
+    parser.add_argument('--procs', metavar='NUM', type=int,
+            help='Number of shards to compact at once',
+            default=multiprocessing.cpu_count())
+    parser.add_argument('--tmpdir', metavar='DIR', type=str,
+            help='Where to keep the shards while compacting',
+            default=tempfile.gettempdir())
+    args = parser.parse_args()
+    if not os.path.isfile(args.result_file):
+        fail_hard(args.result_file,'does not exist')
+    if args.history < 1: fail_hard('--history must be at least 1')
+    if not args.out_file: args.out_file = args.result_file
+    exit(main(args))
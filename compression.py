@@ -0,0 +1,42 @@
+import gzip
+import lzma
+import os
+try: import zstandard # Only needed for .zst files
+except ImportError: zstandard = None
+
+# Relay pair, results, and cache files can be compressed by giving them one
+# of these extensions. Everything is streamed through the compressor, so
+# nothing needs a whole file in memory. Appending to a compressed file adds
+# another compressed member after the ones already there, and reading it
+# back reads every member in turn as if it were one stream.
+def _open_zst(fname, mode, **kwargs):
+    if zstandard == None:
+        raise ImportError('The zstandard module is needed to use '
+            '{}'.format(fname))
+    return zstandard.open(fname, mode, **kwargs)
+
+OPENERS = {
+    '.gz': gzip.open,
+    '.xz': lzma.open,
+    '.zst': _open_zst,
+}
+
+# The compression extension of fname, or '' if it isn't compressed
+def compression_ext(fname):
+    _, ext = os.path.splitext(fname)
+    return ext if ext in OPENERS else ''
+
+# Like open(), but compressing or decompressing if fname has one of the
+# extensions above. Text modes (the default) use UTF-8.
+def open_file(fname, mode='rt'):
+    ext = compression_ext(fname)
+    if ext == '': return open(fname, mode)
+    if 'b' not in mode and 't' not in mode: mode += 't'
+    if 't' in mode: return OPENERS[ext](fname, mode, encoding='utf-8')
+    return OPENERS[ext](fname, mode)
+
+# A temporary file name next to fname that is compressed the same way, for
+# writing to and then renaming over fname
+def tmp_name(fname):
+    ext = compression_ext(fname)
+    return fname[0:len(fname)-len(ext)] + '.tmp' + ext
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# Serve the relay pairs in a directory of relaylist files to ting2.py workers
+# on any number of hosts, each started with
+#
+#   ./ting2.py --relay-source coordinator --coordinator HOST:PORT ...
+#
+# and collect their results and leg cache entries into one results file and
+# one cache file. Pairs that already have a recent enough result are skipped,
+# so this can be stopped and started again without losing much.
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+import os
+import sys
+import time
+from compression import open_file
+from coordinator import Coordinator, CoordinatorServer
+from pastlylogger import PastlyLogger
+from resultindex import ResultIndex
+from threading import Thread
+
+log = PastlyLogger(notice='/dev/stdout', overwrite=['notice'])
+
+def seconds_to_duration(secs):
+    m, s = divmod(secs, 60)
+    h, m = divmod(m, 60)
+    d, h = divmod(h, 24)
+    d, h, m, s = int(d), int(h), int(m), int(round(s,0))
+    if d > 0: return '{}d{}h{}m{}s'.format(d,h,m,s)
+    elif h > 0: return '{}h{}m{}s'.format(h,m,s)
+    elif m > 0: return '{}m{}s'.format(m,s)
+    else: return '{}s'.format(s)
+
+def get_relaylist_files(args):
+    return [ os.path.join(args.relaylist_dir, fname) \
+            for fname in sorted(os.listdir(args.relaylist_dir)) \
+            if not fname.endswith('.done') ]
+
+# Every pair in the relaylist files that doesn't have a successful result
+# newer than args.result_life
+def read_pairs(args, relaylist_files, result_index):
+    num_fresh = 0
+    for fname in relaylist_files:
+        for line in open_file(fname, 'rt'):
+            line = line.strip()
+            if len(line) <= 0 or line[0] == '#': continue
+            fp1, fp2 = line.split(' ')
+            if fp1 > fp2: fp1, fp2 = fp2, fp1
+            if result_index.is_fresh(fp1, fp2, args.result_life):
+                num_fresh += 1
+                continue
+            yield fp1, fp2
+    log.notice('Read every relaylist file. Skipped',num_fresh,'pairs with '
+            'recent results')
+
+def main(args):
+    log.notice('Called as:',*sys.argv)
+    relaylist_files = get_relaylist_files(args)
+    result_index = ResultIndex().load(args.out_result_file)
+    log.notice('Have results for',len(result_index),'pairs already')
+    coord = Coordinator(args, log,
+            read_pairs(args, relaylist_files, result_index), result_index)
+    server = CoordinatorServer(coord, (args.listen_host, args.listen_port))
+    server_thread = Thread(target=server.serve_forever, name='server')
+    server_thread.start()
+    log.notice('Serving pairs from',len(relaylist_files),'relaylist files on',
+            '{}:{}'.format(args.listen_host, args.listen_port))
+    start = time.time()
+    try:
+        while not coord.done.wait(args.stats_interval):
+            coord.write_results()
+            log.notice('Have',coord.num_results,'results after',
+                    seconds_to_duration(time.time() - start),'from',
+                    len(coord.workers),'workers.',coord.num_leased(),
+                    'pairs are leased out,',coord.num_skipped,'were skipped '
+                    'by workers, and',coord.num_duplicates,'duplicate '
+                    'results were dropped')
+        log.notice('Every pair is done. Telling workers to stop')
+        # Give the workers a chance to hear they are done instead of finding
+        # us gone
+        deadline = time.time() + args.linger
+        while len(coord.workers) > 0 and time.time() < deadline:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        log.notice('Stopping early')
+    finally:
+        server.shutdown()
+        server.server_close()
+        server_thread.join()
+        coord.write_results()
+        coord.write_cache()
+    log.notice('Collected',coord.num_results,'results in',
+            seconds_to_duration(time.time() - start))
+
+if __name__=='__main__':
+    parser = ArgumentParser(
+            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--relaylist-dir', metavar='DIR', type=str,
+            help='Directory containing a bunch of relaylist files to serve '
+            'the pairs in', required=True)
+    parser.add_argument('--listen-host', metavar='HOST', type=str,
+            help='Address on which to listen for workers', default='0.0.0.0')
+    parser.add_argument('--listen-port', metavar='PORT', type=int,
+            help='Port on which to listen for workers', default=16668)
+    parser.add_argument('--lease-time', metavar='SECS', type=float,
+            help='Give a worker\'s pairs to someone else if we haven\'t '
+            'heard from it in this long', default=60*10)
+    parser.add_argument('--worker-wait', metavar='SECS', type=float,
+            help='When every pair left is leased out, how long to tell '
+            'workers asking for more to wait before asking again', default=10)
+    parser.add_argument('--linger', metavar='SECS', type=float,
+            help='Once every pair is done, how long to wait for workers to '
+            'find out and disconnect', default=30)
+    parser.add_argument('--out-cache-file', metavar='FNAME',
+            help='Name of file to store cached data in',
+            type=str, default='data/cache.json')
+    parser.add_argument('--out-result-file', metavar='FNAME',
+            help='Name of file to which to write results. It and '
+            '--out-cache-file are compressed if their names end with .xz, '
+            '.gz, or .zst', type=str, default='data/results.json')
+    parser.add_argument('--write-results-every', metavar='NUM', type=int,
+            help='Write results to file every time we collect NUM results',
+            default=100)
+    parser.add_argument('--cache-3hop-life', metavar='SECS', type=int,
+            help='How long to consider 3hop cached results fresh when '
+            'deciding which of two to keep. Should match the workers\'',
+            default=60*60*24*1)
+    parser.add_argument('--cache-4hop-life', metavar='SECS', type=int,
+            help='How long to consider 4hop cached results fresh when '
+            'deciding which of two to keep. Should match the workers\'',
+            default=60*60*24*1)
+    parser.add_argument('--write-cache-interval', metavar='SECS',
+            type=float, help='Write the cache file at most this often',
+            default=60)
+    parser.add_argument('--result-life', metavar='SECS', type=int,
+            help='Skip a pair if the results file has a successful result '
+            'for it that is newer than this', default=60*60*24*100)
+    parser.add_argument('--stats-interval', metavar='SECS', type=float,
+            help='Log information about our progress every SECS seconds at '
+            'level "notice"', default=60)
+    args = parser.parse_args()
+    assert os.path.exists(args.relaylist_dir) and \
+            os.path.isdir(args.relaylist_dir)
+    exit(main(args))
@@ -0,0 +1,443 @@
+from collections import deque
+from threading import Event, Lock, Thread
+import heapq
+import json
+import os
+import socket
+import socketserver
+import time
+from compression import open_file, tmp_name
+from rttcache import cache_lifetimes, is_better_entry
+
+# The coordinator and its workers talk over TCP, one JSON object per line.
+# Every message a worker sends gets exactly one reply.
+#
+#   {'type': 'lease', 'max': N}
+#       -> {'type': 'lease', 'lease': ID, 'pairs': [[fp1, fp2], ...],
+#           'lease_time': SECS, 'cache': {...}}
+#       -> {'type': 'wait', 'secs': SECS, 'cache': {...}}
+#       -> {'type': 'done'}
+#   {'type': 'result', 'lease': ID, 'result': {...}, 'cache': {...}}
+#       -> {'type': 'ok', 'cache': {...}}
+#   {'type': 'renew'}
+#       -> {'type': 'ok', 'cache': {...}}
+#   {'type': 'release', 'pairs': [[fp1, fp2], ...], 'retry_in': SECS}
+#       -> {'type': 'ok', 'cache': {...}}
+#
+# A worker releases leased pairs it won't measure, such as those with a relay
+# it knows is down. They are leased out again once retry_in seconds have
+# passed, or never if retry_in is null.
+#
+# 'cache' holds the leg cache entries that changed since the other side last
+# heard about them, keyed like the cache file. Whichever side gets an entry
+# keeps it if rttcache.is_better_entry() says it beats the one it already
+# has, the same rule dispatch-ting-procs.py merges caches by.
+def send_msg(f, msg):
+    f.write('{}\n'.format(json.dumps(msg)).encode('utf-8'))
+    f.flush()
+
+def recv_msg(f):
+    line = f.readline()
+    if not line: return None
+    return json.loads(line.decode('utf-8'))
+
+# lifetimes is as from rttcache.cache_lifetimes()
+def merge_cache_entry(cache_dict, key, entry, lifetimes, now=None):
+    old = cache_dict.get(key)
+    if old != None and not is_better_entry(entry['rtt'], entry['time'],
+            old['rtt'], old['time'], lifetimes.get(len(entry['path'])), now):
+        return False
+    cache_dict[key] = entry
+    return True
+
+# Hands out relay pairs to workers in leases of a few pairs at a time. A lease
+# lasts args.lease_time seconds and is renewed every time the worker holding
+# it says anything. The pairs left in a lease that runs out, or that belongs
+# to a worker whose connection closed, are given to the next worker to ask.
+#
+# A result is kept if its pair is still leased out or waiting to be leased
+# out again, no matter which lease it came with, so a worker that was only
+# slow doesn't have its work thrown away. A second result for the same pair
+# is dropped.
+class Coordinator():
+    def __init__(self, args, logger, pairs, result_index):
+        self._args = args
+        self._log = logger
+        self._pairs = iter(pairs)
+        self._result_index = result_index
+        self._lock = Lock()
+        self._requeued = deque()
+        self._requeued_set = set()
+        # (when, pair) of released pairs to lease out again later. They are
+        # in _requeued_set until then.
+        self._delayed = []
+        # lease id -> { 'pairs': set, 'expires': time, 'worker': name }
+        self._leases = {}
+        # pair -> id of the lease it's in
+        self._outstanding = {}
+        self._next_lease_id = 0
+        self._no_more_pairs = False
+        self._cache_dict = {}
+        # Keys of cache entries in the order they last changed, so each worker
+        # can be sent only what changed since it last asked. Changes every
+        # worker has been sent are dropped from the front, and
+        # _cache_log_start is how many have been.
+        self._cache_log = []
+        self._cache_log_start = 0
+        # worker -> how many changes it has been sent
+        self._cache_seen = {}
+        self._cache_written_at = time.time()
+        # Results not written to file yet. Each write to a compressed file
+        # is a separate compressed member, so we don't write one at a time.
+        self._pending_results = []
+        self.workers = set()
+        self.num_results = 0
+        self.num_duplicates = 0
+        self.num_skipped = 0
+        self.done = Event()
+        self._load_cache()
+
+    def _load_cache(self):
+        fname = self._args.out_cache_file
+        if not os.path.isfile(fname): return
+        with open_file(fname, 'rt') as f: self._cache_dict = json.load(f)
+        self._log.notice('Loaded',len(self._cache_dict),'cached items')
+
+    def write_cache(self):
+        with self._lock:
+            self._cache_written_at = time.time()
+            cache = dict(self._cache_dict)
+        fname = self._args.out_cache_file
+        tmp_fname = tmp_name(fname)
+        with open_file(tmp_fname, 'wt') as f: json.dump(cache, f)
+        os.replace(tmp_fname, fname)
+        self._log.info('Wrote',len(cache),'cached items to',fname)
+
+    def num_leased(self):
+        with self._lock: return len(self._outstanding)
+
+    # Returns the lease id and its pairs, None if there is nothing to lease
+    # right now, or False if everything is done
+    def lease(self, worker, num):
+        now = time.time()
+        with self._lock:
+            self._reclaim_expired(now)
+            while len(self._delayed) > 0 and self._delayed[0][0] <= now:
+                self._requeued.append(heapq.heappop(self._delayed)[1])
+            pairs = []
+            while len(pairs) < num and len(self._requeued) > 0:
+                pair = self._requeued.popleft()
+                if pair not in self._requeued_set: continue
+                self._requeued_set.remove(pair)
+                pairs.append(pair)
+            while len(pairs) < num and not self._no_more_pairs:
+                try: pair = next(self._pairs)
+                except StopIteration: self._no_more_pairs = True
+                else:
+                    if pair not in self._outstanding: pairs.append(pair)
+            if len(pairs) <= 0:
+                if self._no_more_pairs and len(self._leases) <= 0 and \
+                        len(self._requeued_set) <= 0:
+                    self.done.set()
+                    return False
+                return None
+            lease_id = self._next_lease_id
+            self._next_lease_id += 1
+            self._leases[lease_id] = { 'pairs': set(pairs), 'worker': worker,
+                    'expires': now + self._args.lease_time }
+            for pair in pairs: self._outstanding[pair] = lease_id
+        self._log.info('Leased',len(pairs),'pairs to',worker,'as lease',
+                lease_id)
+        return lease_id, pairs
+
+    def renew(self, worker):
+        expires = time.time() + self._args.lease_time
+        with self._lock:
+            for lease in self._leases.values():
+                if lease['worker'] == worker: lease['expires'] = expires
+
+    # Take back the given pairs leased to worker. They are leased out again
+    # after retry_in seconds, or dropped if it's None.
+    def release(self, worker, pairs, retry_in=None):
+        ready_at = time.time() + retry_in if retry_in != None else None
+        with self._lock:
+            for pair in pairs:
+                pair = tuple(sorted(pair))
+                lease_id = self._outstanding.get(pair)
+                if lease_id == None or \
+                        self._leases[lease_id]['worker'] != worker:
+                    continue
+                self._take_from_lease(pair)
+                if ready_at == None:
+                    self.num_skipped += 1
+                    continue
+                heapq.heappush(self._delayed, (ready_at, pair))
+                self._requeued_set.add(pair)
+
+    def _take_from_lease(self, pair):
+        lease_id = self._outstanding.pop(pair)
+        lease = self._leases[lease_id]
+        lease['pairs'].discard(pair)
+        if len(lease['pairs']) <= 0: del self._leases[lease_id]
+
+    def add_result(self, worker, result):
+        pair = (result['x']['fp'], result['y']['fp'])
+        if pair[0] > pair[1]: pair = pair[1], pair[0]
+        with self._lock:
+            if pair in self._outstanding: self._take_from_lease(pair)
+            elif pair in self._requeued_set:
+                self._requeued_set.remove(pair)
+            else:
+                self.num_duplicates += 1
+                return False
+            self.num_results += 1
+            self._result_index.add_result(result)
+            self._pending_results.append(result)
+            write = len(self._pending_results) >= \
+                    self._args.write_results_every
+        if write: self.write_results()
+        return True
+
+    def write_results(self):
+        with self._lock:
+            results, self._pending_results = self._pending_results, []
+            if len(results) <= 0: return
+            with open_file(self._args.out_result_file, 'at') as f:
+                f.write(''.join([ '{}\n'.format(json.dumps(r)) \
+                        for r in results ]))
+
+    # Give back every pair leased to worker. Called once it has disconnected.
+    def worker_gone(self, worker):
+        with self._lock:
+            self.workers.discard(worker)
+            self._cache_seen.pop(worker, None)
+            self._trim_cache_log()
+            gone = [ lease_id for lease_id, lease in self._leases.items() \
+                    if lease['worker'] == worker ]
+            for lease_id in gone: self._requeue(lease_id)
+        if len(gone) > 0:
+            self._log.notice(worker,'went away. Giving its',len(gone),
+                    'leases to someone else')
+
+    def _reclaim_expired(self, now):
+        expired = [ lease_id for lease_id, lease in self._leases.items() \
+                if lease['expires'] < now ]
+        for lease_id in expired:
+            self._log.warn('Lease',lease_id,'held by',
+                    self._leases[lease_id]['worker'],'expired')
+            self._requeue(lease_id)
+
+    def _requeue(self, lease_id):
+        for pair in self._leases.pop(lease_id)['pairs']:
+            del self._outstanding[pair]
+            self._requeued.append(pair)
+            self._requeued_set.add(pair)
+
+    def add_cache_entries(self, entries):
+        lifetimes = cache_lifetimes(self._args)
+        now = time.time()
+        with self._lock:
+            for key, entry in entries.items():
+                if merge_cache_entry(self._cache_dict, key, entry, lifetimes,
+                        now):
+                    self._cache_log.append(key)
+            write = self._cache_written_at + \
+                    self._args.write_cache_interval <= time.time()
+        if write: self.write_cache()
+
+    # The cache entries that changed since worker was last sent any. A worker
+    # that hasn't been sent any gets all of them.
+    def cache_entries_for(self, worker):
+        with self._lock:
+            end = self._cache_log_start + len(self._cache_log)
+            seen = self._cache_seen.get(worker)
+            self._cache_seen[worker] = end
+            if seen == None: entries = dict(self._cache_dict)
+            else:
+                keys = set(self._cache_log[seen - self._cache_log_start:])
+                entries = { k: self._cache_dict[k] for k in keys }
+            self._trim_cache_log()
+            return entries
+
+    def _trim_cache_log(self):
+        if len(self._cache_seen) <= 0: seen = len(self._cache_log)
+        else: seen = min(self._cache_seen.values()) - self._cache_log_start
+        if seen <= 0: return
+        del self._cache_log[0:seen]
+        self._cache_log_start += seen
+
+class CoordinatorRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        coord = self.server.coordinator
+        worker = '{}:{}'.format(*self.client_address[0:2])
+        with coord._lock: coord.workers.add(worker)
+        coord._log.notice('Worker',worker,'connected')
+        try:
+            while True:
+                msg = recv_msg(self.rfile)
+                if msg == None: break
+                coord.renew(worker)
+                if 'cache' in msg: coord.add_cache_entries(msg['cache'])
+                if msg['type'] == 'result':
+                    coord.add_result(worker, msg['result'])
+                    reply = { 'type': 'ok' }
+                elif msg['type'] == 'renew':
+                    reply = { 'type': 'ok' }
+                elif msg['type'] == 'release':
+                    coord.release(worker, msg['pairs'], msg.get('retry_in'))
+                    reply = { 'type': 'ok' }
+                elif msg['type'] == 'lease':
+                    lease = coord.lease(worker, msg['max'])
+                    if lease == False: reply = { 'type': 'done' }
+                    elif lease == None:
+                        reply = { 'type': 'wait',
+                                'secs': coord._args.worker_wait }
+                    else:
+                        reply = { 'type': 'lease', 'lease': lease[0],
+                                'pairs': lease[1],
+                                'lease_time': coord._args.lease_time }
+                else:
+                    coord._log.warn('Ignoring unknown message from',worker,
+                            msg)
+                    reply = { 'type': 'error' }
+                if reply['type'] != 'done':
+                    reply['cache'] = coord.cache_entries_for(worker)
+                send_msg(self.wfile, reply)
+        except (OSError, ValueError) as e:
+            coord._log.warn('Lost worker',worker,':',e)
+        finally:
+            coord.worker_gone(worker)
+
+class CoordinatorServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, coordinator, address):
+        self.coordinator = coordinator
+        super().__init__(address, CoordinatorRequestHandler)
+
+# The worker's end. Gets pairs from the coordinator, sends results back as
+# soon as each one is made, and keeps this worker's leg cache in sync with the
+# coordinator's. rtt_cache is the RttCache the TingClients share.
+#
+# If the connection is lost we keep trying to reconnect for
+# args.coordinator_retry seconds. Our leases will have been given to someone
+# else by then, but results for them are still welcome.
+class CoordinatorClient():
+    def __init__(self, args, logger, rtt_cache):
+        self._args = args
+        self._log = logger
+        self._rtt_cache = rtt_cache.track_changes()
+        host, port = args.coordinator.rsplit(':', 1)
+        self._address = (host, int(port))
+        self._conn_lock = Lock()
+        self._sock = None
+        self._file = None
+        # pair -> id of the lease it came in
+        self._pair_lease = {}
+        self._lease_time = None
+        # key -> time of the cache entries we got from the coordinator and
+        # haven't seen come back out of rtt_cache.changes() yet. There's no
+        # need to send them back to it.
+        self._cache_received = {}
+        self._is_shutting_down = Event()
+        self._heartbeat_thread = Thread(target=self._heartbeat,
+                name='heartbeat')
+        self._heartbeat_thread.start()
+
+    def stop(self):
+        self._is_shutting_down.set()
+        self._heartbeat_thread.join()
+        with self._conn_lock: self._close()
+
+    # Yield pairs from the coordinator until it says there are no more
+    def pairs(self):
+        while True:
+            reply = self._request({ 'type': 'lease',
+                'max': self._args.lease_pairs })
+            if reply == None or reply['type'] == 'done': return
+            if reply['type'] == 'wait':
+                time.sleep(reply['secs'])
+                continue
+            self._lease_time = reply['lease_time']
+            self._log.info('Got lease',reply['lease'],'of',
+                    len(reply['pairs']),'pairs')
+            for fp1, fp2 in reply['pairs']:
+                self._pair_lease[(fp1, fp2)] = reply['lease']
+                yield fp1, fp2
+
+    # Give back pairs we won't measure. The coordinator leases them out again
+    # after retry_in seconds, or never if it's None.
+    def release(self, pairs, retry_in=None):
+        for pair in pairs:
+            self._pair_lease.pop(tuple(sorted(pair)), None)
+        self._request({ 'type': 'release',
+            'pairs': [ list(pair) for pair in pairs ], 'retry_in': retry_in })
+
+    def add_result(self, result):
+        pair = (result['x']['fp'], result['y']['fp'])
+        if pair[0] > pair[1]: pair = pair[1], pair[0]
+        lease_id = self._pair_lease.pop(pair, None)
+        self._request({ 'type': 'result', 'lease': lease_id,
+            'result': result })
+
+    def _heartbeat(self):
+        while not self._is_shutting_down.wait(
+                (self._lease_time or self._args.coordinator_retry) / 3):
+            if self._sock: self._request({ 'type': 'renew' })
+
+    def _connect(self):
+        deadline = time.time() + self._args.coordinator_retry
+        while not self._is_shutting_down.is_set():
+            try:
+                self._sock = socket.create_connection(self._address)
+            except OSError as e:
+                if time.time() >= deadline:
+                    self._log.error('Giving up on the coordinator at',
+                            self._args.coordinator,':',e)
+                    return False
+                self._log.warn('Couldn\'t connect to the coordinator at',
+                        self._args.coordinator,':',e)
+                time.sleep(5)
+            else:
+                self._file = self._sock.makefile('rwb')
+                self._log.notice('Connected to the coordinator at',
+                        self._args.coordinator)
+                return True
+        return False
+
+    def _close(self):
+        if self._file: self._file.close()
+        if self._sock: self._sock.close()
+        self._file, self._sock = None, None
+
+    def _new_cache_entries(self):
+        return { k: v for k, v in self._rtt_cache.changes().items() \
+                if self._cache_received.pop(k, None) != v['time'] }
+
+    # Entries are marked as received before they're merged so that a request
+    # made in between doesn't send them right back
+    def _merge_cache_entries(self, entries):
+        for key, entry in entries.items():
+            self._cache_received[key] = entry['time']
+            if not self._rtt_cache.merge(entry['path'], entry['rtt'],
+                    entry['time'], entry.get('hist')):
+                self._cache_received.pop(key, None)
+
+    # Send msg and return the reply, reconnecting and sending it again if we
+    # have to. None if we gave up on the coordinator.
+    def _request(self, msg):
+        with self._conn_lock:
+            msg['cache'] = self._new_cache_entries()
+            while True:
+                if not self._sock and not self._connect(): return None
+                try:
+                    send_msg(self._file, msg)
+                    reply = recv_msg(self._file)
+                except (OSError, ValueError) as e:
+                    self._log.warn('Lost the coordinator:',e)
+                    reply = None
+                if reply != None: break
+                self._close()
+        if 'cache' in reply: self._merge_cache_entries(reply['cache'])
+        return reply
@@ -7,7 +7,13 @@ import tempfile
 import subprocess
 import time
 import json
+from collections import deque
+from compression import open_file
 from pastlylogger import PastlyLogger
+from rttcache import cache_lifetimes, is_better_entry
+from torsupervisor import read_instances_file
+from pairscheduler import PairScheduler
+from resultindex import ResultIndex
 
 log = PastlyLogger(debug='/dev/stdout', overwrite=['debug'])
 log = PastlyLogger(notice='/dev/stdout', overwrite=['notice'])
@@ -49,9 +55,9 @@ def seconds_to_duration(secs):
     elif m > 0: return '{}m{}s'.format(m,s)
     else: return '{}s'.format(s)
 
-def make_ting_dirs(args):
+def make_ting_dirs(args, first, num):
     ting_dirs = [ '{}/ting-proc-{}'.format(args.tmpdir,i) \
-            for i in range(0,len(args.socks_port)) ]
+            for i in range(first,first+num) ]
     for d in ting_dirs:
         if os.path.exists(d):
             if not query_yes_no('{} exists. Okay to delete?'.format(d), 'no'):
@@ -64,6 +70,16 @@ def make_ting_dirs(args):
         for f in files: shutil.copy2(f, ting_dir)
     return ting_dirs
 
+# Add a ting proc, with its own ting dir, for each of the given (socks port,
+# ctrl port) that doesn't have one yet
+def add_ting_procs(args, ting_procs, ports):
+    have = set([ (tp.socks_port, tp.ctrl_port) for tp in ting_procs ])
+    new = [ p for p in ports if p not in have ]
+    if len(new) <= 0: return
+    ting_dirs = make_ting_dirs(args, len(ting_procs), len(new))
+    for (socks_port, ctrl_port), ting_dir in zip(new, ting_dirs):
+        ting_procs.append(TingProc(ctrl_port, socks_port, ting_dir))
+
 def get_relaylist_files(args):
     relaylist_files = []
     all_files = os.listdir(args.relaylist_dir)
@@ -85,6 +101,15 @@ class TingProc:
             self.proc = None
             self.cleaned_up = False
             self.relay_pairs_fname = None
+            self.pending_pairs_fname = None
+            # How this proc's tor instance has been doing, smoothed over the
+            # relaylist files it has finished. None until we know.
+            self.throughput = None # pairs per second
+            self.build_latency = None # seconds per successful circ build
+            self.failure_rate = None # fraction of circ builds that failed
+            self.started_at = None
+            self.expected_duration = None
+            self.drained_at = None
     def is_running(self):
         if not self.proc: return False
         if self.proc.poll() == None: return True
@@ -93,88 +118,300 @@ class TingProc:
         assert self.proc != None
         self.proc.wait()
 
-def combine_caches(*cache_files):
+# Entries are kept by rttcache.is_better_entry(), like the coordinator and
+# ting2.py do
+def combine_caches(args, *cache_files):
     cache = {}
     in_items, out_items = 0, 0
+    lifetimes = cache_lifetimes(args)
+    now = time.time()
     for fname in cache_files:
         if not os.path.exists(fname): continue
-        tmp = json.load(open(fname, 'rt'))
+        with open_file(fname, 'rt') as f: tmp = json.load(f)
         in_items += len(tmp)
-        for k in tmp:
-            if k not in cache: cache[k] = tmp[k]
-            elif tmp[k]['rtt'] < cache[k]['rtt']: cache[k] = tmp[k]
+        for k, entry in tmp.items():
+            old = cache.get(k)
+            if old == None or is_better_entry(entry['rtt'], entry['time'],
+                    old['rtt'], old['time'],
+                    lifetimes.get(len(entry['path'])), now):
+                cache[k] = entry
     out_items = len(cache)
-    for fname in cache_files: json.dump(cache, open(fname,'wt'))
+    for fname in cache_files:
+        with open_file(fname, 'wt') as f: json.dump(cache, f)
     log.info('Deduped',in_items,'cache items down to',out_items)
 
-def combine_results(main_fname, sub_fname):
+def combine_results(main_fname, sub_fname, result_index=None):
     if not os.path.exists(sub_fname): return
-    with open(main_fname, 'at') as out_file:
-        for line in open(sub_fname, 'rt'):
+    with open_file(main_fname, 'at') as out_file:
+        for line in open_file(sub_fname, 'rt'):
             line = line.strip()
             if len(line) <= 0: continue
             if line[0] == '#': continue
             out_file.write('{}\n'.format(line))
+            if result_index != None: result_index.add_line(line)
+
+# The (socks port, ctrl port) of every tor instance we may use right now, or
+# None if we weren't given an instances file and should just use all of them
+def get_live_tor_ports(args):
+    if not args.tor_instances_file: return None
+    return set(read_instances_file(args.tor_instances_file))
+
+def is_live(tp, live_ports):
+    return live_ports is None or (tp.socks_port, tp.ctrl_port) in live_ports
+
+# How much a relaylist file's stats count towards a proc's smoothed stats
+STATS_ALPHA = 0.5
+def smooth(old, new):
+    if old == None: return new
+    return STATS_ALPHA*new + (1-STATS_ALPHA)*old
+
+# Copy the pairs in a relaylist file that don't have a result newer than
+# --result-life in the global results file to a temporary file for a ting
+# proc to read. Returns the temporary file's name and how many pairs are in
+# it. The ting proc could only check its own results, which are moved into
+# the global results file as soon as it's done. If given a scheduler, the
+# pairs are written most urgent first, which means holding one file's pairs
+# in memory.
+def write_pending_pairs(args, fname, result_index, scheduler=None):
+    now = time.time()
+    num_pairs, num_fresh = 0, 0
+    fd, pending_fname = tempfile.mkstemp(dir=args.tmpdir,
+            prefix='ting-pending-')
+    pairs = read_pairs(fname)
+    if scheduler: pairs = scheduler.order(pairs)
+    with os.fdopen(fd, 'wt') as out_file:
+        for fp1, fp2 in pairs:
+            if result_index.is_fresh(fp1, fp2, args.result_life, now):
+                num_fresh += 1
+                continue
+            out_file.write('{} {}\n'.format(fp1, fp2))
+            num_pairs += 1
+    if num_fresh > 0:
+        log.notice('Skipping',num_fresh,'pairs in',fname,'with recent '
+                'results.',num_pairs,'pairs are left')
+    return pending_fname, num_pairs
+
+def read_pairs(fname):
+    for line in open_file(fname, 'rt'):
+        line = line.strip()
+        if len(line) <= 0 or line[0] == '#': continue
+        fp1, fp2 = line.split(' ')
+        yield fp1, fp2
+
+# The relaylist files with the most urgent pairs on average first. Files with
+# equally urgent pairs keep their order.
+def order_relaylist_files(relaylist_files, scheduler):
+    priorities = { fname: scheduler.mean_priority(read_pairs(fname)) \
+            for fname in relaylist_files }
+    return sorted(relaylist_files, key=lambda fname: priorities[fname],
+            reverse=True)
+
+def update_ting_proc_stats(args, tp):
+    stats_fname = os.path.join(tp.cwd,'data','stats.json')
+    if not os.path.exists(stats_fname):
+        # It didn't get far enough to write stats, so count it as if every
+        # circuit it tried to build failed
+        if tp.proc.returncode != 0:
+            tp.failure_rate = smooth(tp.failure_rate, 1.0)
+        return
+    with open(stats_fname, 'rt') as f: stats = json.load(f)
+    os.remove(stats_fname)
+    if stats['duration'] > 0 and stats['pairs'] > 0:
+        tp.throughput = smooth(tp.throughput,
+                stats['pairs'] / stats['duration'])
+    if stats['circ_builds'] > 0:
+        tp.failure_rate = smooth(tp.failure_rate,
+                stats['circ_build_failures'] / stats['circ_builds'])
+    num_built = stats['circ_builds'] - stats['circ_build_failures']
+    if num_built > 0:
+        tp.build_latency = smooth(tp.build_latency,
+                stats['circ_build_time'] / num_built)
+    log.notice('Tor on',tp.ctrl_port,'now has a throughput of',
+            tp.throughput,'pairs/sec, a circ build latency of',
+            tp.build_latency,'secs, and a circ build failure rate of',
+            tp.failure_rate)
 
-def cleanup_after_ting_proc(args, tp):
+# What we assume a proc's throughput is before it has finished anything. We're
+# optimistic so that every proc gets tried.
+def default_throughput(ting_procs):
+    known = [ tp.throughput for tp in ting_procs if tp.throughput ]
+    if len(known) <= 0: return 1.0
+    return max(known)
+
+# When we'd expect tp to be done with a file of num_pairs if we gave it the
+# file now, or as soon as it's done with the file it has. If it's already
+# taking longer than expected on its current file, assume it'll keep going
+# for as long again as it has been overdue.
+def expected_completion(tp, num_pairs, now, def_throughput):
+    busy_for = 0
+    if tp.is_running():
+        busy_for = abs(tp.started_at + tp.expected_duration - now)
+    return busy_for + num_pairs / (tp.throughput or def_throughput)
+
+# Stop giving work to procs whose tor instance fails to build too many
+# circuits or is much slower than the typical one. After a while, give a
+# drained proc another chance so its stats can get better.
+def update_drained(args, ting_procs, now):
+    known = sorted([ tp.throughput for tp in ting_procs if tp.throughput ])
+    median = known[len(known)//2] if len(known) > 0 else None
+    for tp in ting_procs:
+        if tp.drained_at != None:
+            if tp.drained_at + args.drain_probation <= now and \
+                    not tp.is_running():
+                log.notice('Giving tor on',tp.ctrl_port,'another chance')
+                tp.drained_at = None
+                tp.failure_rate = None
+                tp.throughput = None
+            continue
+        too_many_failures = tp.failure_rate != None and \
+                tp.failure_rate > args.drain_failure_rate
+        too_slow = tp.throughput != None and median != None and \
+                tp.throughput < median * args.drain_throughput_ratio
+        if too_many_failures or too_slow:
+            log.warn('Draining tor on',tp.ctrl_port,'because it has a '
+                    'throughput of',tp.throughput,'pairs/sec (median is',
+                    median,') and a circ build failure rate of',
+                    tp.failure_rate)
+            tp.drained_at = now
+
+# Number of times we've given each relay list file to a ting proc
+file_attempts = {}
+def cleanup_after_ting_proc(args, tp, todo, result_index):
     if tp.proc == None: return
     if tp.cleaned_up: return
     tp.cleaned_up = True
     global_cache = args.out_cache_file
     tp_cache = os.path.join(tp.cwd,'data','cache.json')
-    combine_caches(global_cache,tp_cache)
+    combine_caches(args, global_cache, tp_cache)
     global_results = args.out_result_file
     tp_results = os.path.join(tp.cwd,'data','results.json')
-    combine_results(global_results, tp_results)
+    combine_results(global_results, tp_results, result_index)
     if os.path.exists(tp_results):
         os.remove(tp_results)
-    open(tp.relay_pairs_fname+'.done', 'at') # touch
+    if os.path.exists(tp.pending_pairs_fname):
+        os.remove(tp.pending_pairs_fname)
+    update_ting_proc_stats(args, tp)
+    rl = tp.relay_pairs_fname
+    if tp.proc.returncode != 0:
+        if file_attempts[rl] < args.max_file_attempts:
+            log.warn('ting proc using tor on',tp.ctrl_port,'failed on',rl,
+                    'so it will be tried again')
+            todo.append(rl)
+            return
+        log.warn('Giving up on',rl,'after',file_attempts[rl],'attempts')
+    open(rl+'.done', 'at') # touch
 
-def get_next_ting_proc(args, ting_procs):
+# Returns the proc that we expect to finish a file with num_pairs soonest,
+# waiting for it to be done with its current file if it's running. A fast
+# tor instance that's about to be free is better than a slow one that's
+# free now.
+def get_next_ting_proc(args, ting_procs, todo, result_index, num_pairs):
     while True:
+        live_ports = get_live_tor_ports(args)
+        if live_ports is not None:
+            num_procs = len(ting_procs)
+            add_ting_procs(args, ting_procs, sorted(live_ports))
+            if len(ting_procs) > num_procs:
+                log.notice('Will also use',len(ting_procs) - num_procs,
+                        'tor instances that are new in',
+                        args.tor_instances_file)
         for tp in ting_procs:
             if not tp.is_running():
-                cleanup_after_ting_proc(args, tp)
-                return tp
+                cleanup_after_ting_proc(args, tp, todo, result_index)
+        now = time.time()
+        update_drained(args, ting_procs, now)
+        candidates = [ tp for tp in ting_procs if is_live(tp, live_ports) ]
+        undrained = [ tp for tp in candidates if tp.drained_at == None ]
+        if len(undrained) > 0: candidates = undrained
+        if len(candidates) > 0:
+            def_throughput = default_throughput(ting_procs)
+            best = min(candidates, key=lambda tp: expected_completion(
+                tp, num_pairs, now, def_throughput))
+            if not best.is_running(): return best
         time.sleep(1)
 
 def main(args):
     log.notice('Called as:',*sys.argv)
-    ting_dirs = make_ting_dirs(args)
+    if args.tor_instances_file:
+        ports = read_instances_file(args.tor_instances_file)
+    else: ports = list(zip(args.socks_port, args.ctrl_port))
     relaylist_files = get_relaylist_files(args)
-    ting_procs = [ TingProc(args.ctrl_port[i], args.socks_port[i],
-        ting_dirs[i]) for i in range(0, len(args.socks_port)) ]
+    ting_procs = []
+    add_ting_procs(args, ting_procs, ports)
     log.notice('Will use',len(ting_procs),'ting procs to process',
             len(relaylist_files),'realylist files')
+    result_index = ResultIndex().load(args.out_result_file)
+    log.notice('Have results for',len(result_index),'pairs already')
+    scheduler = None
+    if args.schedule == 'staleness':
+        scheduler = PairScheduler(result_index, args.schedule_relay_weight)
+        relaylist_files = order_relaylist_files(relaylist_files, scheduler)
+        log.notice('Ordered relaylist files by how stale their pairs\' '
+                'results are')
+    todo = deque(relaylist_files)
     start = time.time()
     last_stat_at = start
-    for i, rl in enumerate(relaylist_files):
-        tp = get_next_ting_proc(args, ting_procs)
+    num_started = 0
+    while True:
+        # Reap procs before deciding we're done, since a failed one gives its
+        # file back. Any that were running before reaping are waited for.
+        running = any([ tp.is_running() for tp in ting_procs ])
+        for tp in ting_procs:
+            if not tp.is_running():
+                cleanup_after_ting_proc(args, tp, todo, result_index)
+        if len(todo) <= 0:
+            if not running: break
+            # Nothing left to start, but a running proc might still fail and
+            # give us its file back
+            time.sleep(1)
+            continue
+        rl = todo.popleft()
+        pending_fname, num_pairs = write_pending_pairs(args, rl, result_index,
+                scheduler)
+        if num_pairs <= 0:
+            log.notice('Every pair in',rl,'has a recent result')
+            os.remove(pending_fname)
+            open(rl+'.done', 'at') # touch
+            continue
+        tp = get_next_ting_proc(args, ting_procs, todo, result_index,
+                num_pairs)
+        file_attempts[rl] = file_attempts.get(rl, 0) + 1
+        num_started += 1
         tp.cleaned_up = False
         tp.relay_pairs_fname = rl
+        tp.pending_pairs_fname = pending_fname
+        tp.started_at = time.time()
+        tp.expected_duration = num_pairs / \
+                (tp.throughput or default_throughput(ting_procs))
         tp.proc = subprocess.Popen(
             './ting2.py --ctrl-port {} --socks-port {} '\
             '--w-relay {} --z-relay {} --samples {} '\
             '--target-host {} --target-port {} '\
             '--threads {} --relay-source stdin --cache-3hop '\
+            '--cache-3hop-life {} --cache-4hop-life {} '\
+            '--relay-health-file {} --relay-fail-threshold {} {} {} {}'\
             .format(tp.ctrl_port, tp.socks_port,
             args.w_relay, args.z_relay, args.samples,
             args.target_host, args.target_port,
-            args.threads).strip().split(' '),
-            stdin=open(rl, 'rt'), cwd=tp.cwd)
+            args.threads, args.cache_3hop_life, args.cache_4hop_life,
+            args.relay_health_file, args.relay_fail_threshold,
+            '--adaptive-timeouts' if args.adaptive_timeouts else '',
+            '--rtt-histograms' if args.rtt_histograms else '',
+            '--admission-dir {}'.format(args.admission_dir) \
+                    if args.admission_dir else '')\
+            .split(),
+            stdin=open(pending_fname, 'rt'), cwd=tp.cwd)
         now = time.time()
         if last_stat_at + args.stats_interval <= now:
+            i = max(1, len(relaylist_files) - len(todo))
             dur = seconds_to_duration(now - start)
             rem = ((now - start) * len(relaylist_files) / i) - (now - start)
             rem = seconds_to_duration(rem)
             log.notice('We are on item {}/{} ({}% done)'.format(i,
                 len(relaylist_files), round(i*100.0/len(relaylist_files),1)),
-                'It has taken',dur,'and we expect to be done in',rem)
+                'It has taken',dur,'and we expect to be done in',rem,
+                '({} ting procs started)'.format(num_started))
             last_stat_at = now
-    for tp in ting_procs:
-        if tp.is_running():
-            tp.wait()
-        cleanup_after_ting_proc(args, tp)
 
 if __name__=='__main__':
     parser = ArgumentParser(
@@ -184,17 +421,28 @@ if __name__=='__main__':
             default='/tmp')
     parser.add_argument('--relaylist-dir', metavar='DIR', type=str,
             help='Directory containing a bunch of relaylist files. We will '
-            'feed them to ting processes one at a time.',
+            'feed them to ting processes one at a time. They may be '
+            'compressed with xz, gzip, or zstd if their names end with .xz, '
+            '.gz, or .zst',
             required=True)
     parser.add_argument('--socks-port', metavar='PORT', type=int,
             help='Add a port to the list of socks ports. The number of socks '
             'ports determines the number of ting2.py processes to run.',
-            required=True, action='append')
+            action='append')
     parser.add_argument('--ctrl-port', metavar='PORT', type=int,
             help='Add a port to the list of control ports. They correspond '
             'to the socks ports in the order they are specified. The number '
             'of ctrl and socks ports must be equal.',
-            required=True, action='append')
+            action='append')
+    parser.add_argument('--tor-instances-file', metavar='FNAME', type=str,
+            help='Instead of --socks-port and --ctrl-port, use the tor '
+            'instances listed in this file by supervise-tors.py. It is '
+            'checked again before every ting process is started. Tor '
+            'instances that are not listed are not given work, and those '
+            'that show up later are')
+    parser.add_argument('--max-file-attempts', metavar='NUM', type=int,
+            help='How many times to give a relaylist file to a ting process '
+            'if the ting process fails', default=3)
     parser.add_argument('--threads', metavar='NUM', type=int,
             help='Number of threads a ting process should run in parallel',
             default=16)
@@ -205,6 +453,9 @@ if __name__=='__main__':
     parser.add_argument('--samples', metavar='NUM', type=int,
             help='How many "tings" to send over a completed circuit and take '
             'the min() of and call the RTT', default=200)
+    parser.add_argument('--rtt-histograms', action='store_true',
+            help='Have ting procs keep a histogram of every circuit\'s '
+            'samples in the cache and results files. See rtt-hists.py')
     parser.add_argument('--target-host', metavar='HOST', type=str,
             help='Host/IP that the echo server is running', required=True)
     parser.add_argument('--target-port', metavar='PORT', type=int,
@@ -212,14 +463,71 @@ if __name__=='__main__':
     parser.add_argument('--out-cache-file', metavar='FNAME',
             help='Name of file to store cached data in',
             type=str, default='data/cache.json')
+    parser.add_argument('--cache-3hop-life', metavar='SECS', type=int,
+            help='How long ting processes consider 3hop cached results '
+            'fresh. Also used when merging their caches into ours',
+            default=60*60*24*1)
+    parser.add_argument('--cache-4hop-life', metavar='SECS', type=int,
+            help='How long ting processes consider 4hop cached results '
+            'fresh. Also used when merging their caches into ours',
+            default=60*60*24*1)
     parser.add_argument('--out-result-file', metavar='FNAME',
-            help='Name of file to which to write results',
-            type=str, default='data/results.json')
+            help='Name of file to which to write results. It and '
+            '--out-cache-file are compressed if their names end with .xz, '
+            '.gz, or .zst', type=str, default='data/results.json')
+    parser.add_argument('--drain-failure-rate', metavar='FRAC', type=float,
+            help='Stop giving work to a tor instance if more than this '
+            'fraction of its circuit builds fail', default=0.5)
+    parser.add_argument('--drain-throughput-ratio', metavar='FRAC',
+            type=float, help='Stop giving work to a tor instance if it '
+            'measures pairs at less than this fraction of the median tor '
+            'instance\'s rate', default=0.25)
+    parser.add_argument('--drain-probation', metavar='SECS', type=float,
+            help='How long to wait before giving a drained tor instance '
+            'work again', default=60*30)
+    parser.add_argument('--adaptive-timeouts', action='store_true',
+            help='Have ting processes adapt their circuit build and socket '
+            'connect timeouts to how long they have recently taken')
+    parser.add_argument('--relay-fail-threshold', metavar='NUM', type=int,
+            help='Have ting processes consider a relay down after failing to '
+            'build circuits through it NUM times in a row and stop measuring '
+            'pairs with it for a while. 0 disables this', default=0)
+    parser.add_argument('--relay-health-file', metavar='FNAME', type=str,
+            help='File in which all ting processes share which relays are '
+            'down', default='data/relay-health.json')
+    parser.add_argument('--admission-dir', metavar='DIR', type=str,
+            help='Directory in which all ting processes share limits on how '
+            'many circuit builds and ting streams may be in flight at once '
+            'so that W isn\'t overloaded. Not given means no limits')
+    parser.add_argument('--schedule', choices=['staleness', 'file'],
+            help='Measure relaylist files, and the pairs in each, with no or '
+            'the oldest results first, or in the order they are in',
+            default='staleness')
+    parser.add_argument('--schedule-relay-weight', metavar='NUM', type=float,
+            help='With --schedule staleness, how much sooner to measure '
+            'pairs with relays that have few results. 0 means only result '
+            'age matters', default=1.0)
+    parser.add_argument('--result-life', metavar='SECS', type=int,
+            help='Don\'t give a pair to a ting process if the results file '
+            'has a successful result for it that is newer than this',
+            default=60*60*24*100)
     parser.add_argument('--stats-interval', metavar='SECS', type=float,
             help='Log information about our progress every SECS seconds at '
             'level "notice"', default=60)
     args = parser.parse_args()
-    assert len(args.ctrl_port) == len(args.socks_port)
+    if args.tor_instances_file:
+        if args.socks_port or args.ctrl_port:
+            fail_hard('Give either --tor-instances-file or ports, not both')
+        # Instances that aren't ready yet are picked up once they're listed
+        if not os.path.isfile(args.tor_instances_file):
+            fail_hard(args.tor_instances_file,'does not exist. Is '
+                    'supervise-tors.py running?')
+    elif not args.socks_port or not args.ctrl_port:
+        fail_hard('Need --socks-port and --ctrl-port or --tor-instances-file')
+    else: assert len(args.ctrl_port) == len(args.socks_port)
+    args.relay_health_file = os.path.abspath(args.relay_health_file)
+    if args.admission_dir:
+        args.admission_dir = os.path.abspath(args.admission_dir)
     assert len(args.w_relay) == 40
     assert len(args.z_relay) == 40
     assert os.path.exists(args.relaylist_dir) and \
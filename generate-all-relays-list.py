@@ -1,42 +1,100 @@
 #!/usr/bin/env python3
-from configparser import ConfigParser
+# Generate every pair of relays in the current consensus, optionally only
+# those with certain flags or measured status, in relay-blocked order (see
+# pairgen.py). Pairs are streamed to stdout, a file, or a number of shard
+# files for dispatch-ting-procs.py, without holding them all in memory.
+import os
+import sys
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 from stem.control import Controller
 from stem import SocketError
-import ipaddress
-conf = ConfigParser()
-conf.read('config.ini')
+from compression import OPENERS, open_file
+from pairgen import blocked_tiles, num_pairs_in_tile, tile_lines
 
-def fail_hard(msg):
-    print(msg)
+def fail_hard(*msg):
+    if msg: print(*msg, file=sys.stderr)
     exit(1)
 
-def notice(*args):
-    #print(*args)
-    pass
+def notice(*msg):
+    print(*msg, file=sys.stderr)
 
-fail_hard('Need to update this script to use args instead of a config file. '
-        'Or just hardcore the ctrl port as needed.')
+def get_controller(ctrl_port):
+    cont = None
+    try:
+        cont = Controller.from_port(port=ctrl_port)
+    except SocketError:
+        fail_hard('SocketError: Couldn\'t connect to Tor control port {}'\
+            .format(ctrl_port))
+    if not cont:
+        fail_hard('Couldn\'t connect to Tor control port {}'.format(ctrl_port))
+    if not cont.is_authenticated(): cont.authenticate()
+    if not cont.is_authenticated():
+        fail_hard('Couldn\'t authenticate to Tor control port {}'\
+            .format(ctrl_port))
+    return cont
 
-ctrl_port = conf.getint('torclient','ctrl_port')
-cont = None
-try:
-    cont = Controller.from_port(port=ctrl_port)
-except SocketError:
-    fail_hard('SocketError: Couldn\'t connect to Tor control port {}'.format(
-        ctrl_port))
-if not cont:
-    fail_hard('Couldn\'t connect to Tor control port {}'.format(ctrl_port))
-if not cont.is_authenticated(): cont.authenticate()
-if not cont.is_authenticated():
-    fail_hard('Couldn\'t authenticate to Tor control port {}'.format(ctrl_port))
+def get_relays(args):
+    cont = get_controller(args.ctrl_port)
+    relays = [ r for r in cont.get_network_statuses() ]
+    notice('There are currently',len(relays),'relays in the entire Tor network')
+    if args.flag:
+        relays = [ r for r in relays if set(args.flag) <= set(r.flags) ]
+    if args.measured == 'measured':
+        relays = [ r for r in relays if not r.is_unmeasured ]
+    elif args.measured == 'unmeasured':
+        relays = [ r for r in relays if r.is_unmeasured ]
+    notice(len(relays),'relays are left after filtering')
+    return [ r.fingerprint for r in relays ]
 
-relays = [ r for r in cont.get_network_statuses() ]
-notice('There are currently',len(relays),'relays in the entire Tor network')
+def open_outputs(args):
+    if not args.outdir:
+        if args.outfile == '-': return [ sys.stdout ]
+        return [ open_file(args.outfile, 'wt') ]
+    ext = '' if args.compress == 'none' else '.' + args.compress
+    os.makedirs(args.outdir, exist_ok=True)
+    return [ open_file(os.path.join(args.outdir,
+            'shard-{:04d}.txt{}'.format(i, ext)), 'wt') \
+            for i in range(args.shards) ]
 
-#####
-# Just do all relays
-#####
-all_relays = [ r.fingerprint for r in relays ]
-all_relays.sort()
-for i in range(0, len(all_relays)):
-    [ print(all_relays[i], relay_j) for relay_j in all_relays[i+1:] ]
+def main(args):
+    relays = get_relays(args)
+    outputs = open_outputs(args)
+    # Each tile goes to whichever output has the fewest pairs so far so that
+    # whole tiles, and thus their relays, stay together in one shard
+    counts = [ 0 ] * len(outputs)
+    for block_a, block_b in blocked_tiles(relays, args.block_size):
+        i = counts.index(min(counts))
+        outputs[i].write(tile_lines(block_a, block_b))
+        counts[i] += num_pairs_in_tile(block_a, block_b)
+    for out in outputs:
+        if out is not sys.stdout: out.close()
+    notice('Wrote',sum(counts),'pairs to',len(outputs),'output(s)')
+
+if __name__=='__main__':
+    parser = ArgumentParser(
+            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--ctrl-port', metavar='PORT', type=int,
+            help='Port on which to control the tor client', default=9051)
+    parser.add_argument('--outfile', metavar='FNAME', type=str,
+            help='Where to write relay pairs. - means stdout. Compressed if '
+            'it ends with .xz, .gz, or .zst. Ignored if --outdir is given',
+            default='-')
+    parser.add_argument('--outdir', metavar='DIR', type=str,
+            help='If given, split relay pairs into --shards files in DIR')
+    parser.add_argument('--shards', metavar='NUM', type=int,
+            help='Number of shard files to write into --outdir', default=6)
+    parser.add_argument('--compress',
+            choices=['none'] + [ ext[1:] for ext in OPENERS ],
+            help='How to compress shard files', default='none')
+    parser.add_argument('--block-size', metavar='NUM', type=int,
+            help='Number of relays per block. All pairs between two blocks '
+            'are written together', default=64)
+    parser.add_argument('--flag', metavar='FLAG', type=str, action='append',
+            help='Only use relays with this flag (e.g. Fast). Can be given '
+            'multiple times, in which case relays need all the flags')
+    parser.add_argument('--measured', choices=['any','measured','unmeasured'],
+            help='Only use relays with this measured status', default='any')
+    args = parser.parse_args()
+    if args.shards < 1: fail_hard('Need at least one shard')
+    if args.block_size < 1: fail_hard('Need at least one relay per block')
+    exit(main(args))
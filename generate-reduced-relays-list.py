@@ -5,14 +5,20 @@
 # Generate a list of relay pairs for ting using only the representative relays
 import time
 import json
+import os
 import random
-import subprocess
-import os, shutil, os.path
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, FileType
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Queue
 from statistics import mean
+from threading import Lock
 # in virtualenv
 # mine
 from pastlylogger import PastlyLogger
+from resultsmanager import ResultsManager
+from rttcache import RttCache
+from tingclient import TingClient
 
 log = PastlyLogger(info='/dev/stdout', overwrite=['info'])
 def fail_hard(*msg):
@@ -29,33 +35,32 @@ def seconds_to_duration(secs):
     elif m > 0: return '{}m{}s'.format(m,s)
     else: return '{}s'.format(s)
 
-def query_yes_no(question, default="yes"):
-    valid = {"yes": True, "y": True, "ye": True, "no": False, "n": False}
-    if default is None: prompt = " [y/n] "
-    elif default == "yes": prompt = " [Y/n] "
-    elif default == "no": prompt = " [y/N] "
-    else: raise ValueError("invalid default answer: '%s'" % default)
-    while True:
-        print(question + prompt, end='')
-        choice = input().lower()
-        if default is not None and choice == '': return valid[default]
-        elif choice in valid: return valid[choice]
-        else: print("Please respond with 'yes' or 'no' "
-            "(or 'y' or 'n').")
+# One tor instance and the TingClient we use to measure through it. The
+# client, its results manager, and their controller connections are reused
+# for every group this worker is given.
+class TingWorker:
+    def __init__(self, args, ctrl_port, socks_port, name):
+        self.ctrl_port = ctrl_port
+        self.socks_port = socks_port
+        self.name = name
+        self.args = make_ting_args(args, ctrl_port, socks_port)
+        self.results_manager = ResultsManager(self.args, log)
+        self.client = TingClient(self.args, log, Lock(), RttCache(),
+                self.results_manager)
 
-class TingProc:
-    def __init__(self, ctrl_port, socks_port, cwd):
-            self.ctrl_port = ctrl_port
-            self.socks_port = socks_port
-            self.cwd = cwd
-            self.proc = None
-    def is_running(self):
-        if not self.proc: return False
-        if self.proc.poll() == None: return True
-        return False
-    def wait(self):
-        assert self.proc != None
-        self.proc.wait()
+# The options ting2.py would have parsed for itself. There's no result file,
+# so results only come back in memory, and 3 hop legs are cached in memory
+# for the life of the worker so relays shared between attempts are only
+# measured once.
+def make_ting_args(args, ctrl_port, socks_port):
+    return Namespace(ctrl_port=ctrl_port, socks_host='127.0.0.1',
+            socks_port=socks_port, socks_timeout=10, circ_build_timeout=10,
+            w_relay=args.w_relay, z_relay=args.z_relay,
+            target_host=args.target_host, target_port=args.target_port,
+            samples=args.samples, circ_build_attempts=3,
+            measurement_attempts=3, cache_3hop=True, cache_3hop_life=60*60,
+            cache_4hop=False, cache_4hop_life=0, out_result_file=None,
+            write_results_every=10, rtt_histograms=False)
 
 def trim_too_small_groups(groups, size):
     log.notice('For groups smaller than',size,'we will just use all the '
@@ -68,47 +73,42 @@ def trim_too_small_groups(groups, size):
         else: new_groups[g] = group
     return relays_to_use, new_groups
 
-def create_ting_datadir(datadir):
-    if os.path.exists(datadir):
-        assert os.path.isdir(datadir)
-        shutil.rmtree(datadir)
-    fnames = ['ting2.py', 'pastlylogger.py', 'tingclient.py','relaylist.py']
-    os.mkdir(datadir)
-    os.mkdir(os.path.join(datadir, 'results'))
-    for fname in fnames: shutil.copy2(fname, datadir)
+# Keeps every result measured between relays in a group, keyed on the sorted
+# relay pair, so a later attempt or a more relaxed RTT threshold can reuse
+# them instead of measuring them again.
+class GroupResultStore:
+    def __init__(self):
+        self._results = {}
 
-def ting_within_group(group, args, sample_size, attempt_num='?'):
-    ting = TingProc(args.ctrl, args.socks, args.datadir)
-    sample = random.sample(group, sample_size)
-    sample = [ r['fp'] for r in sample ]
-    log.notice('(',attempt_num,'/',args.attempts,') Group of size',
-            len(group),'trying reps:',', '.join([ s[0:8] for s in sample]))
+    def __len__(self):
+        return len(self._results)
+
+    def add(self, results):
+        for res in results:
+            xy = ( res['x']['fp'], res['y']['fp'] )
+            if xy[0] > xy[1]: xy = xy[1], xy[0]
+            self._results[xy] = res
+
+    def missing_pairs(self, pairs):
+        return [ pair for pair in pairs if pair not in self._results ]
+
+    # Only successful results. Failed measurements (rtt of None) are kept in
+    # the store so they aren't retried, but they can't be used to pick a relay
+    def results_for(self, pairs):
+        return [ self._results[pair] for pair in pairs \
+                if pair in self._results and \
+                self._results[pair]['rtt'] is not None ]
+
+def pairs_in_sample(sample):
     pairs = set()
-    input_data = ''
     for i, fp1 in enumerate(sample):
         for fp2 in sample[i+1:]:
             if fp1 > fp2: pairs.add( (fp2, fp1) )
             else: pairs.add( (fp1, fp2) )
-    for pair in pairs: input_data += '{} {}\n'.format(*pair)
-    #print(input_data)
-    ting.proc = subprocess.Popen(
-            './ting2.py --ctrl-port {} --socks-port {} --w-relay {} '\
-                '--z-relay {} --target-host {} --target-port {} '
-                '--relay-source stdin --samples {}'\
-                .format(ting.ctrl_port, ting.socks_port,
-                args.w_relay, args.z_relay,
-                args.target_host, args.target_port, args.samples).split(' '),
-            stdin=subprocess.PIPE,
-            cwd=ting.cwd)
-    ting.proc.communicate(bytes(input_data, 'utf-8'))
-    ting.wait()
-    results_fname = os.path.join(ting.cwd,'results','results.json')
-    if not os.path.exists(results_fname): return []
-    assert os.path.isfile(results_fname)
-    results = []
-    for line in open(results_fname, 'rt'):
-        results.append(json.loads(line))
-    return results
+    return pairs
+
+def ting_within_group(pairs, args, ting):
+    return ting.client.perform_on_pairs(pairs)
 
 def best_relay_from_results(results, required_len, max_allowed_rtt):
     relays = {}
@@ -148,17 +148,31 @@ def best_relay_from_results(results, required_len, max_allowed_rtt):
             [ round(1000*rtt,2) for rtt in relays[best_relay[0]] ])
     return best_relay[0]
 
-def get_representative_relay(group, args):
+def get_representative_relay(group, args, ting):
     relay = None
+    store = GroupResultStore()
+    samples = []
     for max_allowed_rtt in args.max_allowed_rtt:
-        log.notice('Requiring a max mean RTT of',max_allowed_rtt,'ms')
+        log.notice(ting.name,'requiring a max mean RTT of',max_allowed_rtt,
+                'ms')
         for attempt_num in range(args.attempts):
-            create_ting_datadir(args.datadir)
-            sample_size = min(args.max_group_size, len(group))
-            results = ting_within_group(group, args, sample_size,
-                    attempt_num=attempt_num+1)
-            relay_fp = best_relay_from_results(results, sample_size-1,
-                    max_allowed_rtt)
+            # Samples from previous thresholds are evaluated again before we
+            # spend time measuring new ones
+            if attempt_num < len(samples): sample = samples[attempt_num]
+            else:
+                sample_size = min(args.max_group_size, len(group))
+                sample = [ r['fp'] for r in random.sample(group, sample_size) ]
+                samples.append(sample)
+            pairs = pairs_in_sample(sample)
+            missing = store.missing_pairs(pairs)
+            log.notice(ting.name,'(',attempt_num+1,'/',args.attempts,') Group '
+                    'of size',len(group),'trying reps:',
+                    ', '.join([ s[0:8] for s in sample]),'with',len(missing),
+                    'of',len(pairs),'pairs left to measure')
+            if len(missing) > 0:
+                store.add(ting_within_group(missing, args, ting))
+            relay_fp = best_relay_from_results(store.results_for(pairs),
+                    len(sample)-1, max_allowed_rtt)
             if not relay_fp: continue
             for r in group:
                 if r['fp'] == relay_fp:
@@ -173,6 +187,63 @@ def get_representative_relay(group, args):
         return group
     return [relay]
 
+# Take a free ting worker, use it to find the representative relay(s) for the
+# group, and give the ting worker back. Returns the relays and how long it took
+def serve_group(group, group_num, num_groups, args, free_ting_workers):
+    ting = free_ting_workers.get()
+    try:
+        log.notice(ting.name,'now serving group',group_num,'of',num_groups)
+        start = time.time()
+        rtu = get_representative_relay(group, args, ting)
+        return rtu, time.time() - start
+    finally:
+        free_ting_workers.put(ting)
+
+def make_ting_workers(args):
+    ting_workers = []
+    for i, (ctrl, socks) in enumerate(zip(args.ctrl, args.socks)):
+        name = 'worker-{}'.format(i)
+        ting_workers.append(TingWorker(args, ctrl, socks, name))
+    return ting_workers
+
+# The journal has one JSON object per line for every group we've decided on,
+# in the order we decided on them: {"group": ID, "relays": [...]}. It's only
+# ever appended to, so if we're killed part way through, at most the last
+# line is lost (or cut short, in which case we ignore it).
+def read_journal(fname):
+    decided = {}
+    if not os.path.exists(fname): return decided
+    with open(fname, 'rt') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) <= 0: continue
+            try: entry = json.loads(line)
+            except ValueError:
+                log.warn('Ignoring unreadable journal line:',line)
+                continue
+            decided[entry['group']] = entry['relays']
+    return decided
+
+# If we were killed while writing the last line, make sure the next line
+# starts on its own instead of being glued on to the partial one
+def open_journal(fname):
+    journal = open(fname, 'at')
+    if journal.tell() > 0:
+        with open(fname, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n': journal.write('\n')
+    return journal
+
+def append_to_journal(journal, group_id, relays):
+    journal.write('{}\n'.format(json.dumps({
+        'group': group_id, 'relays': relays})))
+    journal.flush()
+
+def export_relays(fname, relays_to_use):
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'wt') as f: json.dump(relays_to_use, f)
+    os.replace(tmp_fname, fname)
+
 def main(args):
     groups = json.load(args.groups)
     relays_to_use = []
@@ -186,27 +257,47 @@ def main(args):
     log.notice('After trimming small groups, there are',len(groups),'remaining '
             'groups.', len(relays_to_use),'relays will have to represent '
             'themselves.')
-    if os.path.exists(args.datadir):
-        if not query_yes_no('{} exists and will be deleted. That ok?'.format(
-            args.datadir)):
-            fail_hard('Then we cannot continue')
-        if os.path.isdir(args.datadir): shutil.rmtree(args.datadir)
-        elif os.path.isfile(args.datadir): os.remove(args.datadir)
-        else: fail_hard('Don\'t know what {} is so cannot delete')
-    total_time = 0
-    for i, g in enumerate(groups):
-        log.notice('Now serving group',i+1,'of',len(groups))
-        group = groups[g]
+    decided = read_journal(args.journal)
+    if len(decided) > 0 and not args.resume and not args.export_only:
+        fail_hard(args.journal,'already has',len(decided),'decided groups. '
+                'Use --resume to continue from it or remove it to start over.')
+    todo = [ g for g in groups if g not in decided ]
+    log.notice(len(groups)-len(todo),'groups were already decided in',
+            args.journal,'and',len(todo),'groups are left')
+    if len(todo) > 0 and not args.export_only:
+        ting_workers = make_ting_workers(args)
+        log.notice('Will use',len(ting_workers),'tor instances to process',
+                len(todo),'groups')
+        free_ting_workers = Queue()
+        for tw in ting_workers: free_ting_workers.put(tw)
         start = time.time()
-        rtu = get_representative_relay(group, args)
-        end = time.time()
-        total_time += end-start
-        log.notice('Group',i+1,'of',len(groups),'took',
-                seconds_to_duration(end-start),'Will be done in ~',
-                seconds_to_duration(total_time/(i+1)*(len(groups)-i-1)))
-        relays_to_use.extend(rtu)
-        if args.outfile.seekable(): args.outfile.seek(0)
-        json.dump(relays_to_use, args.outfile)
+        with ThreadPoolExecutor(max_workers=len(ting_workers)) as pool, \
+                open_journal(args.journal) as journal:
+            futures = {}
+            for i, g in enumerate(todo):
+                fut = pool.submit(serve_group, groups[g], i+1, len(todo),
+                        args, free_ting_workers)
+                futures[fut] = i, g
+            for num_done, fut in enumerate(as_completed(futures)):
+                i, g = futures[fut]
+                rtu, duration = fut.result()
+                decided[g] = rtu
+                append_to_journal(journal, g, rtu)
+                elapsed = time.time() - start
+                log.notice('Group',i+1,'of',len(todo),'took',
+                        seconds_to_duration(duration),'Will be done in ~',
+                        seconds_to_duration(elapsed/(num_done+1)*\
+                        (len(todo)-num_done-1)))
+    # Groups finish in whatever order the ting workers get through them, but
+    # the export is always in the order of the groups file so it's the same
+    # no matter how many tor instances we used or how many times we resumed.
+    for g in groups:
+        if g in decided: relays_to_use.extend(decided[g])
+    export_relays(args.outfile, relays_to_use)
+    num_left = len([ g for g in groups if g not in decided ])
+    if num_left > 0:
+        log.warn(num_left,'groups are still undecided and were left out of',
+                args.outfile)
     log.notice('Ready to ting between the',len(relays_to_use),'representative '
             'relays.')
 
@@ -215,6 +306,7 @@ if __name__=='__main__':
             formatter_class=ArgumentDefaultsHelpFormatter)
     DEF_RELAYS_FILE = 'relay-groups.json'
     DEF_OUTPUT_FILE = 'selected-relays.json'
+    DEF_JOURNAL_FILE = 'selected-relays.journal'
     DEF_NON_GROUP = "-1" # yes ... it has to be a string.
     DEF_MIN_GROUP_SIZE = 3
     DEF_MAX_GROUP_SIZE = 10
@@ -222,15 +314,25 @@ if __name__=='__main__':
     DEF_ATTEMPTS = 3
     DEF_CTRL_PORT = 8720
     DEF_SOCKS_PORT = 8730
-    DEF_DATADIR = os.path.abspath('/tmp/tmpting')
     DEF_SAMPLES = 30
     DEF_TARGET_PORT = 16667
     parser.add_argument('-g','--groups',
             help='Input file with relays split into groups',
             default=DEF_RELAYS_FILE, type=FileType('rt'))
     parser.add_argument('-o','--outfile',
-            help='Output file to put representative relays into',
-            default=DEF_OUTPUT_FILE, type=FileType('wt'))
+            help='Output file to put representative relays into once all '
+            'groups are decided',
+            default=DEF_OUTPUT_FILE, type=str)
+    parser.add_argument('-j','--journal',
+            help='File to which each decided group is appended as soon as it '
+            'is decided',
+            default=DEF_JOURNAL_FILE, type=str)
+    parser.add_argument('--resume', action='store_true',
+            help='Skip the groups already decided in the journal instead of '
+            'refusing to run')
+    parser.add_argument('--export-only', action='store_true',
+            help='Don\'t measure anything. Just write the outfile from the '
+            'groups already decided in the journal')
     parser.add_argument('--non-group',
             help='Group ID for the group of relays without a group',
             default=DEF_NON_GROUP)
@@ -251,12 +353,14 @@ if __name__=='__main__':
             'this, then it will not be a candidate. Can be specified multiple '
             'times. Each RTT will be tried in increasing order.',
             default=DEF_MAX_ALLOWED_RTT, type=float, action='append')
-    parser.add_argument('--ctrl', help='Tor control port',
-        default=DEF_CTRL_PORT, type=int)
-    parser.add_argument('--socks', help='Tor socks port',
-        default=DEF_SOCKS_PORT, type=int)
-    parser.add_argument('--datadir', help='Ting data dir to create',
-            default=DEF_DATADIR, type=str)
+    parser.add_argument('--ctrl', help='Add a Tor control port. Can be '
+            'specified multiple times, once per tor instance. They correspond '
+            'to the socks ports in the order they are specified.',
+            type=int, action='append')
+    parser.add_argument('--socks', help='Add a Tor socks port. Can be '
+            'specified multiple times, once per tor instance. The number of '
+            'socks ports determines how many groups are processed at once.',
+            type=int, action='append')
     parser.add_argument('--samples', help='Ting samples per relay pair',
             default=DEF_SAMPLES, type=int)
     parser.add_argument('--w-relay', help='FP of W relay', type=str,
@@ -266,11 +370,15 @@ if __name__=='__main__':
     parser.add_argument('--target-host', help='Host/IP of the echo server',
             required=True)
     parser.add_argument('--target-port', help='Port of the echo server',
-            default=DEF_TARGET_PORT)
+            default=DEF_TARGET_PORT, type=int)
     args = parser.parse_args()
     if args.max_allowed_rtt != DEF_MAX_ALLOWED_RTT:
         args.max_allowed_rtt = args.max_allowed_rtt[len(DEF_MAX_ALLOWED_RTT):]
     args.max_allowed_rtt.sort()
+    if not args.ctrl: args.ctrl = [DEF_CTRL_PORT]
+    if not args.socks: args.socks = [DEF_SOCKS_PORT]
+    if len(args.ctrl) != len(args.socks):
+        fail_hard('Need the same number of --ctrl and --socks ports')
     if len(args.w_relay) != 40:
         fail_hard('--w-relay doesn\'t look like a fingerprint')
     if len(args.z_relay) != 40:
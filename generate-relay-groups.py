@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# Split the relays in the current consensus into groups for
+# generate-reduced-relays-list.py based on which network prefix (or which AS
+# announcing that prefix) each relay's address falls in.
+#
+# The prefix-to-AS table can be huge, so instead of loading it we put the few
+# thousand relay addresses into a binary radix trie and stream the table
+# through it once. Every node remembers all the relays under it, so a prefix
+# of length L matches after walking at most L bits, and each relay keeps the
+# longest prefix that matched it.
+import ipaddress
+import json
+import os
+import sys
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from compression import open_file, tmp_name
+from stem.control import Controller
+from stem import SocketError
+
+def fail_hard(*msg):
+    if msg: print(*msg, file=sys.stderr)
+    exit(1)
+
+def notice(*msg):
+    print(*msg, file=sys.stderr)
+
+class RelayTrie:
+    def __init__(self, num_bits):
+        self._num_bits = num_bits
+        # [child for a 0 bit, child for a 1 bit, relays in this subtree]
+        self._root = [None, None, []]
+
+    def insert(self, addr_int, relay):
+        node = self._root
+        node[2].append(relay)
+        for shift in range(self._num_bits-1, -1, -1):
+            bit = (addr_int >> shift) & 1
+            if node[bit] is None: node[bit] = [None, None, []]
+            node = node[bit]
+            node[2].append(relay)
+
+    # All relays whose address is in the prefix
+    def relays_in(self, prefix_int, prefix_len):
+        node = self._root
+        for shift in range(self._num_bits-1, self._num_bits-1-prefix_len, -1):
+            node = node[(prefix_int >> shift) & 1]
+            if node is None: return []
+        return node[2]
+
+# Yields (network, AS) for every line in the table. Accepts both CAIDA's
+# routeviews pfx2as format ("1.0.0.0<tab>24<tab>13335") and
+# "1.0.0.0/24 13335". Blank lines and lines starting with # are skipped.
+def read_prefix_table(f):
+    for line in f:
+        line = line.strip()
+        if len(line) <= 0 or line[0] == '#': continue
+        words = line.split()
+        try:
+            if '/' in words[0]:
+                net = ipaddress.ip_network(words[0], strict=False)
+                asn = words[1]
+            else:
+                net = ipaddress.ip_network('{}/{}'.format(*words[0:2]),
+                        strict=False)
+                asn = words[2]
+        except (ValueError, IndexError):
+            notice('Ignoring bad prefix table line:',line)
+            continue
+        yield net, asn
+
+def get_controller(ctrl_port):
+    cont = None
+    try:
+        cont = Controller.from_port(port=ctrl_port)
+    except SocketError:
+        fail_hard('SocketError: Couldn\'t connect to Tor control port {}'\
+            .format(ctrl_port))
+    if not cont:
+        fail_hard('Couldn\'t connect to Tor control port {}'.format(ctrl_port))
+    if not cont.is_authenticated(): cont.authenticate()
+    if not cont.is_authenticated():
+        fail_hard('Couldn\'t authenticate to Tor control port {}'\
+            .format(ctrl_port))
+    return cont
+
+def main(args):
+    cont = get_controller(args.ctrl_port)
+    relays = [ { 'fp': r.fingerprint, 'ip': r.address } \
+            for r in cont.get_network_statuses() ]
+    notice('Grouping',len(relays),'relays from the current consensus')
+    tries = { 4: RelayTrie(32), 6: RelayTrie(128) }
+    for relay in relays:
+        addr = ipaddress.ip_address(relay['ip'])
+        tries[addr.version].insert(int(addr), relay)
+    # fp -> (prefix length, group id) of the longest prefix seen so far
+    best = {}
+    num_prefixes = 0
+    with open_file(args.prefix_table, 'rt') as f:
+        for net, asn in read_prefix_table(f):
+            num_prefixes += 1
+            group_id = asn if args.group_by == 'as' else str(net)
+            matches = tries[net.version].relays_in(
+                    int(net.network_address), net.prefixlen)
+            for relay in matches:
+                fp = relay['fp']
+                if fp not in best or best[fp][0] < net.prefixlen:
+                    best[fp] = (net.prefixlen, group_id)
+    notice('Read',num_prefixes,'prefixes from',args.prefix_table)
+    groups = {}
+    for relay in relays:
+        if relay['fp'] in best: group_id = best[relay['fp']][1]
+        else: group_id = args.non_group
+        if group_id not in groups: groups[group_id] = []
+        groups[group_id].append(relay)
+    notice('Put',len(relays),'relays into',len(groups),'groups.',
+            len(groups.get(args.non_group, [])),'relays have no group')
+    # Only replace the old groups once we have all of the new ones
+    tmp_fname = tmp_name(args.outfile)
+    with open_file(tmp_fname, 'wt') as f: json.dump(groups, f)
+    os.replace(tmp_fname, args.outfile)
+
+if __name__=='__main__':
+    parser = ArgumentParser(
+            formatter_class=ArgumentDefaultsHelpFormatter)
+    DEF_OUTPUT_FILE = 'relay-groups.json'
+    DEF_NON_GROUP = "-1" # must match generate-reduced-relays-list.py
+    parser.add_argument('--ctrl-port', metavar='PORT', type=int,
+            help='Port on which to control the tor client', default=9051)
+    parser.add_argument('-p','--prefix-table', metavar='FNAME', type=str,
+            help='File mapping network prefixes to the AS that announces '
+            'them, like CAIDA\'s routeviews pfx2as files. It may be '
+            'compressed if its name ends with .xz, .gz, or .zst',
+            required=True)
+    parser.add_argument('-o','--outfile', metavar='FNAME', type=str,
+            help='Where to write the relay groups', default=DEF_OUTPUT_FILE)
+    parser.add_argument('--group-by', choices=['as','prefix'], default='as',
+            help='Put relays in the same group if they are in the same AS or '
+            'only if they are in the same most specific prefix')
+    parser.add_argument('--non-group',
+            help='Group ID for the group of relays without a group',
+            default=DEF_NON_GROUP)
+    args = parser.parse_args()
+    if not os.path.isfile(args.prefix_table):
+        fail_hard(args.prefix_table,'does not exist')
+    exit(main(args))
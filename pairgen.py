@@ -0,0 +1,79 @@
+# Helpers for generating relay pairs to ting between without holding all the
+# pairs in memory.
+#
+# Pairs are generated in relay-blocked order: relays are sorted and split into
+# blocks, and all pairs between two blocks (a "tile") are generated together.
+# Consecutive pairs then keep reusing the same couple hundred relays, which
+# is what the 3 hop leg cache in a ting process wants, instead of every relay
+# being seen once per pass over the whole network.
+import math
+import random
+
+def make_blocks(relays, block_size):
+    relays = sorted(relays)
+    return [ relays[i:i+block_size] for i in range(0, len(relays), block_size) ]
+
+# Yields (block_a, block_b) for every tile in the order they should be
+# measured. block_a is block_b for tiles on the diagonal.
+def blocked_tiles(relays, block_size):
+    blocks = make_blocks(relays, block_size)
+    for i, block_a in enumerate(blocks):
+        for block_b in blocks[i:]:
+            yield block_a, block_b
+
+def num_pairs_in_tile(block_a, block_b):
+    if block_a is block_b: return len(block_a) * (len(block_a) - 1) // 2
+    return len(block_a) * len(block_b)
+
+# All the pairs in a tile as relay list file lines. Relays were sorted when
+# making blocks, so the first fingerprint on a line is always the smaller.
+def tile_lines(block_a, block_b):
+    chunks = []
+    for i, fp1 in enumerate(block_a):
+        others = block_a[i+1:] if block_a is block_b else block_b
+        if len(others) <= 0: continue
+        prefix = fp1 + ' '
+        chunks.append(prefix + ('\n' + prefix).join(others) + '\n')
+    return ''.join(chunks)
+
+def blocked_pairs(relays, block_size):
+    for block_a, block_b in blocked_tiles(relays, block_size):
+        for i, fp1 in enumerate(block_a):
+            others = block_a[i+1:] if block_a is block_b else block_b
+            for fp2 in others: yield fp1, fp2
+
+# The pairs of n relays, numbered 0 to n(n-1)/2 - 1, are (0,1), (0,2), (1,2),
+# (0,3), (1,3), (2,3), ... so pair r is (i, j) where j is the largest with
+# j(j-1)/2 <= r
+def unrank_pair(r):
+    j = (1 + math.isqrt(1 + 8*r)) // 2
+    return r - j*(j-1)//2, j
+
+# Knuth's selection sampling: num of the numbers 0 to total - 1, in order,
+# each set of them equally likely, in one pass and without remembering any
+def _selection_sample(total, num, rng):
+    for r in range(total):
+        if num <= 0: return
+        if rng.random() * (total - r) < num:
+            yield r
+            num -= 1
+
+# Yields num distinct pairs of relays, or every pair if there are fewer, with
+# every set of num pairs equally likely. Pair numbers are sampled and turned
+# into pairs as they're needed instead of drawing relays until enough
+# different pairs turn up, so asking for most of the pairs costs no more than
+# asking for a few. Relays are sorted first, so the same rng seed always
+# gives the same pairs, and the first fingerprint in a pair is the smaller.
+#
+# When fewer than half the pairs are wanted, their numbers are drawn at
+# random and held in memory. Otherwise every pair number is considered in
+# turn, which takes no memory but yields them in order.
+def sample_pairs(relays, num, rng=random):
+    relays = sorted(relays)
+    total = len(relays) * (len(relays) - 1) // 2
+    num = min(num, total)
+    if num * 2 <= total: numbers = rng.sample(range(total), num)
+    else: numbers = _selection_sample(total, num, rng)
+    for r in numbers:
+        i, j = unrank_pair(r)
+        yield relays[i], relays[j]
@@ -0,0 +1,45 @@
+import time
+
+# Orders relay pairs so that, however far through them we get before being
+# stopped, what we measured is what most needed measuring: pairs that have
+# never been measured first, then the ones whose latest result is oldest.
+#
+# A pair is as urgent as its result is old, and one that has never been
+# measured is treated as if it was measured at the epoch, so it comes before
+# any that has. With relay_weight, a pair's urgency is also scaled up by
+#
+#   1 + relay_weight / (1 + results for its relay with the fewest results)
+#
+# where a relay's results are how many pairs with it have one, so that pairs
+# filling in relays we know little about go before equally old pairs between
+# relays we know plenty about.
+#
+# Pairs that are equally urgent keep the order they were given in, which is
+# usually one that makes good use of the leg cache.
+class PairScheduler():
+    def __init__(self, result_index, relay_weight=0, now=None):
+        self._result_index = result_index
+        self._relay_weight = relay_weight
+        self._now = now if now != None else time.time()
+        self._relay_counts = {}
+        if relay_weight > 0: self._relay_counts = result_index.relay_counts()
+
+    def priority(self, fp1, fp2):
+        urgency = self._now - (self._result_index.last_measured(fp1, fp2) or 0)
+        if self._relay_weight <= 0: return urgency
+        fewest = min([ self._relay_counts.get(bytes.fromhex(fp), 0) \
+                for fp in (fp1, fp2) ])
+        return urgency * (1 + self._relay_weight / (1 + fewest))
+
+    # pairs as a list, most urgent first
+    def order(self, pairs):
+        return sorted(pairs, key=lambda xy: self.priority(*xy), reverse=True)
+
+    # How urgent a bunch of pairs is as a whole, for deciding which of several
+    # relaylist files to measure first
+    def mean_priority(self, pairs):
+        total, num = 0, 0
+        for fp1, fp2 in pairs:
+            total += self.priority(fp1, fp2)
+            num += 1
+        return total / num if num > 0 else 0
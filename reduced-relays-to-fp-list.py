@@ -1,31 +1,169 @@
 #!/usr/bin/env python3
+# Take the representative relays chosen by generate-reduced-relays-list.py
+# and split every pair of them into shard files for dispatch-ting-procs.py.
+#
+# All the pairs that start with the same relay (a "row") go into the same
+# shard so the ting process that gets the shard only has to measure that
+# relay's 3 hop leg once. Rows are given to shards so that every shard has
+# about the same estimated cost, where a pair or leg that is already in the
+# cache or that already has a recent result is cheap.
+import glob
+import heapq
 import json
+import os
 import random
+import time
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, FileType
 from datetime import datetime
+from compression import open_file
+
+# Estimated cost of measuring a circuit (4 hop pair or 3 hop leg) that we
+# know nothing about, and of one that we expect to be cached or skipped
+FULL_COST = 1.0
+CHEAP_COST = 0.1
+
+def fail_hard(*msg):
+    if msg: print(*msg)
+    exit(1)
+
+def read_fresh_cache_keys(args):
+    fresh_3hop, fresh_4hop = set(), set()
+    if not args.cache_file or not os.path.isfile(args.cache_file):
+        return fresh_3hop, fresh_4hop
+    now = time.time()
+    with open_file(args.cache_file, 'rt') as f: cache = json.load(f)
+    for key, entry in cache.items():
+        path = key.split('-')
+        if path[0] != args.w_relay or path[-1] != args.z_relay: continue
+        if len(path) == 3 and entry['time'] + args.cache_3hop_life >= now:
+            fresh_3hop.add(path[1])
+        elif len(path) == 4 and entry['time'] + args.cache_4hop_life >= now:
+            fresh_4hop.add( (path[1], path[2]) )
+    return fresh_3hop, fresh_4hop
+
+def read_fresh_result_pairs(args):
+    fresh = set()
+    if not args.results_file or not os.path.isfile(args.results_file):
+        return fresh
+    now = time.time()
+    with open_file(args.results_file, 'rt') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) <= 0 or line[0] == '#': continue
+            res = json.loads(line)
+            if res['time'] + args.result_life < now: continue
+            xy = ( res['x']['fp'], res['y']['fp'] )
+            if xy[0] > xy[1]: xy = xy[1], xy[0]
+            fresh.add(xy)
+    return fresh
+
+def row_costs(relays, fresh_3hop, cheap_pairs):
+    position = { fp: i for i, fp in enumerate(relays) }
+    costs = []
+    for i, fp in enumerate(relays):
+        cost = (len(relays) - i - 1) * FULL_COST
+        cost += CHEAP_COST if fp in fresh_3hop else FULL_COST
+        costs.append(cost)
+    # Every cheap pair belongs to the row of whichever of its relays comes
+    # first, so we can discount it without looking at every pair
+    for fp1, fp2 in cheap_pairs:
+        if fp1 not in position or fp2 not in position: continue
+        i = min(position[fp1], position[fp2])
+        costs[i] -= FULL_COST - CHEAP_COST
+    return costs
+
+# Longest processing time first: the most expensive row goes to whichever
+# shard currently has the lowest total cost
+def assign_rows_to_shards(costs, num_shards):
+    shards = [ (0.0, shard) for shard in range(num_shards) ]
+    heapq.heapify(shards)
+    assignment = [ None ] * len(costs)
+    for i in sorted(range(len(costs)), key=lambda i: costs[i], reverse=True):
+        total, shard = heapq.heappop(shards)
+        assignment[i] = shard
+        heapq.heappush(shards, (total + costs[i], shard))
+    return assignment, sorted(shards, key=lambda s: s[1])
+
+def shard_fname(args, shard):
+    return os.path.join(args.outdir, 'shard-{:04d}.txt'.format(shard))
+
+# Shards and .done markers left by an earlier run would have their pairs
+# measured again, or the new shards skipped
+def remove_old_shards(args):
+    old = glob.glob(os.path.join(args.outdir, 'shard-*'))
+    for fname in old: os.remove(fname)
+    if len(old) > 0:
+        print('Removed', len(old), 'shard files and markers from an earlier '
+                'run in', args.outdir)
 
 def main(args):
     selected_relays = json.load(args.selected_relays)
     selected_relays = [ r['fp'] for r in selected_relays ]
+    random.seed(args.seed)
     random.shuffle(selected_relays)
-    pairs = []
+    fresh_3hop, fresh_4hop = read_fresh_cache_keys(args)
+    cheap_pairs = fresh_4hop | read_fresh_result_pairs(args)
+    costs = row_costs(selected_relays, fresh_3hop, cheap_pairs)
+    assignment, shard_costs = assign_rows_to_shards(costs, args.shards)
+    os.makedirs(args.outdir, exist_ok=True)
+    remove_old_shards(args)
+    outfiles = [ open(shard_fname(args, shard), 'wt') \
+            for shard in range(args.shards) ]
+    for f in outfiles: f.write('# Generated on {}\n'.format(datetime.now()))
+    num_pairs = 0
     for i, fp1 in enumerate(selected_relays):
+        row = []
         for fp2 in selected_relays[i+1:]:
-            if fp1 < fp2: pairs.append('{} {}\n'.format(fp1,fp2))
-            else: pairs.append('{} {}\n'.format(fp2,fp1))
-    args.outfile.write('# Generated on {}\n'.format(datetime.now()))
-    args.outfile.write(''.join(pairs))
+            if fp1 < fp2: row.append('{} {}\n'.format(fp1,fp2))
+            else: row.append('{} {}\n'.format(fp2,fp1))
+        outfiles[assignment[i]].write(''.join(row))
+        num_pairs += len(row)
+    for f in outfiles: f.close()
+    print('Wrote', num_pairs, 'pairs between', len(selected_relays),
+            'relays into', args.shards, 'shards in', args.outdir)
+    for total, shard in shard_costs:
+        print(shard_fname(args, shard), 'estimated cost', round(total, 1))
 
 if __name__=='__main__':
     parser = ArgumentParser(
             formatter_class=ArgumentDefaultsHelpFormatter)
     DEF_SELECTED_RELAYS_FNAME = 'selected-relays.json'
-    DEF_OUTFILE = 'reduced-relaypairs.txt'
+    DEF_OUTDIR = 'reduced-relaypairs-split'
+    DEF_SHARDS = 6
+    DEF_CACHE_FNAME = 'data/cache.json'
+    DEF_RESULTS_FNAME = 'data/results.json'
     parser.add_argument('--selected-relays',
             help='Name of selected relays file',
             default=DEF_SELECTED_RELAYS_FNAME, type=FileType('rt'))
-    parser.add_argument('--outfile',
-            help='Where to dump relay pairs',
-            default=DEF_OUTFILE, type=FileType('wt'))
+    parser.add_argument('--outdir',
+            help='Directory in which to put the shard files',
+            default=DEF_OUTDIR, type=str)
+    parser.add_argument('--shards',
+            help='Number of shard files to split relay pairs into',
+            default=DEF_SHARDS, type=int)
+    parser.add_argument('--seed', help='Seed for shuffling the relays',
+            default=None, type=int)
+    parser.add_argument('--w-relay', help='FP of W relay. Needed to find '
+            'cached results in the cache file', type=str)
+    parser.add_argument('--z-relay', help='FP of Z relay. Needed to find '
+            'cached results in the cache file', type=str)
+    parser.add_argument('--cache-file',
+            help='Cache file used to estimate which legs are cheap',
+            default=DEF_CACHE_FNAME, type=str)
+    parser.add_argument('--cache-3hop-life', metavar='SECS', type=int,
+            help='How long to consider 3hop cached results fresh',
+            default=60*60*24*1)
+    parser.add_argument('--cache-4hop-life', metavar='SECS', type=int,
+            help='How long to consider 4hop cached results fresh',
+            default=60*60*24*1)
+    parser.add_argument('--results-file',
+            help='Results file used to estimate which pairs are cheap',
+            default=DEF_RESULTS_FNAME, type=str)
+    parser.add_argument('--result-life', metavar='SECS', type=int,
+            help='How long to consider a result recent',
+            default=60*60*24*100)
     args = parser.parse_args()
+    if args.shards < 1: fail_hard('Need at least one shard')
+    if not args.w_relay or not args.z_relay:
+        args.cache_file = None
     exit(main(args))
@@ -0,0 +1,141 @@
+from threading import Lock
+import fcntl
+import json
+import os
+import time
+
+# Remembers which relays we recently failed to build circuits through so that
+# we don't spend circ_build_attempts * CircuitBuildTimeout on every single
+# pair that has an offline relay in it.
+#
+# Every failed circuit counts against all the relays in it other than W and
+# Z, and every successful circuit clears them. Failures only count while
+# other circuits through our tor instance are being built fine. If none have
+# been for INSTANCE_OK_WINDOW seconds, it's our tor instance or W that is
+# broken and not the relays, and blaming them would have every other ting
+# process sharing the file skip them too. A relay that fails
+# args.relay_fail_threshold times in a row is considered down for a back-off
+# period that doubles every time it fails again, up to args.relay_backoff_max.
+# Once the back-off is over, one pair with the relay is let through to
+# recheck it.
+#
+# If args.relay_health_file is given, the state is merged with that file
+# every args.relay_health_sync seconds so that every ting process sharing the
+# file learns about down relays from the others.
+class RelayHealth():
+    INSTANCE_OK_WINDOW = 60*5
+
+    def __init__(self, args, logger):
+        self._args = args
+        self._log = logger
+        self._fname = args.relay_health_file
+        self._fixed = set([args.w_relay, args.z_relay])
+        self._lock = Lock()
+        self._sync_lock = Lock()
+        # fp -> { 'failures': consecutive failures,
+        #         'down_until': time we'll let a pair with it through again,
+        #         'updated': time of the last change to this entry }
+        self._relays = {}
+        self._last_sync = 0
+        # When a circuit through our tor instance was last built
+        self._last_success = None
+        if self._fname: self.sync()
+
+    def failed(self, path):
+        now = time.time()
+        with self._lock:
+            if self._last_success == None or self._last_success + \
+                    RelayHealth.INSTANCE_OK_WINDOW < now:
+                self._log.info('Not blaming the relays in a failed circuit '
+                        'since no circuit has been built lately')
+                return
+            for fp in path:
+                if fp in self._fixed: continue
+                entry = self._relays.get(fp, { 'failures': 0,
+                    'down_until': 0 })
+                entry['failures'] += 1
+                entry['updated'] = now
+                over = entry['failures'] - self._args.relay_fail_threshold
+                if over >= 0:
+                    backoff = min(self._args.relay_backoff_max,
+                            self._args.relay_backoff * 2**over)
+                    entry['down_until'] = now + backoff
+                    self._log.notice('Considering',fp,'down for',
+                            round(backoff),'secs after',entry['failures'],
+                            'failures in a row')
+                self._relays[fp] = entry
+        self._maybe_sync(now)
+
+    def succeeded(self, path):
+        now = time.time()
+        with self._lock:
+            self._last_success = now
+            for fp in path:
+                if fp in self._fixed: continue
+                if fp not in self._relays: continue
+                if self._relays[fp]['failures'] > 0:
+                    self._log.info('Considering',fp,'up again')
+                self._relays[fp] = { 'failures': 0, 'down_until': 0,
+                        'updated': now }
+        self._maybe_sync(now)
+
+    # Whether a pair should be measured now. If one of its relays is down but
+    # its back-off is over, this pair gets to be the one that rechecks it and
+    # everyone else keeps waiting for another back-off period.
+    def should_try(self, fp1, fp2):
+        now = time.time()
+        with self._lock:
+            entries = [ self._relays[fp] for fp in (fp1, fp2) \
+                    if fp in self._relays ]
+            if any([ e['down_until'] > now for e in entries ]): return False
+            for e in entries:
+                if e['failures'] >= self._args.relay_fail_threshold:
+                    e['down_until'] = now + self._args.relay_backoff
+                    e['updated'] = now
+        return True
+
+    # When the first of the given pairs may be tried again
+    def next_recheck(self, pairs):
+        with self._lock:
+            times = [ max([ self._relays[fp]['down_until'] for fp in pair \
+                    if fp in self._relays ] or [0]) for pair in pairs ]
+        return min(times) if len(times) > 0 else 0
+
+    def _maybe_sync(self, now):
+        if not self._fname: return
+        if self._last_sync + self._args.relay_health_sync > now: return
+        self.sync()
+
+    # Merge our state with the file's, keeping whichever entry for a relay
+    # was updated last, and write the result back
+    def sync(self):
+        if not self._fname: return
+        with self._sync_lock:
+            self._last_sync = time.time()
+            os.makedirs(os.path.dirname(os.path.abspath(self._fname)),
+                    exist_ok=True)
+            with open(self._fname + '.lock', 'at') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                on_disk = {}
+                if os.path.isfile(self._fname):
+                    with open(self._fname, 'rt') as f:
+                        try: on_disk = json.load(f)
+                        except ValueError: on_disk = {}
+                with self._lock:
+                    for fp, entry in on_disk.items():
+                        if fp not in self._relays or \
+                                self._relays[fp]['updated'] < entry['updated']:
+                            self._relays[fp] = entry
+                    self._forget_old(self._last_sync)
+                    merged = { fp: dict(e) for fp, e in self._relays.items() }
+                tmp_fname = self._fname + '.tmp'
+                with open(tmp_fname, 'wt') as f: json.dump(merged, f)
+                os.replace(tmp_fname, self._fname)
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Relays that are fine don't need to be remembered forever
+    def _forget_old(self, now):
+        for fp in list(self._relays.keys()):
+            entry = self._relays[fp]
+            if entry['failures'] == 0 and entry['updated'] + 60*60*24 < now:
+                del self._relays[fp]
@@ -1,35 +1,79 @@
 from stem import SocketError
 from stem.control import Controller
+from compression import open_file, tmp_name
+from pairgen import sample_pairs
+from pairscheduler import PairScheduler
+from resultindex import ResultIndex
+import json
 import os.path
 import random
 import time
-import json
-import lzma
-import gzip
+from threading import Lock
+# The relay pairs to measure, without those that already have a recent
+# result. With args.schedule staleness, the rest are in PairScheduler order.
+# Otherwise they're in the order they were read in.
+#
+# With args.consensus_state_file, pairs from the internet are only those
+# with a relay that is new to the consensus or whose address or flags
+# changed since the last time we measured from it, and a result only counts
+# as recent if it's newer than that change. Those pairs are made one changed
+# relay at a time as they're iterated over, so that the first run, when
+# every relay is new, doesn't hold every pair in the consensus at once. They
+# are pruned and, with args.schedule staleness, ordered a relay at a time
+# too.
 class RelayList():
     def __init__(self, args, logger):
         self._args = args
         self._log = logger
-        self._pairs = set()
+        # A dict with no values instead of a set so that the order the pairs
+        # were read in is kept
+        self._pairs = {}
+        # fp -> { 'address', 'flags', 'since' } of every relay in the
+        # consensus, if measuring incrementally. since is when the relay
+        # first showed up with that address and flags.
+        self._consensus = None
+        # If measuring incrementally, every relay in the consensus, the
+        # changed relays we'll make pairs for in order, and about how many
+        # pairs that is. A pair of two changed relays is made with whichever
+        # is first.
+        self._all_fps = []
+        self._changed = []
+        self._changed_set = set()
+        self._num_pairs = 0
+        # Changed relays that won't have had all their pairs made and
+        # measured, to make pairs for again next time
+        self._pending = set()
+        # changed relay -> how many of the pairs made with it haven't been
+        # measured yet
+        self._unmeasured = {}
+        self._unmeasured_lock = Lock()
+        # For pruning and ordering incremental pairs as they're made
+        self._result_index = None
+        self._scheduler = None
         self._max_pairs = args.relay_max_pairs
         if self._max_pairs < 0: self._max_pairs = 1000000000000
         source = args.relay_source
         if source == 'file': self._init_from_file(args.relay_source_file)
         elif source == 'internet': self._init_from_internet()
-        elif source == 'stdin': self._init_from_file(open('/dev/stdin', 'rt'))
+        elif source == 'stdin': self._init_from_file('/dev/stdin')
         else: self._fail_hard('unknown source: {}. Failing'.format(source))
         self._prune_existing_results()
 
     def __iter__(self):
+        if self._consensus != None: return self._iter_incremental()
         return self._pairs.__iter__()
 
+    # If measuring incrementally, this counts pairs that will be pruned for
+    # having recent results too
     def __len__(self):
+        if self._consensus != None: return self._num_pairs
         return len(self._pairs)
 
-    def _init_from_file(self, f):
-        self._log.notice('Initializing RelayList from {}'.format(f.name))
-        self._pairs = set()
-        if f.seekable(): f.seek(0)
+    # fname may be compressed (see compression.py)
+    def _init_from_file(self, fname):
+        self._log.notice('Initializing RelayList from {}'.format(fname))
+        self._pairs = {}
+        f = open_file(fname, 'rt')
         for line in f:
             #line = line[:-1] # trailing newline
             line = line.strip()
@@ -39,17 +83,32 @@ class RelayList():
             assert len(fp1) == 40
             assert len(fp2) == 40
             if fp1 > fp2: fp1, fp2 = fp2, fp1
-            self._pairs.add( (fp1, fp2) )
+            self._pairs[(fp1, fp2)] = None
             if len(self._pairs) >= self._max_pairs: break
         f.close()
         self._log.notice('Finished reading {} relay pairs from file'.format(
             len(self._pairs)))
         if len(self._pairs) >= self._max_pairs:
             self._log.warn('We stopped reading {} because we hit our '
-                'configured maximimum number of relay pairs'.format(f.name))
+                'configured maximimum number of relay pairs'.format(fname))
 
     def _init_from_internet(self):
         self._log.notice('Initializing RelayList from the current consensus')
+        relays = self._get_measured_relays()
+        if self._args.consensus_state_file:
+            self._init_incremental(relays)
+            return
+        rng = random.Random(self._args.relay_seed)
+        for fp1, fp2 in sample_pairs([ r.fingerprint for r in relays ],
+                self._max_pairs, rng):
+            self._pairs[(fp1, fp2)] = None
+        self._log.notice('Finished reading {} relay pairs from the current '
+                'consensus'.format(len(self._pairs)))
+        if len(self._pairs) >= self._max_pairs:
+            self._log.warn('We stopped adding relay pairs because we hit our '
+                'configured maximimum')
+
+    def _get_measured_relays(self):
         cont = None
         port = self._args.ctrl_port
         try:
@@ -65,29 +124,119 @@ class RelayList():
             self._fail_hard('Couldn\'t authenticate to Tor control port {}'\
                 .format(port))
         relays = cont.get_network_statuses()
-        all_fps = set([ r.fingerprint for r in relays if not r.is_unmeasured ])
-        ###
-        # simple method
-        ###
-        #for fp1 in all_fps:
-        #    for fp2 in all_fps:
-        #        if fp1 == fp2: continue
-        #        if fp1 > fp2: fp1, fp2 = fp2, fp1
-        #        self._pairs.add( (fp1, fp2) )
-        #        if len(self._pairs) >= self._max_pairs: break
-        #    if len(self._pairs) >= self._max_pairs: break
-        ###
-        # beter? method
-        ###
-        while len(self._pairs) < self._max_pairs:
-            fp1, fp2 = random.sample(all_fps, 2)
-            if fp1 > fp2: fp1, fp2 = fp2, fp1
-            self._pairs.add( tuple(random.sample(all_fps, 2)) )
-        self._log.notice('Finished reading {} relay pairs from the current '
-                'consensus'.format(len(self._pairs)))
-        if len(self._pairs) >= self._max_pairs:
-            self._log.warn('We stopped adding relay pairs because we hit our '
-                'configured maximimum')
+        return [ r for r in relays if not r.is_unmeasured ]
+
+    def _read_consensus_state(self):
+        fname = self._args.consensus_state_file
+        if not os.path.isfile(fname): return {}
+        with open_file(fname, 'rt') as f: return json.load(f)['relays']
+
+    # Find the relays that are new or changed since the consensus in the
+    # state file. Relays that were pending last time are changed again, but
+    # keep when they changed so results we got for them since still count.
+    # We don't know when a relay we've never seen changed, so every result
+    # for it counts. On the first run that's every relay.
+    def _init_incremental(self, relays):
+        log = self._log
+        now = time.time()
+        old = self._read_consensus_state()
+        self._consensus = {}
+        changed = []
+        for r in relays:
+            entry = { 'address': r.address, 'flags': sorted(r.flags) }
+            prev = old.get(r.fingerprint)
+            same = prev != None and prev['address'] == entry['address'] and \
+                    prev['flags'] == entry['flags']
+            if same: entry['since'] = prev['since']
+            elif prev != None: entry['since'] = now
+            else: entry['since'] = 0
+            if not same or prev.get('pending'): changed.append(r.fingerprint)
+            self._consensus[r.fingerprint] = entry
+        num_removed = len([ fp for fp in old if fp not in self._consensus ])
+        log.notice('Since the last consensus we measured from,',
+                len(changed),'relays are new or changed and',num_removed,
+                'are gone.',len(self._consensus),'relays are in it now')
+        self._all_fps = sorted(self._consensus.keys())
+        changed.sort()
+        self._changed_set = set(changed)
+        self._pending = set(changed)
+        for i, fp1 in enumerate(changed):
+            if self._num_pairs >= self._max_pairs: break
+            self._changed.append(fp1)
+            # Every other relay but the changed ones before it
+            self._num_pairs += len(self._all_fps) - 1 - i
+        if self._num_pairs > self._max_pairs or \
+                len(self._changed) < len(changed):
+            self._num_pairs = min(self._num_pairs, self._max_pairs)
+            log.warn('We will stop making relay pairs when we hit our '
+                'configured maximimum. The other pairs of the relays we '
+                'don\'t get to will be made next time')
+        log.notice('Will make up to {} relay pairs with the new or changed '
+                'relays'.format(self._num_pairs))
+
+    # The pairs of each changed relay in turn, without those with recent
+    # results
+    def _iter_incremental(self):
+        now = time.time()
+        life = self._args.result_life
+        num_made = 0
+        for fp1 in self._changed:
+            pairs = []
+            for fp2 in self._all_fps:
+                if fp2 == fp1 or (fp2 in self._changed_set and fp2 < fp1):
+                    continue
+                if num_made >= self._max_pairs: break
+                num_made += 1
+                xy = (fp1, fp2) if fp1 < fp2 else (fp2, fp1)
+                if not self._is_fresh(self._result_index, xy, life, now):
+                    pairs.append(xy)
+            else: self._pending.discard(fp1)
+            if self._scheduler: pairs = self._scheduler.order(pairs)
+            with self._unmeasured_lock: self._unmeasured[fp1] = len(pairs)
+            self._log.info('Made',len(pairs),'pairs without recent results '
+                    'with',fp1)
+            for xy in pairs: yield xy
+
+    # Call with every pair that got a result, good or bad
+    def pair_measured(self, fp1, fp2):
+        if self._consensus == None: return
+        owners = [ fp for fp in (fp1, fp2) if fp in self._changed_set ]
+        if len(owners) <= 0: return
+        with self._unmeasured_lock: self._unmeasured[min(owners)] -= 1
+
+    # Remember the consensus our pairs came from so the next run only makes
+    # pairs for what changed since. Changed relays with pairs that weren't
+    # measured, because they were skipped or we stopped early, stay pending
+    # so that their pairs are made again next time.
+    def save_consensus_state(self):
+        if self._consensus == None: return
+        with self._unmeasured_lock:
+            unmeasured = set([ fp for fp, num in self._unmeasured.items() \
+                    if num > 0 ])
+        if len(unmeasured) > 0:
+            self._log.notice(len(unmeasured),'changed relays have pairs that '
+                    'weren\'t measured. They will be made again next time')
+        self._pending.update(unmeasured)
+        for fp, entry in self._consensus.items():
+            if fp in self._pending: entry['pending'] = True
+        fname = self._args.consensus_state_file
+        tmp_fname = tmp_name(fname)
+        with open_file(tmp_fname, 'wt') as f:
+            json.dump({ 'saved_at': time.time(), 'relays': self._consensus },
+                    f)
+        os.replace(tmp_fname, fname)
+        self._log.notice('Saved the state of',len(self._consensus),'relays '
+                'in the consensus to',fname)
+
+    # Whether the pair xy has a result that is recent and, if measuring
+    # incrementally, newer than the last time either relay changed
+    def _is_fresh(self, result_index, xy, life, now):
+        if result_index == None: return False
+        measured_at = result_index.last_measured(*xy)
+        if measured_at == None or measured_at + life < now: return False
+        if self._consensus == None: return True
+        return all([ measured_at >= self._consensus[fp]['since'] \
+                for fp in xy if fp in self._consensus ])
 
     def _prune_existing_results(self):
         args = self._args
@@ -96,28 +245,27 @@ class RelayList():
         now = time.time()
         results_fname = os.path.abspath(args.out_result_file)
         if not os.path.isfile(results_fname): return
-        results = []
-        for line in open(results_fname, 'rt'): results.append(json.loads(line))
-        num_results = len(results)
+        result_index = ResultIndex(include_failures=True).load(results_fname)
+        scheduler = None
+        if args.schedule == 'staleness':
+            scheduler = PairScheduler(result_index, args.schedule_relay_weight,
+                    now)
+        if self._consensus != None:
+            # Incremental pairs are pruned and ordered as they're made
+            self._result_index, self._scheduler = result_index, scheduler
+            return
         old_num_pairs = len(self._pairs)
-        too_old_results = 0
-        still_recent_results = 0
-        for res in results:
-            xy = ( res['x']['fp'], res['y']['fp'] )
-            if xy[0] > xy[1]: xy = xy[1], xy[0]
-            if res['time'] + life < now:
-                too_old_results += 1
-                continue
-            else: still_recent_results += 1
-            if xy in self._pairs:
-                log.info('Removing {},{} from pairs because we have a recent '
-                    'result.'.format(*[fp[0:8] for fp in xy]))
-                self._pairs.remove(xy)
+        for xy in [ xy for xy in self._pairs \
+                if self._is_fresh(result_index, xy, life, now) ]:
+            log.info('Removing {},{} from pairs because we have a recent '
+                'result.'.format(*[fp[0:8] for fp in xy]))
+            del self._pairs[xy]
         new_num_pairs = len(self._pairs)
-        log.notice('Trimmed {} pairs to {} using {} recent results '
-            '({} were too old).'.format(old_num_pairs, new_num_pairs,
-            still_recent_results, too_old_results))
-
+        log.notice('Trimmed {} pairs to {} using results for {} '
+            'pairs.'.format(old_num_pairs, new_num_pairs, len(result_index)))
+        if scheduler:
+            self._pairs = dict.fromkeys(scheduler.order(self._pairs))
+            log.notice('Ordered the pairs by how stale their results are')
 
     def _fail_hard(self, msg):
         self._log.error(msg)
@@ -0,0 +1,72 @@
+from compression import open_file
+import json
+import os
+import re
+import time
+
+# When each relay pair last got a successful result, built by streaming
+# through results files so the results themselves never need to be held in
+# memory. Pairs are keyed on their two fingerprints decoded to bytes, which
+# is about half the size of keeping them as a tuple of strings.
+#
+# Failed measurements only count if include_failures is True.
+class ResultIndex():
+    # The parts of a result we need, as ResultsManager writes them. Parsing
+    # each line as JSON takes several times longer, so that is only done for
+    # lines that don't look like this.
+    RESULT_RE = re.compile(r'^\{"time": ([^,]+), "rtt": ([^,]+), '
+            r'"x": \{"fp": "([0-9A-Fa-f]{40})", .*?\}, '
+            r'"y": \{"fp": "([0-9A-Fa-f]{40})", ')
+
+    def __init__(self, include_failures=False):
+        self._include_failures = include_failures
+        self._latest = {}
+
+    def __len__(self):
+        return len(self._latest)
+
+    @staticmethod
+    def _key(fp1, fp2):
+        if fp1 > fp2: fp1, fp2 = fp2, fp1
+        return bytes.fromhex(fp1 + fp2)
+
+    def add_result(self, res):
+        if res['rtt'] == None and not self._include_failures: return
+        key = ResultIndex._key(res['x']['fp'], res['y']['fp'])
+        if self._latest.get(key, 0) < res['time']:
+            self._latest[key] = res['time']
+
+    def add_line(self, line):
+        line = line.strip()
+        if len(line) <= 0 or line[0] == '#': return
+        match = ResultIndex.RESULT_RE.match(line)
+        if not match:
+            self.add_result(json.loads(line))
+            return
+        at, rtt, fp1, fp2 = match.groups()
+        if rtt == 'null' and not self._include_failures: return
+        key = ResultIndex._key(fp1, fp2)
+        at = float(at)
+        if self._latest.get(key, 0) < at: self._latest[key] = at
+
+    def load(self, fname):
+        if not os.path.isfile(fname): return self
+        with open_file(fname, 'rt') as f:
+            for line in f: self.add_line(line)
+        return self
+
+    # fp decoded to bytes -> how many pairs with it have a result
+    def relay_counts(self):
+        counts = {}
+        for key in self._latest:
+            for fp in (key[0:20], key[20:40]):
+                counts[fp] = counts.get(fp, 0) + 1
+        return counts
+
+    def last_measured(self, fp1, fp2):
+        return self._latest.get(ResultIndex._key(fp1, fp2), None)
+
+    def is_fresh(self, fp1, fp2, life, now=None):
+        if now == None: now = time.time()
+        measured_at = self.last_measured(fp1, fp2)
+        return measured_at != None and measured_at + life >= now
@@ -2,20 +2,40 @@ from stem import ( CircuitExtensionFailed, DescriptorUnavailable,
         InvalidRequest, SocketError
 )
 from stem.control import Controller, EventType
+from compression import open_file
 import json, time
-from threading import Thread
-from queue import Empty, Queue
+from threading import Lock, Thread
+from queue import Queue
+# If args.out_result_file is None, results are not written anywhere and are
+# only handed back to whoever made them. This is how the results manager is
+# used when measuring from within another program instead of from ting2.py.
+#
+# The controller is only needed to look up relays' addresses and nicknames,
+# so we don't connect to tor until the first result is made.
 class ResultsManager():
-    def __init__(self, args, logger, end_event):
+    def __init__(self, args, logger):
         self._args = args
         self._log = logger
-        self._cont = \
-            self._init_controller(args.ctrl_port)
+        self._cont = None
+        self._cont_lock = Lock()
         self._write_results_every = args.write_results_every
         self._results_fname = args.out_result_file
         self._incoming_queue = Queue()
-        self._is_shutting_down = end_event
-        Thread(target=self._loop_forever, name='results').start()
+        self._thread = None
+        if self._results_fname is not None:
+            self._thread = Thread(target=self._loop_forever, name='results')
+            self._thread.start()
+
+    # Write out whatever results are still pending and stop
+    def stop(self):
+        if not self._thread: return
+        self._incoming_queue.put(None)
+        self._thread.join()
+
+    def _fail_hard(self, msg):
+        log = self._log
+        if msg: log.error(msg)
+        exit(1)
 
     def _init_controller(self, port):
         log = self._log
@@ -35,32 +55,43 @@ class ResultsManager():
         return cont
 
     def add_result(self, result):
-        self._incoming_queue.put(result)
+        if self._results_fname is not None: self._incoming_queue.put(result)
+        return result
+
+    def _controller(self):
+        with self._cont_lock:
+            if self._cont == None:
+                self._cont = self._init_controller(self._args.ctrl_port)
+        return self._cont
 
-    def make_result(self, rtt, fp1, fp2):
+    # hists maps the names of the legs we measured ('wxyz', 'wxz', 'wyz') to
+    # the histograms of their samples. Legs without one are left out.
+    def make_result(self, rtt, fp1, fp2, hists=None):
         ip1, ip2 = ['0.0.0.0'] * 2
         nick1, nick2 = ['(unknown)'] * 2
-        try: ns1 = self._cont.get_network_status(fp1)
+        cont = self._controller()
+        try: ns1 = cont.get_network_status(fp1)
         except DescriptorUnavailable: pass
         else: ip1, nick1 = ns1.address, ns1.nickname
-        try: ns2 = self._cont.get_network_status(fp2)
+        try: ns2 = cont.get_network_status(fp2)
         except DescriptorUnavailable: pass
         else: ip2, nick2 = ns2.address, ns2.nickname
-        return {
+        result = {
                 'time': time.time(),
                 'rtt': rtt,
                 'x': { 'fp': fp1, 'ip': ip1, 'nick': nick1, },
                 'y': { 'fp': fp2, 'ip': ip2, 'nick': nick2, },
         }
+        if hists:
+            hists = { leg: h for leg, h in hists.items() if h != None }
+            if len(hists) > 0: result['hists'] = hists
+        return result
 
     def _loop_forever(self):
         pending_results = []
-        while not self._is_shutting_down.is_set():
-            res = None
-            try: res = self._incoming_queue.get(timeout=1)
-            except Empty:
-                self._log.debug('No pending results')
-                continue
+        while True:
+            res = self._incoming_queue.get()
+            if res == None: break
             self._log.debug('Got',res)
             pending_results.append(res)
             if len(pending_results) >= self._write_results_every:
@@ -72,6 +103,6 @@ class ResultsManager():
     def _write_results(self, results):
         self._log.notice('Collected',len(results),'results so writing them to',
                 self._results_fname)
-        with open(self._results_fname, 'at') as f:
+        with open_file(self._results_fname, 'at') as f:
             output = '\n'.join([json.dumps(r) for r in results])
             f.write('{}\n'.format(output))
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# Look at the histograms ting2.py --rtt-histograms keeps of every circuit's
+# samples, to judge how much to trust a result without measuring it again.
+#
+# Histograms are read from results files and cache files and merged by leg
+# or by relay. A leg is named by the relays in the middle of its path, so
+# X-Y for the W-X-Y-Z circuit of a result and X for W-X-Z. Every leg counts
+# for each relay in it. For each group we print how many samples it has and
+# some quantiles of them. The ratio of a high quantile to the low one is
+# near 1 for a quiet leg and grows with congestion, so groups are printed
+# noisiest first.
+#
+# With --out-file the merged histograms are also written as JSON, one
+# { 'name', 'hist' } per line, which can be read back in with --hist-file.
+import json
+import os
+import sys
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from compression import open_file
+from rtthist import RttHistogram
+
+def fail_hard(*msg):
+    if msg: print(*msg, file=sys.stderr)
+    exit(1)
+
+def read_lines(fname):
+    for line in open_file(fname, 'rt'):
+        line = line.strip()
+        if len(line) <= 0 or line[0] == '#': continue
+        yield json.loads(line)
+
+# (leg name, histogram) for every histogram in the given files
+def read_leg_hists(args):
+    for fname in args.result_file:
+        for res in read_lines(fname):
+            x, y = res['x']['fp'], res['y']['fp']
+            names = { 'wxyz': '{}-{}'.format(x, y), 'wxz': x, 'wyz': y }
+            for leg, hist in res.get('hists', {}).items():
+                yield names[leg], RttHistogram.from_list(hist)
+    for fname in args.cache_file:
+        with open_file(fname, 'rt') as f: cache = json.load(f)
+        for entry in cache.values():
+            if 'hist' not in entry: continue
+            yield '-'.join(entry['path'][1:-1]), \
+                    RttHistogram.from_list(entry['hist'])
+    for fname in args.hist_file:
+        for line in read_lines(fname):
+            yield line['name'], RttHistogram.from_list(line['hist'])
+
+def merge_hists(args):
+    merged = {}
+    for name, hist in read_leg_hists(args):
+        groups = [ name ] if args.by == 'leg' else name.split('-')
+        for group in groups:
+            if group not in merged: merged[group] = RttHistogram()
+            merged[group].merge(hist)
+    return merged
+
+def main(args):
+    merged = merge_hists(args)
+    if args.out_file:
+        with open_file(args.out_file, 'wt') as f:
+            for name, hist in merged.items():
+                f.write('{}\n'.format(json.dumps(
+                    { 'name': name, 'hist': hist.to_list() })))
+    rows = []
+    for name, hist in merged.items():
+        if len(hist) < args.min_samples: continue
+        qs = [ hist.quantile(q) for q in args.quantiles ]
+        rows.append( (qs[-1] / qs[0], name, len(hist), qs) )
+    rows.sort(reverse=True)
+    if args.limit: rows = rows[0:args.limit]
+    print('# {} samples {} spread'.format(args.by,
+        ' '.join([ 'q{}'.format(q) for q in args.quantiles ])))
+    for spread, name, num, qs in rows:
+        print(name, num, ' '.join([ '{:.4f}'.format(q) for q in qs ]),
+                '{:.2f}'.format(spread))
+
+if __name__=='__main__':
+    parser = ArgumentParser(
+            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--result-file', metavar='FNAME', action='append',
+            help='Results file to read histograms from. Can be given more '
+            'than once', default=[])
+    parser.add_argument('--cache-file', metavar='FNAME', action='append',
+            help='Cache file to read histograms from. Can be given more '
+            'than once', default=[])
+    parser.add_argument('--hist-file', metavar='FNAME', action='append',
+            help='File written by --out-file to read histograms from. Can '
+            'be given more than once', default=[])
+    parser.add_argument('--by', choices=['leg', 'relay'], default='leg',
+            help='Merge the histograms of each leg or of each relay')
+    parser.add_argument('--quantiles', metavar='Q', type=float, nargs='+',
+            help='Quantiles to print. The spread is the last over the first',
+            default=[0.0, 0.5, 0.9, 0.99])
+    parser.add_argument('--min-samples', metavar='NUM', type=int,
+            help='Leave out groups with fewer samples than this', default=1)
+    parser.add_argument('--limit', metavar='NUM', type=int,
+            help='Only print this many of the noisiest groups')
+    parser.add_argument('--out-file', metavar='FNAME', type=str,
+            help='Also write the merged histograms to this file')
+    args = parser.parse_args()
+    if len(args.result_file) + len(args.cache_file) + \
+            len(args.hist_file) <= 0:
+        fail_hard('Give at least one --result-file, --cache-file, or '
+                '--hist-file')
+    for fname in args.result_file + args.cache_file + args.hist_file:
+        if not os.path.isfile(fname): fail_hard(fname, 'does not exist')
+    exit(main(args))
@@ -0,0 +1,268 @@
+from array import array
+from compression import open_file, tmp_name
+from threading import Event, Lock, Thread
+import json
+import os
+import time
+
+# The RTTs we've measured over 3 and 4 hop paths, shared by every TingClient
+# in a process.
+#
+# Keeping this as a dict of '-'.join(path) to { 'rtt', 'path', 'time' } costs
+# close to a kilobyte per entry, and with one lock around all of it every
+# thread waits on every other thread's lookups. Instead each relay is
+# interned to a small int, a path is packed into a single int made of its
+# relays' ints, and the rtt and time of each entry live in arrays. Entries
+# are split between stripes by path, each with its own lock.
+#
+# An entry can also have a histogram of the samples its RTT was the min() of,
+# as from RttHistogram.to_list(). Those are only kept for the entries that
+# have one, and only as long as the entry's RTT is the one they describe.
+#
+# The cache file keeps the old format so older cache files can still be used
+# and so dispatch-ting-procs.py and the coordinator can keep merging them.
+#
+# lifetimes is path length -> how long an entry stays fresh when deciding
+# which of two entries to keep, as from cache_lifetimes(). Not given means
+# entries never go stale.
+class RttCache():
+    # Enough for every relay that has ever existed, many times over
+    RELAY_BITS = 21
+
+    def __init__(self, num_stripes=16, lifetimes=None):
+        self._num_stripes = num_stripes
+        self._lifetimes = lifetimes or {}
+        self._intern_lock = Lock()
+        # Only one thread writes the cache file at a time, but lookups don't
+        # have to wait for it
+        self._dump_lock = Lock()
+        # Cleared while a cache file is being loaded in the background
+        self._loaded = Event()
+        self._loaded.set()
+        self._relay_ids = {}
+        self._relay_fps = []
+        self._locks = [ Lock() for _ in range(num_stripes) ]
+        # packed path -> index into the stripe's arrays
+        self._slots = [ {} for _ in range(num_stripes) ]
+        self._rtts = [ array('d') for _ in range(num_stripes) ]
+        self._times = [ array('d') for _ in range(num_stripes) ]
+        # packed path -> histogram, for the entries that have one
+        self._hists = [ {} for _ in range(num_stripes) ]
+        # packed paths of the entries set since changes() was last called, if
+        # track_changes() was
+        self._changed = None
+
+    def __len__(self):
+        return sum([ len(slots) for slots in self._slots ])
+
+    def _intern(self, fp):
+        with self._intern_lock:
+            if fp not in self._relay_ids:
+                self._relay_ids[fp] = len(self._relay_fps)
+                self._relay_fps.append(fp)
+            return self._relay_ids[fp]
+
+    # The packed form of path, or None if one of its relays has never been
+    # seen and add is False. Relay ids are stored plus one so that a path
+    # can't be mistaken for a shorter one.
+    def _key(self, path, add=False):
+        relay_ids = self._relay_ids
+        bits = RttCache.RELAY_BITS
+        key = 0
+        for fp in path:
+            relay_id = relay_ids.get(fp)
+            if relay_id == None:
+                if not add: return None
+                relay_id = self._intern(fp)
+            key = (key << bits) | (relay_id + 1)
+        return key
+
+    def _path(self, key):
+        mask = (1 << RttCache.RELAY_BITS) - 1
+        path = []
+        while key > 0:
+            path.append(self._relay_fps[(key & mask) - 1])
+            key >>= RttCache.RELAY_BITS
+        return path[::-1]
+
+    # Every path shares W and Z, so mix the middle relays into the low bits
+    # before picking a stripe
+    def _stripe(self, key):
+        bits = RttCache.RELAY_BITS
+        return (key ^ (key >> bits) ^ (key >> 2*bits)) % self._num_stripes
+
+    def get(self, path, lifetime, now=None):
+        if not self._loaded.is_set(): self._loaded.wait()
+        key = self._key(path)
+        if key == None: return None
+        if now == None: now = time.time()
+        stripe = self._stripe(key)
+        with self._locks[stripe]:
+            slot = self._slots[stripe].get(key)
+            if slot == None: return None
+            if self._times[stripe][slot] + lifetime < now: return None
+            return self._rtts[stripe][slot]
+
+    # The histogram stored with path's entry, or None
+    def hist(self, path):
+        key = self._key(path)
+        if key == None: return None
+        stripe = self._stripe(key)
+        with self._locks[stripe]: return self._hists[stripe].get(key)
+
+    # Remember rtt for path unless we already have a lower one that is still
+    # fresh. Returns whether we did.
+    def put(self, path, rtt, lifetime, now=None, hist=None):
+        if now == None: now = time.time()
+        key = self._key(path, add=True)
+        stripe = self._stripe(key)
+        with self._locks[stripe]:
+            slot = self._slots[stripe].get(key)
+            if slot != None and self._times[stripe][slot] + lifetime > now \
+                    and self._rtts[stripe][slot] <= rtt:
+                return False
+            self._set(stripe, key, slot, rtt, now, hist)
+        return True
+
+    # Remember rtt for path if is_better_entry() says it beats what we have.
+    # Used for entries measured by someone else. Returns whether we did.
+    def merge(self, path, rtt, at, hist=None, now=None):
+        if now == None: now = time.time()
+        lifetime = self._lifetimes.get(len(path))
+        key = self._key(path, add=True)
+        stripe = self._stripe(key)
+        with self._locks[stripe]:
+            slot = self._slots[stripe].get(key)
+            if slot != None and not is_better_entry(rtt, at,
+                    self._rtts[stripe][slot], self._times[stripe][slot],
+                    lifetime, now):
+                return False
+            self._set(stripe, key, slot, rtt, at, hist)
+        return True
+
+    def _set(self, stripe, key, slot, rtt, at, hist=None):
+        if self._changed != None: self._changed[stripe].add(key)
+        if hist != None: self._hists[stripe][key] = hist
+        else: self._hists[stripe].pop(key, None)
+        if slot == None:
+            self._slots[stripe][key] = len(self._rtts[stripe])
+            self._rtts[stripe].append(rtt)
+            self._times[stripe].append(at)
+        else:
+            self._rtts[stripe][slot] = rtt
+            self._times[stripe][slot] = at
+
+    # (path, rtt, time, hist) of every entry measured after newer_than. hist
+    # is None if the entry doesn't have one.
+    def items(self, newer_than=0):
+        items = []
+        for stripe in range(self._num_stripes):
+            with self._locks[stripe]:
+                rtts, times = self._rtts[stripe], self._times[stripe]
+                hists = self._hists[stripe]
+                items.extend([ (key, rtts[slot], times[slot], hists.get(key)) \
+                        for key, slot in self._slots[stripe].items() \
+                        if times[slot] > newer_than ])
+        return [ (self._path(key), rtt, at, hist) \
+                for key, rtt, at, hist in items ]
+
+    # Start remembering which entries are set so that changes() can return
+    # them without looking at every entry. Every entry we have so far counts
+    # as changed.
+    def track_changes(self):
+        self._changed = [ set() for _ in range(self._num_stripes) ]
+        for stripe in range(self._num_stripes):
+            with self._locks[stripe]:
+                self._changed[stripe].update(self._slots[stripe])
+        return self
+
+    # The entries set since the last call, in the format of the cache file
+    def changes(self):
+        d = {}
+        for stripe in range(self._num_stripes):
+            with self._locks[stripe]:
+                keys, self._changed[stripe] = self._changed[stripe], set()
+                slots = self._slots[stripe]
+                rtts, times = self._rtts[stripe], self._times[stripe]
+                hists = self._hists[stripe]
+                entries = [ (key, rtts[slots[key]], times[slots[key]],
+                    hists.get(key)) for key in keys ]
+            for key, rtt, at, hist in entries:
+                path = self._path(key)
+                entry = { 'rtt': rtt, 'path': path, 'time': at }
+                if hist != None: entry['hist'] = hist
+                d['-'.join(path)] = entry
+        return d
+
+    # In the format of the cache file
+    def to_dict(self, newer_than=0):
+        d = {}
+        for path, rtt, at, hist in self.items(newer_than):
+            entry = { 'rtt': rtt, 'path': path, 'time': at }
+            if hist != None: entry['hist'] = hist
+            d['-'.join(path)] = entry
+        return d
+
+    # merge() every entry in d, a dict in the format of the cache file. The
+    # entries are sorted into stripes first so that each stripe's lock is
+    # only taken once.
+    def update_from_dict(self, d):
+        now = time.time()
+        by_stripe = [ [] for _ in range(self._num_stripes) ]
+        for entry in d.values():
+            key = self._key(entry['path'], add=True)
+            by_stripe[self._stripe(key)].append( (key, entry['rtt'],
+                entry['time'], entry.get('hist'),
+                self._lifetimes.get(len(entry['path']))) )
+        for stripe, entries in enumerate(by_stripe):
+            with self._locks[stripe]:
+                slots = self._slots[stripe]
+                rtts, times = self._rtts[stripe], self._times[stripe]
+                for key, rtt, at, hist, lifetime in entries:
+                    slot = slots.get(key)
+                    if slot != None and not is_better_entry(rtt, at,
+                            rtts[slot], times[slot], lifetime, now):
+                        continue
+                    self._set(stripe, key, slot, rtt, at, hist)
+        return self
+
+    def load(self, fname):
+        if not os.path.isfile(fname): return self
+        with open_file(fname, 'rt') as f:
+            return self.update_from_dict(json.load(f))
+
+    # Load fname in another thread so that whoever is starting up doesn't have
+    # to wait for it. Lookups wait until it's done so that we don't measure
+    # something we already have.
+    def load_in_background(self, fname):
+        self._loaded.clear()
+        def enter():
+            try: self.load(fname)
+            finally: self._loaded.set()
+        Thread(target=enter, name='cache-loader').start()
+        return self
+
+    def dump(self, fname):
+        tmp_fname = tmp_name(fname)
+        if not self._loaded.is_set(): self._loaded.wait()
+        with self._dump_lock:
+            with open_file(tmp_fname, 'wt') as f: json.dump(self.to_dict(), f)
+            os.replace(tmp_fname, fname)
+
+# Whether an entry with rtt measured at should replace one with old_rtt
+# measured at old_at. Every merge of leg caches follows this, as put() does:
+# the lowest RTT is kept as long as it's fresh, and one that is older than
+# lifetime gives way to a fresh one. A lifetime of None means entries never
+# go stale.
+def is_better_entry(rtt, at, old_rtt, old_at, lifetime=None, now=None):
+    if lifetime != None:
+        if now == None: now = time.time()
+        fresh, old_fresh = at + lifetime >= now, old_at + lifetime >= now
+        if not fresh and not old_fresh: return at > old_at
+        if fresh != old_fresh: return fresh
+    return rtt < old_rtt or (rtt == old_rtt and at > old_at)
+
+# Path length -> how long an entry stays fresh, from the --cache-3hop-life and
+# --cache-4hop-life options
+def cache_lifetimes(args):
+    return { 3: args.cache_3hop_life, 4: args.cache_4hop_life }
@@ -0,0 +1,79 @@
+import math
+
+# A summary of every ting sample sent over a circuit, small enough to keep
+# next to the min() we call its RTT in the cache and results files.
+#
+# Samples are counted in buckets that each cover the same fraction of the
+# RTTs in them, BUCKETS_PER_DOUBLING buckets for every doubling of the RTT
+# starting at MIN_RTT. Anything below MIN_RTT is counted in the first bucket
+# and anything past the last bucket in the last one. Only buckets with
+# samples in them are kept, so a circuit whose samples are all within a few
+# milliseconds of each other costs a few dozen bytes and even a very noisy
+# one a few hundred.
+#
+# Histograms with the same buckets can be added together, so those of every
+# circuit through a relay, or every time a leg was measured, can be merged
+# and their quantiles looked at as one. Changing the buckets makes every
+# histogram already stored meaningless.
+class RttHistogram():
+    MIN_RTT = 0.001
+    BUCKETS_PER_DOUBLING = 16
+    # 1 ms to a little over 2 minutes
+    NUM_BUCKETS = BUCKETS_PER_DOUBLING * 17
+
+    def __init__(self, counts=None):
+        # bucket -> number of samples in it
+        self._counts = dict(counts) if counts else {}
+
+    def __len__(self):
+        return sum(self._counts.values())
+
+    @staticmethod
+    def bucket(rtt):
+        if rtt <= RttHistogram.MIN_RTT: return 0
+        b = int(math.log2(rtt / RttHistogram.MIN_RTT) * \
+                RttHistogram.BUCKETS_PER_DOUBLING)
+        return min(b, RttHistogram.NUM_BUCKETS - 1)
+
+    # The smallest and largest RTT counted in bucket b
+    @staticmethod
+    def bucket_bounds(b):
+        per = RttHistogram.BUCKETS_PER_DOUBLING
+        return RttHistogram.MIN_RTT * 2 ** (b / per), \
+                RttHistogram.MIN_RTT * 2 ** ((b + 1) / per)
+
+    def add(self, rtt, count=1):
+        b = RttHistogram.bucket(rtt)
+        self._counts[b] = self._counts.get(b, 0) + count
+        return self
+
+    def add_samples(self, samples):
+        for rtt in samples: self.add(rtt)
+        return self
+
+    def merge(self, other):
+        for b, count in other._counts.items():
+            self._counts[b] = self._counts.get(b, 0) + count
+        return self
+
+    # The q quantile of the samples, as the geometric middle of the bucket it
+    # falls in, or None if there are no samples. It's within about 2% of the
+    # real thing.
+    def quantile(self, q):
+        total = len(self)
+        if total <= 0: return None
+        want = max(1, math.ceil(q * total))
+        seen = 0
+        for b in sorted(self._counts):
+            seen += self._counts[b]
+            if seen >= want: break
+        low, high = RttHistogram.bucket_bounds(b)
+        return math.sqrt(low * high)
+
+    # [[bucket, count], ...] in bucket order, for storing as JSON
+    def to_list(self):
+        return [ [b, self._counts[b]] for b in sorted(self._counts) ]
+
+    @staticmethod
+    def from_list(l):
+        return RttHistogram({ b: count for b, count in l })
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# Start a number of Tor processes for ting2 to then use, wait for them to
+# bootstrap, and keep them running until killed. The tor instances that are
+# currently usable are listed in --instances-file, which
+# dispatch-ting-procs.py can read with its --tor-instances-file option.
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+import os
+import sys
+import time
+from pastlylogger import PastlyLogger
+from torsupervisor import TorSupervisor
+
+log = PastlyLogger(notice='/dev/stdout', overwrite=['notice'])
+
+def main(args):
+    log.notice('Called as:',*sys.argv)
+    os.makedirs(args.datadir, exist_ok=True)
+    supervisor = TorSupervisor(args, log)
+    try:
+        supervisor.start()
+        log.notice(len(supervisor.live_instances()),'of',args.num_tors,
+            'tor instances are ready. Listing them in',args.instances_file)
+        while True: time.sleep(60)
+    except KeyboardInterrupt:
+        log.notice('Stopping tor instances')
+    finally:
+        supervisor.stop()
+
+if __name__=='__main__':
+    parser = ArgumentParser(
+            formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--tor-bin', metavar='PATH', type=str,
+            help='Tor binary to run', default='tor')
+    parser.add_argument('--num-tors', metavar='NUM', type=int,
+            help='Number of tor instances to run', default=6)
+    parser.add_argument('--base-port', metavar='PORT', type=int,
+            help='SocksPort of the first tor instance. Instance i gets '
+            'SocksPort PORT+2i and ControlPort PORT+2i+1', default=12000)
+    parser.add_argument('--datadir', metavar='DIR', type=str,
+            help='Directory in which each tor instance gets a DataDirectory '
+            'named after its SocksPort', default='tordatadirs')
+    parser.add_argument('--bridge', metavar='BRIDGE', type=str,
+            help='Bridge line (e.g. "IP:PORT FP") to make tor use. Can be '
+            'given multiple times', action='append', default=[])
+    parser.add_argument('--instances-file', metavar='FNAME', type=str,
+            help='Where to list the tor instances that are ready to be used',
+            default='tor-instances.json')
+    parser.add_argument('--bootstrap-timeout', metavar='SECS', type=float,
+            help='Restart a tor instance if it isn\'t ready SECS seconds '
+            'after starting or after it stopped being ready', default=300)
+    parser.add_argument('--check-interval', metavar='SECS', type=float,
+            help='How often to check that each tor instance is still '
+            'running and ready', default=10)
+    args = parser.parse_args()
+    exit(main(args))
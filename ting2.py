@@ -1,15 +1,23 @@
 #!/usr/bin/env python3
-from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser, FileType
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 from pastlylogger import PastlyLogger
 from tingclient import TingClient
 from relaylist import RelayList
 from resultsmanager import ResultsManager
-from threading import Event, Lock, Thread
-from queue import Empty, Queue
+from circprefetcher import CircuitPrefetcher
+from relayhealth import RelayHealth
+from adaptivetimeout import AdaptiveTimeouts
+from admission import AdmissionControl
+from coordinator import CoordinatorClient
+from rttcache import RttCache, cache_lifetimes
+from collections import deque
+from threading import Lock, Thread
+from queue import Queue
 import json, os, sys, time
 
 log = PastlyLogger(notice='data/notice.log', log_threads=True)
 #log = PastlyLogger(debug='/dev/stdout', overwrite=['debug'], log_threads=True)
+started_at = time.time()
 
 def seconds_to_duration(secs):
     m, s = divmod(secs, 60)
@@ -21,16 +29,25 @@ def seconds_to_duration(secs):
     elif m > 0: return '{}m{}s'.format(m,s)
     else: return '{}s'.format(s)
 
+# Takes pairs from the work queue shared by all client threads and measures
+# them until it takes None off the queue. on_done is called with the result of
+# every pair.
 class ClientThread():
-    def __init__(self, args, log, stream_creation_lock, cache_dict,
-            results_manager, is_shutting_down, name):
-        self._is_shutting_down = is_shutting_down
+    def __init__(self, args, log, stream_creation_lock, rtt_cache,
+            results_manager, prefetcher, relay_health, timeouts, admission,
+            work_queue, on_done, name):
+        self._work_queue = work_queue
+        self._on_done = on_done
         self._stream_creation_lock = stream_creation_lock
-        self.cache_dict = cache_dict
+        self.rtt_cache = rtt_cache
         self._results_manager = results_manager
+        self._prefetcher = prefetcher
+        self._relay_health = relay_health
+        self._timeouts = timeouts
+        self._admission = admission
         self._args = args
         self._log = log
-        self.input = Queue(maxsize=1)
+        self.ready_at = None
         self.thread = Thread(target=self._enter)
         self.thread.name = name
         self.name = self.thread.name
@@ -42,72 +59,163 @@ class ClientThread():
 
     def _enter(self):
         self._client = TingClient(self._args, self._log,
-                self._stream_creation_lock, self.cache_dict,
-                self._results_manager)
+                self._stream_creation_lock, self.rtt_cache,
+                self._results_manager, prefetcher=self._prefetcher,
+                relay_health=self._relay_health, timeouts=self._timeouts,
+                admission=self._admission)
+        self.ready_at = time.time()
+        self._log.info('Ready after',round(self.ready_at - started_at, 2),
+                'secs')
         while True:
-            fp1, fp2 = None, None
-            try: fp1, fp2 = self.input.get(timeout=1)
-            except Empty:
-                if self._is_shutting_down.is_set(): break
-                self._log.debug('No pending work')
-                continue
-            if fp1 and fp2:
-                self._client.perform_on(fp1,fp2)
+            item = self._work_queue.get()
+            if item == None: break
+            fp1, fp2 = item
+            self._log.info('Got',fp1,fp2)
+            self._on_done(self._client.perform_on(fp1,fp2))
 
 cleanup_count = 0
-def cleanup_after_ting_thread(args, thr, force=False):
+cleanup_count_lock = Lock()
+def cleanup_after_ting_thread(args, rtt_cache, force=False):
     global cleanup_count
-    cleanup_count += 1
-    if force or cleanup_count >= args.write_cache_every:
+    with cleanup_count_lock:
+        cleanup_count += 1
+        if not force and cleanup_count < args.write_cache_every: return
         if not force: cleanup_count -= args.write_cache_every
-        cache_dict, cache_dict_lock = thr.cache_dict
-        cache_fname = args.out_cache_file
-        with cache_dict_lock:
-            log.info('Writing',len(cache_dict),'cached items to cache file')
-            json.dump(cache_dict, open(cache_fname, 'wt'))
+    log.info('Writing',len(rtt_cache),'cached items to cache file')
+    rtt_cache.dump(args.out_cache_file)
 
-def get_next_client_thread(args, threads):
-    while True:
-        for thr in threads:
-            if not thr.input.full():
-                cleanup_after_ting_thread(args, thr)
-                return thr
-        time.sleep(0.5)
+# Sum up how circuit building and measuring went for all our clients so
+# whatever started us can tell how well our tor instance is doing. startup is
+# how long it took for the first client to be ready to measure. other_clients
+# are clients not owned by a thread, like the one the prefetcher builds
+# circuits with.
+def write_stats(args, threads, duration, other_clients=None):
+    stats = { 'duration': duration }
+    ready_at = [ thr.ready_at for thr in threads if thr.ready_at ]
+    if len(ready_at) > 0: stats['startup'] = min(ready_at) - started_at
+    clients = [ getattr(thr, '_client', None) for thr in threads ] + \
+            (other_clients or [])
+    for client in clients:
+        if not client: continue
+        for k, v in client.stats.items(): stats[k] = stats.get(k, 0) + v
+    log.notice('Stats:',stats)
+    # Replace it all at once so whatever reads it never sees half of it
+    tmp_fname = args.out_stats_file + '.tmp'
+    with open(tmp_fname, 'wt') as f: json.dump(stats, f)
+    os.replace(tmp_fname, args.out_stats_file)
 
-def dispatch_client_thread(thr, fp1, fp2):
-    log.info('Giving',thr.name,fp1,fp2)
-    thr.input.put( (fp1, fp2) )
+# Yield the pairs from relay_list lookahead pairs later than we read them,
+# telling the prefetcher about each pair as soon as we read it so it can get
+# its circuits ready
+def with_prefetching(relay_list, prefetcher, lookahead):
+    upcoming = deque()
+    for fp1, fp2 in relay_list:
+        prefetcher.want_pair(fp1, fp2)
+        upcoming.append( (fp1, fp2) )
+        if len(upcoming) > lookahead:
+            prefetcher.pair_dispatched()
+            yield upcoming.popleft()
+    while len(upcoming) > 0:
+        prefetcher.pair_dispatched()
+        yield upcoming.popleft()
+
+# Yield the pairs from relay_list, except those with a relay that is down.
+# Those are held back until the relay may be rechecked, and then yielded once
+# everything else has been. Pairs that would need us to wait more than
+# args.relay_recheck_wait seconds for a recheck are skipped.
+#
+# Pairs from a coordinator are given back to it instead of being held, so
+# that it doesn't wait on our leases for them. It leases them out again once
+# they may be rechecked, unless that's too far away.
+def with_relay_health(relay_list, relay_health, args, coordinator=None):
+    deferred = []
+    for fp1, fp2 in relay_list:
+        if relay_health.should_try(fp1, fp2): yield fp1, fp2
+        elif coordinator:
+            wait = relay_health.next_recheck([ (fp1, fp2) ]) - time.time()
+            coordinator.release([ (fp1, fp2) ], max(0, wait) \
+                    if wait <= args.relay_recheck_wait else None)
+        else: deferred.append( (fp1, fp2) )
+    if len(deferred) > 0:
+        log.notice('Deferred',len(deferred),'pairs with relays that are down')
+    while len(deferred) > 0:
+        still_deferred = []
+        for fp1, fp2 in deferred:
+            if relay_health.should_try(fp1, fp2): yield fp1, fp2
+            else: still_deferred.append( (fp1, fp2) )
+        deferred = still_deferred
+        if len(deferred) <= 0: break
+        wait = relay_health.next_recheck(deferred) - time.time()
+        if wait > args.relay_recheck_wait:
+            log.notice('Skipping',len(deferred),'pairs with relays that '
+                'are down. The next recheck is',round(wait),'secs away')
+            break
+        time.sleep(max(0, min(wait, 5)))
 
 def main(args):
     log.notice('Called as:',*sys.argv)
-    kill_client_threads = Event()
-    kill_results_thread = Event()
     stream_creation_lock = Lock()
-    cache_dict_lock = Lock()
-    cache_dict = None
-    relay_list = RelayList(args, log)
-    if len(relay_list) < 1:
-        log.notice('There\'s nothing to do')
-        exit(0)
-    rm = ResultsManager(args, log, kill_results_thread)
+    rm = ResultsManager(args, log)
     cache_fname = os.path.abspath(args.out_cache_file)
-    if not os.path.isfile(cache_fname):
-        os.makedirs(os.path.dirname(cache_fname), exist_ok=True)
-        cache_dict = {}
-        json.dump(cache_dict, open(cache_fname, 'wt'))
-    cache_dict = json.load(open(cache_fname, 'rt'))
+    os.makedirs(os.path.dirname(cache_fname), exist_ok=True)
+    # The client threads connect to tor while the cache loads and while the
+    # relay list is read, and each one starts measuring as soon as it's
+    # connected and there's a pair for it
+    rtt_cache = RttCache(args.cache_stripes, cache_lifetimes(args))\
+            .load_in_background(cache_fname)
+    prefetcher = None
+    prefetch_client = None
+    relay_health = None
+    timeouts = None
+    admission = None
+    if args.adaptive_timeouts: timeouts = AdaptiveTimeouts(args, log)
+    if args.admission_dir: admission = AdmissionControl(args, log)
+    if args.relay_fail_threshold > 0: relay_health = RelayHealth(args, log)
+    if args.prefetch_circs > 0:
+        prefetch_client = TingClient(args, log, stream_creation_lock,
+                rtt_cache, rm, relay_health=relay_health, timeouts=timeouts,
+                admission=admission)
+        prefetcher = CircuitPrefetcher(args, log, prefetch_client)
+    # Bounded so that we only read as far ahead of the client threads as it
+    # takes for a thread that finishes a pair to immediately find another
+    work_queue = Queue(maxsize=args.threads)
+    coordinator = None
+    relay_list = None
+    def on_done(result):
+        if coordinator: coordinator.add_result(result)
+        if relay_list != None:
+            relay_list.pair_measured(result['x']['fp'], result['y']['fp'])
+        cleanup_after_ting_thread(args, rtt_cache)
     client_threads = [ ClientThread(args, log, stream_creation_lock,
-        (cache_dict, cache_dict_lock), rm, kill_client_threads,
-        'worker-{}'.format(i)) \
+        rtt_cache, rm, prefetcher, relay_health,
+        timeouts, admission, work_queue, on_done, 'worker-{}'.format(i)) \
         for i in range(0, args.threads) ]
+    try:
+        if args.relay_source == 'coordinator':
+            coordinator = CoordinatorClient(args, log, rtt_cache)
+            pairs = coordinator.pairs()
+        else:
+            relay_list = RelayList(args, log)
+            pairs = relay_list
+            if len(relay_list) < 1: log.notice('There\'s nothing to do')
+    except SystemExit:
+        for _ in client_threads: work_queue.put(None)
+        if prefetcher: prefetcher.stop()
+        raise
+    if relay_health:
+        pairs = with_relay_health(pairs, relay_health, args, coordinator)
+    if prefetcher:
+        pairs = with_prefetching(pairs, prefetcher, args.prefetch_circs)
     start = time.time()
     last_stat_at = start
-    for i, item in enumerate(relay_list):
-        fp1, fp2 = item
-        dispatch_client_thread(get_next_client_thread(args, client_threads),
-            fp1, fp2)
+    for i, item in enumerate(pairs):
+        work_queue.put(item)
         now = time.time()
-        if last_stat_at + args.stats_interval <= now:
+        if last_stat_at + args.stats_interval <= now and relay_list == None:
+            log.notice('We are on item',i,'after',
+                    seconds_to_duration(now - start))
+            last_stat_at = now
+        elif last_stat_at + args.stats_interval <= now:
             dur = seconds_to_duration(now - start)
             rem = ((now - start) * len(relay_list) / i) - (now - start)
             rem = seconds_to_duration(rem)
@@ -115,11 +223,17 @@ def main(args):
                 len(relay_list), round(i*100.0/len(relay_list),1)),'It has '
                 'taken',dur,'and we expect to be done in',rem)
             last_stat_at = now
-    kill_client_threads.set()
+    for _ in client_threads: work_queue.put(None)
     for thr in [ t for t in client_threads if t.thread ]:
         thr.wait()
-    cleanup_after_ting_thread(args, client_threads[0], force=True)
-    kill_results_thread.set()
+    if prefetcher: prefetcher.stop()
+    if coordinator: coordinator.stop()
+    if relay_health: relay_health.sync()
+    if relay_list != None: relay_list.save_consensus_state()
+    cleanup_after_ting_thread(args, rtt_cache, force=True)
+    write_stats(args, client_threads, time.time() - start,
+            [ prefetch_client ])
+    rm.stop()
 
 if __name__ == '__main__':
     parser = ArgumentParser(
@@ -143,11 +257,73 @@ if __name__ == '__main__':
             help='Number of times we should try to collect all the samples '
             'over a completed circuit', default=3)
     parser.add_argument('--socks-timeout', metavar='SECS', type=int,
-            help='How long to wait for a socket to connect()',
+            help='How long to wait for a socket to connect(). With '
+            '--adaptive-timeouts, the longest we will wait',
+            default=10)
+    parser.add_argument('--circ-build-timeout', metavar='SECS', type=int,
+            help='How long tor may take to build a circuit. With '
+            '--adaptive-timeouts, the longest we will wait',
             default=10)
+    parser.add_argument('--adaptive-timeouts', action='store_true',
+            help='Base circuit build and socket connect timeouts on how long '
+            'they have recently taken through the same relays')
+    parser.add_argument('--timeout-quantile', metavar='Q', type=float,
+            help='With --adaptive-timeouts, which quantile of recent '
+            'latencies to base timeouts on', default=0.95)
+    parser.add_argument('--timeout-margin', metavar='SECS', type=float,
+            help='With --adaptive-timeouts, how much to add to the quantile',
+            default=1.0)
+    parser.add_argument('--timeout-min', metavar='SECS', type=float,
+            help='With --adaptive-timeouts, the shortest timeout to use',
+            default=2.0)
+    parser.add_argument('--timeout-min-samples', metavar='NUM', type=int,
+            help='With --adaptive-timeouts, how many latencies a relay or '
+            'our tor instance needs before we adapt to them', default=10)
+    parser.add_argument('--timeout-window', metavar='NUM', type=int,
+            help='With --adaptive-timeouts, how many of the most recent '
+            'latencies to remember per relay', default=100)
+    parser.add_argument('--admission-dir', metavar='DIR', type=str,
+            help='Directory in which every ting process on this host shares '
+            'limits on how many circuit builds and ting streams may be in '
+            'flight at once, so that W isn\'t overloaded. Not given means no '
+            'limits')
+    parser.add_argument('--admission-start', metavar='NUM', type=float,
+            help='With --admission-dir, how many circuit builds to allow at '
+            'once at first. This changes with how builds go', default=8)
+    parser.add_argument('--admission-min', metavar='NUM', type=float,
+            help='With --admission-dir, the fewest circuit builds to allow at '
+            'once', default=2)
+    parser.add_argument('--admission-max', metavar='NUM', type=float,
+            help='With --admission-dir, the most circuit builds to allow at '
+            'once', default=64)
+    parser.add_argument('--admission-decrease', metavar='FRAC', type=float,
+            help='With --admission-dir, what to multiply the number of '
+            'circuit builds allowed at once by when W looks overloaded',
+            default=0.75)
+    parser.add_argument('--admission-latency-factor', metavar='NUM',
+            type=float, help='With --admission-dir, consider W overloaded '
+            'when a circuit build takes this many times longer than the '
+            'fastest builds lately', default=3)
+    parser.add_argument('--admission-failure-rate', metavar='FRAC',
+            type=float, help='With --admission-dir, consider W overloaded '
+            'when a circuit build fails and more than this fraction of '
+            'recent builds have', default=0.3)
+    parser.add_argument('--admission-rate', metavar='NUM', type=float,
+            help='With --admission-dir, how many circuit builds may start '
+            'per second', default=20)
+    parser.add_argument('--admission-burst', metavar='NUM', type=float,
+            help='With --admission-dir, how many circuit builds may start at '
+            'once after a quiet period', default=10)
+    parser.add_argument('--admission-streams', metavar='NUM', type=int,
+            help='With --admission-dir, how many ting streams may be open at '
+            'once', default=48)
     parser.add_argument('--samples', metavar='NUM', type=int,
             help='How many "tings" to send over a completed circuit and take '
             'the min() of and call the RTT', default=200)
+    parser.add_argument('--rtt-histograms', action='store_true',
+            help='Keep a histogram of every circuit\'s samples with its '
+            'entries in the cache and results files instead of only the '
+            'min(). See rtt-hists.py')
     parser.add_argument('--target-host', metavar='HOST', type=str,
             help='Host/IP that the echo server is running', required=True)
     parser.add_argument('--target-port', metavar='PORT', type=int,
@@ -157,10 +333,30 @@ if __name__ == '__main__':
             default=1)
     parser.add_argument('--relay-source', metavar='SRC', type=str,
             help='Where to get relays to ting between',
-            choices=['internet','file','stdin'], default='internet')
+            choices=['internet','file','stdin','coordinator'],
+            default='internet')
     parser.add_argument('--relay-source-file', metavar='FNAME',
-            help='If SRC is file, the name of the file to read',
-            type=FileType('rt'), default='/dev/null')
+            help='If SRC is file, the name of the file to read. It may be '
+            'compressed with xz, gzip, or zstd if its name ends with .xz, '
+            '.gz, or .zst', type=str, default='/dev/null')
+    parser.add_argument('--relay-seed', metavar='NUM', type=int,
+            help='If SRC is internet, seed for picking which pairs to '
+            'measure so that the same consensus always gives the same '
+            'pairs. Not given means different pairs every time')
+    parser.add_argument('--consensus-state-file', metavar='FNAME', type=str,
+            help='If SRC is internet, only measure pairs with a relay that '
+            'is new or has a new address or flags since the consensus saved '
+            'in FNAME, and save the current one there when done. It may be '
+            'compressed like --relay-source-file')
+    parser.add_argument('--coordinator', metavar='HOST:PORT', type=str,
+            help='If SRC is coordinator, where coordinate-ting-workers.py is '
+            'listening')
+    parser.add_argument('--lease-pairs', metavar='NUM', type=int,
+            help='If SRC is coordinator, how many pairs to ask for at once',
+            default=20)
+    parser.add_argument('--coordinator-retry', metavar='SECS', type=float,
+            help='If SRC is coordinator, how long to keep trying to reach it '
+            'before giving up', default=60*5)
     parser.add_argument('--relay-max-pairs', metavar='NUM', type=int,
             help='Maximum number of relay pairs to read from SRC',
             default=100)
@@ -168,8 +364,13 @@ if __name__ == '__main__':
             help='Name of file to store cached data in',
             type=str, default='data/cache.json')
     parser.add_argument('--out-result-file', metavar='FNAME',
-            help='Name of file to which to write results',
-            type=str, default='data/results.json')
+            help='Name of file to which to write results. It and '
+            '--out-cache-file are compressed if their names end with .xz, '
+            '.gz, or .zst', type=str, default='data/results.json')
+    parser.add_argument('--out-stats-file', metavar='FNAME',
+            help='Name of file to which to write circuit building and '
+            'measurement stats when done',
+            type=str, default='data/stats.json')
     parser.add_argument('--write-results-every', metavar='NUM',
             help='Write results to file every time we collect NUM results',
             default=10)
@@ -183,6 +384,10 @@ if __name__ == '__main__':
     parser.add_argument('--cache-3hop-life', metavar='SECS', type=int,
             help='How long to consider 3hop cached results fresh',
             default=60*60*24*1)
+    parser.add_argument('--cache-stripes', metavar='NUM', type=int,
+            help='Number of separately locked parts to split the cache '
+            'into so that client threads rarely wait on each other',
+            default=16)
     parser.add_argument('--write-cache-every', metavar='NUM',
             help='Write cache file after every NUM collected results',
             default=10)
@@ -190,10 +395,46 @@ if __name__ == '__main__':
             help='When starting up and reading relay pairs from a source, we '
             'ignore a pair if we have a recent enough result already',
             default=60*60*24*100)
+    parser.add_argument('--schedule', choices=['staleness', 'file'],
+            help='Measure the pairs read from SRC with no or the oldest '
+            'results first, or in the order they were read',
+            default='staleness')
+    parser.add_argument('--schedule-relay-weight', metavar='NUM', type=float,
+            help='With --schedule staleness, how much sooner to measure '
+            'pairs with relays that have few results. 0 means only result '
+            'age matters', default=1.0)
+    parser.add_argument('--prefetch-circs', metavar='NUM', type=int,
+            help='Build circuits for upcoming relay pairs ahead of time, with '
+            'at most NUM being built or waiting to be used at once. 0 '
+            'disables prefetching', default=0)
+    parser.add_argument('--prefetch-max-age', metavar='SECS', type=float,
+            help='Close a prefetched circuit if it hasn\'t been used after '
+            'SECS seconds', default=60)
+    parser.add_argument('--relay-fail-threshold', metavar='NUM', type=int,
+            help='Consider a relay down after we fail to build circuits '
+            'through it NUM times in a row and stop measuring pairs with it '
+            'for a while. 0 disables this', default=0)
+    parser.add_argument('--relay-backoff', metavar='SECS', type=float,
+            help='How long to consider a relay down at first. This doubles '
+            'every time it fails again', default=60*5)
+    parser.add_argument('--relay-backoff-max', metavar='SECS', type=float,
+            help='The longest to consider a relay down before rechecking it',
+            default=60*60*6)
+    parser.add_argument('--relay-recheck-wait', metavar='SECS', type=float,
+            help='Once every other pair is done, wait at most this long for '
+            'down relays to be rechecked before giving up on their pairs',
+            default=60*10)
+    parser.add_argument('--relay-health-file', metavar='FNAME', type=str,
+            help='File in which to share which relays are down with other '
+            'ting processes', default='data/relay-health.json')
+    parser.add_argument('--relay-health-sync', metavar='SECS', type=float,
+            help='How often to sync with the relay health file', default=30)
     parser.add_argument('--stats-interval', metavar='SECS', type=float,
             help='Log information about our progress every SECS seconds at '
             'level "notice"', default=60)
     args = parser.parse_args()
     assert len(args.w_relay) == 40
     assert len(args.z_relay) == 40
+    if args.relay_source == 'coordinator' and not args.coordinator:
+        parser.error('--relay-source coordinator needs --coordinator')
     exit(main(args))
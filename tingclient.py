@@ -1,19 +1,28 @@
 from stem import ( CircuitExtensionFailed, DescriptorUnavailable,
-        InvalidRequest, SocketError
+        InvalidRequest, SocketError, Timeout
 )
 from stem.control import Controller, EventType
+from rtthist import RttHistogram
+from threading import Event
 import socks # PySocks
 import socket
 import time
 
 class TingClient():
-    def __init__(self, args, logger, stream_creation_lock, cache_dict,
-            results_manager):
+    def __init__(self, args, logger, stream_creation_lock, rtt_cache,
+            results_manager, prefetcher=None, relay_health=None,
+            timeouts=None, admission=None):
         self._args = args
         self._log = logger
         self._stream_creation_lock = stream_creation_lock
-        self._cache_dict, self._cache_dict_lock = cache_dict
+        self._rtt_cache = rtt_cache
         self._results_manager = results_manager
+        self._prefetcher = prefetcher
+        self._relay_health = relay_health
+        self._timeouts = timeouts
+        self._admission = admission
+        self.stats = { 'circ_builds': 0, 'circ_build_failures': 0,
+                'circ_build_time': 0.0, 'pairs': 0, 'failed_pairs': 0 }
         self._cont = \
             self._init_controller(args.ctrl_port)
 
@@ -49,7 +58,8 @@ class TingClient():
         cont.set_conf('__DisablePredictedCircuits', '1')
         cont.set_conf('__LeaveStreamsUnattached', '1')
         cont.set_conf('LearnCircuitBuildTimeout','0')
-        cont.set_conf('CircuitBuildTimeout','10')
+        cont.set_conf('CircuitBuildTimeout',
+                str(int(self._args.circ_build_timeout)))
         return cont
 
     def _new_socket(self):
@@ -65,21 +75,76 @@ class TingClient():
         s.settimeout(socks_timeout)
         return s
 
+    # Like Controller.new_circuit(path, await_build=True) but gives up after
+    # timeout seconds and closes the circuit instead of waiting for tor's own
+    # CircuitBuildTimeout
+    def _new_circuit(self, path, timeout):
+        done = Event()
+        statuses = {}
+        circ_id = None
+        def circ_event_listener(event):
+            statuses[event.id] = event.status
+            if event.id == circ_id and \
+                    event.status in ('BUILT', 'FAILED', 'CLOSED'):
+                done.set()
+        self._cont.add_event_listener(circ_event_listener, EventType.CIRC)
+        try:
+            circ_id = self._cont.new_circuit(path, await_build=False)
+            # It may have finished before we knew which circuit to look for
+            if statuses.get(circ_id) in ('BUILT', 'FAILED', 'CLOSED'):
+                done.set()
+            if not done.wait(timeout):
+                self._close_circ(circ_id)
+                raise Timeout('Circ {} took longer than {} secs to '
+                    'build'.format(circ_id, round(timeout, 2)))
+            if statuses[circ_id] != 'BUILT':
+                raise CircuitExtensionFailed('Circ {} {}'.format(circ_id,
+                    statuses[circ_id]))
+            return circ_id
+        finally:
+            self._cont.remove_event_listener(circ_event_listener)
+
     def _build_circ(self, path):
         log = self._log
         relay_nicks = self._path_to_nicks(path)
         attempts = self._args.circ_build_attempts
         while attempts > 0:
+            timeout = None
+            if self._timeouts: timeout = self._timeouts.build_timeout(path)
+            slot = None
+            if self._admission: slot = self._admission.acquire_build()
+            # How long the build took and whether it worked, for admission
+            # control. Left None if it says nothing about how loaded W is,
+            # such as when tor refuses to build it or something else breaks.
+            secs, succeeded = None, None
             try:
                 attempts -= 1
                 log.info('Building circ: {}'.format('->'.join(relay_nicks)))
-                circ_id = self._cont.new_circuit(path, await_build=True)
-            except (InvalidRequest, CircuitExtensionFailed) as e:
+                self.stats['circ_builds'] += 1
+                start = time.time()
+                if timeout:
+                    circ_id = self._new_circuit(path, timeout)
+                else:
+                    circ_id = self._cont.new_circuit(path, await_build=True)
+                secs, succeeded = time.time() - start, True
+            except (InvalidRequest, CircuitExtensionFailed, Timeout) as e:
+                self.stats['circ_build_failures'] += 1
                 log.warn('Failed to build circ: {}'.format(e))
-            else:
+                if isinstance(e, Timeout):
+                    self._timeouts.record_build(path, timeout)
+                if not isinstance(e, InvalidRequest):
+                    secs, succeeded = time.time() - start, False
+            finally:
+                if slot: self._admission.release_build(slot, secs, succeeded)
+            if succeeded:
+                self.stats['circ_build_time'] += secs
+                if self._timeouts:
+                    self._timeouts.record_build(path, secs)
                 log.debug('Built circ {} {}'.format(circ_id,
                     '->'.join(relay_nicks)))
+                if self._relay_health: self._relay_health.succeeded(path)
                 return circ_id
+        if self._relay_health: self._relay_health.failed(path)
         return None
 
     def _close_circ(self, circ_id):
@@ -87,32 +152,56 @@ class TingClient():
         if self._cont.get_circuit(circ_id, default=None):
             self._cont.close_circuit(circ_id)
 
-    def ting(self, circ_id):
+    def ting(self, circ_id, path=None):
+        samples = self._ting_samples(circ_id, path)
+        if samples == None: return None
+        return min(samples)
+
+    # Every sample's RTT, or None if we couldn't measure over circ_id
+    def _ting_samples(self, circ_id, path=None):
         log = self._log
         host = self._args.target_host
         port = self._args.target_port
         num_samples = self._args.samples
-        log.debug('Waiting for lock to create stream')
-        self._stream_creation_lock.acquire()
-        log.debug('Received lock')
-        stream_event_listener = self._stream_event_listener(circ_id)
-        self._cont.add_event_listener(stream_event_listener, EventType.STREAM)
-        s = self._new_socket()
+        slot, s = None, None
         try:
-            log.info('Attempting connection to {}:{} through socks5 proxy'\
-                .format(host, port))
-            s.connect( (host, port) )
-            self._cont.remove_event_listener(stream_event_listener)
-        except (socks.ProxyConnectionError, socks.GeneralProxyError) as e:
-            log.warn('Couldn\'t connect to {}:{} through socks5 proxy: {}'\
-                .format(host,port,e))
-            self._cont.remove_event_listener(stream_event_listener)
-            self._stream_creation_lock.release()
-            log.debug('Released lock to create stream')
-        else:
-            self._cont.remove_event_listener(stream_event_listener)
-            self._stream_creation_lock.release()
-            log.debug('Released lock to create stream')
+            if self._admission: slot = self._admission.acquire_stream()
+            log.debug('Waiting for lock to create stream')
+            self._stream_creation_lock.acquire()
+            log.debug('Received lock')
+            stream_event_listener, connect_timeout, start = None, None, None
+            # Whatever happens while connecting, stop listening for stream
+            # events and let the next stream be created
+            try:
+                listener = self._stream_event_listener(circ_id)
+                self._cont.add_event_listener(listener, EventType.STREAM)
+                stream_event_listener = listener
+                s = self._new_socket()
+                if self._timeouts and path:
+                    connect_timeout = self._timeouts.connect_timeout(path)
+                    s.settimeout(connect_timeout)
+                log.info('Attempting connection to {}:{} through socks5 '
+                    'proxy'.format(host, port))
+                start = time.time()
+                s.connect( (host, port) )
+                if connect_timeout:
+                    self._timeouts.record_connect(path, time.time() - start)
+                    s.settimeout(self._args.socks_timeout)
+            # A plain socket.timeout or other OSError can come out of connect()
+            # too, not just the socks errors
+            except (socks.ProxyConnectionError, socks.GeneralProxyError,
+                    OSError) as e:
+                log.warn('Couldn\'t connect to {}:{} through socks5 proxy: {}'\
+                    .format(host,port,e))
+                if connect_timeout and start and \
+                        time.time() - start >= connect_timeout:
+                    self._timeouts.record_connect(path, connect_timeout)
+                return None
+            finally:
+                if stream_event_listener:
+                    self._cont.remove_event_listener(stream_event_listener)
+                self._stream_creation_lock.release()
+                log.debug('Released lock to create stream')
             msg, done = b'!', b'X'
             log.info('Sending {} tings on circ {}'.format(num_samples, circ_id))
             samples = []
@@ -127,40 +216,41 @@ class TingClient():
                 try: s.shutdown(socket.SHUT_RDWR)
                 except: pass
                 log.info('Min RTT: {}'.format(min(samples)))
-                return min(samples)
+                return samples
             except (BrokenPipeError, socket.timeout):
                 log.warn("Failed to measure over circ {} due to timeout or "
                     "a broken pipe".format(circ_id))
                 return None
         finally:
-            s.close()
+            if s: s.close()
+            if slot: self._admission.release_stream(slot)
 
+    # The RTT over path and, if args.rtt_histograms, the histogram of the
+    # samples it is the min() of as from RttHistogram.to_list()
     def _get_rtt_on(self, path):
+        want_hist = self._args.rtt_histograms
         cached_rtt = self._get_cached_rtt(path)
         if cached_rtt != None:
             relay_nicks = self._path_to_nicks(path)
             self._log.info('Using cached RTT of {} for {}'.format(
                 cached_rtt, '->'.join(relay_nicks)))
-            return cached_rtt
+            return cached_rtt, \
+                    self._rtt_cache.hist(path) if want_hist else None
         attempts = self._args.measurement_attempts
-        circ_id = self._build_circ(path)
-        if circ_id == None: return None
+        circ_id = None
+        if self._prefetcher: circ_id = self._prefetcher.take(path)
+        if circ_id == None: circ_id = self._build_circ(path)
+        if circ_id == None: return None, None
+        samples = None
         for _ in range(0,attempts):
-            rtt = self.ting(circ_id)
-            if rtt != None: break
+            samples = self._ting_samples(circ_id, path)
+            if samples != None: break
         self._close_circ(circ_id)
-        return rtt
-
-    def _create_rtt_cache_entry(self, rtt, path):
-        self._log.info('Caching RTT of {} for {}'.format(
-            rtt, '->'.join(self._path_to_nicks(path))))
-        return {
-                'rtt': rtt,
-                'path': path,
-                'time': time.time()
-        }
-
-    def _cache_rtt(self, rtt, path):
+        if samples == None: return None, None
+        if not want_hist: return min(samples), None
+        return min(samples), RttHistogram().add_samples(samples).to_list()
+
+    def _cache_rtt(self, rtt, path, hist=None):
         assert len(path) == 3 or len(path) == 4
         if len(path) == 3:
             if not self._args.cache_3hop: return
@@ -168,18 +258,9 @@ class TingClient():
         else:
             if not self._args.cache_4hop: return
             lifetime = self._args.cache_4hop_life
-        key = '-'.join(path)
-        self._cache_dict_lock.acquire()
-        cache_dict = self._cache_dict
-        if key not in cache_dict:
-            cache_dict[key] = self._create_rtt_cache_entry(rtt, path)
-        else:
-            now = time.time()
-            cached_at = cache_dict[key]['time']
-            if cached_at + lifetime <= now or \
-                cache_dict[key]['rtt'] > rtt:
-                cache_dict[key] = self._create_rtt_cache_entry(rtt, path)
-        self._cache_dict_lock.release()
+        if self._rtt_cache.put(path, rtt, lifetime, hist=hist):
+            self._log.info('Caching RTT of {} for {}'.format(
+                rtt, '->'.join(self._path_to_nicks(path))))
 
     def _get_cached_rtt(self, path):
         if len(path) == 3:
@@ -188,48 +269,52 @@ class TingClient():
         else:
             if not self._args.cache_4hop: return None
             lifetime = self._args.cache_4hop_life
-        key = '-'.join(path)
-        cache_dict = self._cache_dict
-        self._cache_dict_lock.acquire()
-        if key not in cache_dict: rtt = None
-        else:
-            now = time.time()
-            cached_at = cache_dict[key]['time']
-            if cached_at + lifetime < now: rtt = None
-            else: rtt = cache_dict[key]['rtt']
-        self._cache_dict_lock.release()
-        return rtt
+        return self._rtt_cache.get(path, lifetime)
 
     def perform_on(self, target1_fp, target2_fp):
+        result = self._perform_on(target1_fp, target2_fp)
+        self.stats['pairs'] += 1
+        if result['rtt'] == None: self.stats['failed_pairs'] += 1
+        return result
+
+    def _perform_on(self, target1_fp, target2_fp):
         w = self._args.w_relay
         x, y = target1_fp, target2_fp
         z = self._args.z_relay
         wxyz_rtt, wxz_rtt, wyz_rtt = None, None, None
+        # Only filled in if args.rtt_histograms
+        hists = {}
 
         path = [w,x,y,z]
-        wxyz_rtt = self._get_rtt_on(path)
+        wxyz_rtt, hists['wxyz'] = self._get_rtt_on(path)
         if wxyz_rtt == None:
             return self._results_manager.add_result(
-                    self._results_manager.make_result(None,x,y))
-        else: self._cache_rtt(wxyz_rtt, path)
+                    self._results_manager.make_result(None,x,y,hists))
+        else: self._cache_rtt(wxyz_rtt, path, hists['wxyz'])
 
         path = [w,x,z]
-        wxz_rtt = self._get_rtt_on(path)
+        wxz_rtt, hists['wxz'] = self._get_rtt_on(path)
         if wxz_rtt == None:
             return self._results_manager.add_result(
-                    self._results_manager.make_result(None,x,y))
-        else: self._cache_rtt(wxz_rtt, path)
+                    self._results_manager.make_result(None,x,y,hists))
+        else: self._cache_rtt(wxz_rtt, path, hists['wxz'])
 
         path = [w,y,z]
-        wyz_rtt = self._get_rtt_on(path)
+        wyz_rtt, hists['wyz'] = self._get_rtt_on(path)
         if wyz_rtt == None:
             return self._results_manager.add_result(
-                    self._results_manager.make_result(None,x,y))
-        else: self._cache_rtt(wyz_rtt, path)
+                    self._results_manager.make_result(None,x,y,hists))
+        else: self._cache_rtt(wyz_rtt, path, hists['wyz'])
 
         xy_rtt = wxyz_rtt - 0.5*wxz_rtt - 0.5*wyz_rtt
         return self._results_manager.add_result(
-                self._results_manager.make_result(xy_rtt,x,y))
+                self._results_manager.make_result(xy_rtt,x,y,hists))
+
+    # Measure each pair in turn over this client's controller and return the
+    # results, in the same order as the pairs, instead of needing to read
+    # them back from a results file
+    def perform_on_pairs(self, pairs):
+        return [ self.perform_on(fp1, fp2) for fp1, fp2 in pairs ]
 
     def _stream_event_listener(self, circ_id):
         log = self._log
@@ -0,0 +1,179 @@
+from stem.control import Controller
+from threading import Event, Thread
+import json
+import os
+import subprocess
+import time
+
+# One tor process that we started and are watching. Its SocksPort and
+# ControlPort never change, even across restarts, so whatever was using it
+# can just reconnect once it's back.
+class TorInstance():
+    def __init__(self, args, logger, socks_port, ctrl_port):
+        self._args = args
+        self._log = logger
+        self.socks_port = socks_port
+        self.ctrl_port = ctrl_port
+        self.datadir = os.path.abspath(os.path.join(args.datadir,
+            str(socks_port)))
+        self.proc = None
+        self.restarts = 0
+        self.is_ready = False
+        self.not_ready_since = None
+
+    def _command(self):
+        args = self._args
+        cmd = [ args.tor_bin,
+            '--SocksPort', str(self.socks_port),
+            '--ControlPort', str(self.ctrl_port),
+            '--CookieAuthentication', '1',
+            '--Log', 'err file {}'.format(
+                os.path.join(self.datadir, 'error.log')),
+            '--DataDirectory', self.datadir,
+            '--PidFile', os.path.join(self.datadir, 'tor.pid'),
+            '--defaults-torrc', '/dev/null',
+            '--LearnCircuitBuildTimeout', '0',
+            '--CircuitBuildTimeout', '10',
+        ]
+        for bridge in args.bridge: cmd.extend(['--Bridge', bridge])
+        if args.bridge: cmd.extend(['--UseBridges', '1'])
+        return cmd
+
+    def start(self):
+        os.makedirs(self.datadir, exist_ok=True)
+        self._log.notice('Starting tor with SocksPort',self.socks_port,
+            'and ControlPort',self.ctrl_port)
+        self.is_ready = False
+        self.not_ready_since = time.time()
+        self.proc = subprocess.Popen(self._command(),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def stop(self):
+        self.is_ready = False
+        if not self.is_running(): return
+        self.proc.terminate()
+        try: self.proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+    def is_running(self):
+        if not self.proc: return False
+        if self.proc.poll() == None: return True
+        return False
+
+    # Whether tor has finished bootstrapping and has enough of a consensus to
+    # build circuits
+    def check_ready(self):
+        if not self.is_running(): return False
+        try:
+            with Controller.from_port(port=self.ctrl_port) as cont:
+                cont.authenticate()
+                phase = cont.get_info('status/bootstrap-phase')
+                enough = cont.get_info('status/enough-dir-info')
+        except Exception as e:
+            self._log.debug('Couldn\'t ask tor on',self.ctrl_port,
+                'if it is ready:',e)
+            return False
+        return 'PROGRESS=100' in phase and enough == '1'
+
+    def to_dict(self):
+        return { 'socks_port': self.socks_port, 'ctrl_port': self.ctrl_port,
+            'datadir': self.datadir }
+
+# Starts args.num_tors tor instances, waits for them to bootstrap, and then
+# keeps them alive, restarting any that die or stop answering on their
+# control port. The instances that are currently ready are kept in
+# args.instances_file for dispatch-ting-procs.py to read.
+class TorSupervisor():
+    def __init__(self, args, logger):
+        self._args = args
+        self._log = logger
+        self._is_shutting_down = Event()
+        self.instances = [ TorInstance(args, logger,
+            args.base_port + 2*i, args.base_port + 2*i + 1) \
+            for i in range(args.num_tors) ]
+        self._monitor_thread = None
+
+    def start(self):
+        for inst in self.instances: inst.start()
+        self.wait_until_ready(self.instances)
+        self._write_instances_file()
+        self._monitor_thread = Thread(target=self._monitor, name='monitor')
+        self._monitor_thread.start()
+
+    def stop(self):
+        self._is_shutting_down.set()
+        if self._monitor_thread: self._monitor_thread.join()
+        for inst in self.instances: inst.stop()
+        self._write_instances_file()
+
+    def live_instances(self):
+        return [ inst for inst in self.instances if inst.is_ready ]
+
+    def wait_until_ready(self, instances):
+        deadline = time.time() + self._args.bootstrap_timeout
+        waiting = list(instances)
+        while len(waiting) > 0 and time.time() < deadline:
+            if self._is_shutting_down.is_set(): return
+            for inst in list(waiting):
+                if inst.check_ready():
+                    inst.is_ready = True
+                    inst.not_ready_since = None
+                    waiting.remove(inst)
+                    self._log.notice('Tor on',inst.ctrl_port,'is ready')
+            if len(waiting) > 0: time.sleep(1)
+        for inst in waiting:
+            self._log.warn('Tor on',inst.ctrl_port,'did not bootstrap within',
+                self._args.bootstrap_timeout,'seconds')
+
+    def _restart(self, inst):
+        inst.restarts += 1
+        self._log.warn('Restarting tor on',inst.ctrl_port,'(restart number',
+            '{})'.format(inst.restarts))
+        inst.stop()
+        inst.start()
+
+    # A tor that died is restarted right away. One that is running but has not
+    # been ready for longer than it's allowed to take to bootstrap is assumed
+    # to be stuck and is restarted too.
+    def _monitor(self):
+        while not self._is_shutting_down.wait(self._args.check_interval):
+            before = [ inst.is_ready for inst in self.instances ]
+            now = time.time()
+            for inst in self.instances:
+                if not inst.is_running():
+                    self._log.warn('Tor on',inst.ctrl_port,'died')
+                    self._restart(inst)
+                elif inst.check_ready():
+                    if not inst.is_ready:
+                        self._log.notice('Tor on',inst.ctrl_port,'is ready')
+                    inst.is_ready = True
+                    inst.not_ready_since = None
+                else:
+                    if inst.is_ready:
+                        self._log.warn('Tor on',inst.ctrl_port,'stopped '
+                            'being ready')
+                        inst.not_ready_since = now
+                    inst.is_ready = False
+                    timeout = self._args.bootstrap_timeout
+                    if inst.not_ready_since + timeout < now:
+                        self._restart(inst)
+            if before != [ inst.is_ready for inst in self.instances ]:
+                self._write_instances_file()
+
+    def _write_instances_file(self):
+        fname = self._args.instances_file
+        tmp_fname = fname + '.tmp'
+        with open(tmp_fname, 'wt') as f:
+            json.dump([ inst.to_dict() for inst in self.live_instances() ], f)
+        os.replace(tmp_fname, fname)
+
+# Read the list of live tor instances written by a TorSupervisor. Returns a
+# list of (socks_port, ctrl_port)
+def read_instances_file(fname):
+    if not os.path.isfile(fname): return []
+    with open(fname, 'rt') as f:
+        try: instances = json.load(f)
+        except ValueError: return []
+    return [ (inst['socks_port'], inst['ctrl_port']) for inst in instances ]